@@ -0,0 +1,227 @@
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+from config import load_server_config
+
+# 加性增：每完成约 limit 次未过载的调用，上限加 1
+ADDITIVE_INCREASE = 1.0
+# 乘性减：被限流（429）时上限减半；延迟明显变差或超时/5xx 时小幅下调
+THROTTLE_DECREASE = 0.5
+OVERLOAD_DECREASE = 0.9
+# 单位输出延迟超过基线的该倍数视为过载（梯度信号）
+LATENCY_TOLERANCE = 2.0
+# 延迟基线：最近若干次调用单位输出延迟的低分位数
+BASELINE_SAMPLES = 100
+BASELINE_QUANTILE = 0.1
+# 最近延迟的指数平滑系数
+LATENCY_EWMA_ALPHA = 0.2
+# 单位输出延迟按至少这么多输出 token 计，避免极短回复放大首字延迟
+MIN_NORMALIZE_TOKENS = 50
+# 被限流后的这段时间内不再上调
+THROTTLE_COOLDOWN_S = 10.0
+# 每个端点保留的上限变化记录条数
+HISTORY_MAX = 200
+# 排队请求带有取消检查时的检查间隔（秒）
+QUEUE_CHECK_S = 0.5
+
+_THROTTLE_MARKERS = ("rate limit", "ratelimit", "too many requests", "resource_exhausted", "quota")
+_OVERLOAD_MARKERS = ("timeout", "timed out", "internal server error", "bad gateway", "overloaded", "unavailable")
+# 异常信息中的 HTTP 状态码：位于开头（“503 UNAVAILABLE”）或紧跟“error code/status”（“Error code: 429”），
+# 不匹配正文中偶然出现的数字（如“max_tokens 5000”）
+_STATUS_TEXT_RE = re.compile(r"(?:^|\b(?:error code|status code|status|http)\b[\s:=]*)([45]\d\d)\b", re.IGNORECASE)
+
+
+def classify_error(error: BaseException) -> str:
+    """将调用异常归类为 throttle（限流）、overload（超时/服务端过载）或 other。"""
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if not isinstance(status, int):
+        match = _STATUS_TEXT_RE.search(str(error).strip())
+        status = int(match.group(1)) if match else None
+    if status == 429:
+        return "throttle"
+    text = f"{type(error).__name__} {error}".lower()
+    if any(m in text for m in _THROTTLE_MARKERS):
+        return "throttle"
+    if isinstance(status, int) and status >= 500:
+        return "overload"
+    if any(m in text for m in _OVERLOAD_MARKERS):
+        return "overload"
+    return "other"
+
+
+class EndpointSaturated(Exception):
+    """非阻塞占用时端点在途数已达上限。"""
+
+
+class EndpointLimiter:
+    """
+    单个模型端点（提供商 + 地址 + 模型）的自适应在途请求上限（AIMD）。
+    - 调用成功且延迟正常、并且上限已被用满时加性上调
+    - 被限流时乘性下调并进入冷却；超时、5xx 或单位输出延迟超过基线 LATENCY_TOLERANCE 倍时小幅下调
+    延迟以“耗时 / 输出 token”度量，避免长短回复混杂导致误判。
+    """
+
+    def __init__(self, endpoint: str, initial: int, max_limit: int, min_limit: int = 1):
+        self.endpoint = endpoint
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.in_flight = 0
+        self.queued = 0
+        self.calls = 0
+        self.throttled = 0
+        self.errors = 0
+        self._latencies: Deque[float] = deque(maxlen=BASELINE_SAMPLES)
+        self._latency_ewma: Optional[float] = None
+        self._cooldown_until = 0.0
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=HISTORY_MAX)
+        self._cond = threading.Condition()
+        self._record_change("init")
+
+    # --- 占用 ---
+
+    @contextmanager
+    def acquire(self, check: Optional[Callable[[], None]] = None, block: bool = True) -> Iterator[Dict[str, Any]]:
+        """
+        占用一个在途名额（阻塞直至在途数低于当前上限；block=False 时已满即抛出 EndpointSaturated）。
+        返回的字典用于回填调用结果：成功时设置 output_tokens，失败时设置 error。
+        """
+        enqueued_at = time.time()
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                if not block:
+                    raise EndpointSaturated(self.endpoint)
+                self._wait_for_capacity(check)
+            self.in_flight += 1
+            saturated = self.in_flight >= int(self.limit)
+        info: Dict[str, Any] = {"waited_s": round(time.time() - enqueued_at, 3), "output_tokens": None, "error": None}
+        started = time.perf_counter()
+        try:
+            yield info
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._cond:
+                self.in_flight -= 1
+                if info["error"] is not None:
+                    self._on_error(info["error"])
+                elif info["output_tokens"] is not None:
+                    self._on_success(elapsed, info["output_tokens"], saturated)
+                self._cond.notify_all()
+
+    def wait_available(self, check: Optional[Callable[[], None]] = None):
+        """阻塞直至在途数低于当前上限（不占用名额；调用方随后以 block=False 占用，仍可能被别人抢先）。"""
+        with self._cond:
+            self._wait_for_capacity(check)
+
+    def _wait_for_capacity(self, check: Optional[Callable[[], None]]):
+        self.queued += 1
+        try:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait(timeout=QUEUE_CHECK_S)
+                if check is not None:
+                    check()
+        finally:
+            self.queued -= 1
+
+    # --- 调整 ---
+
+    def _baseline(self) -> Optional[float]:
+        if len(self._latencies) < 5:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(BASELINE_QUANTILE * (len(ordered) - 1))]
+
+    def _on_success(self, elapsed: float, output_tokens: int, saturated: bool):
+        self.calls += 1
+        sample = elapsed / max(MIN_NORMALIZE_TOKENS, output_tokens)
+        self._latencies.append(sample)
+        alpha = LATENCY_EWMA_ALPHA
+        self._latency_ewma = sample if self._latency_ewma is None else alpha * sample + (1 - alpha) * self._latency_ewma
+        baseline = self._baseline()
+        if baseline is not None and self._latency_ewma > baseline * LATENCY_TOLERANCE:
+            self._decrease(OVERLOAD_DECREASE, "latency")
+            # 下调后重新累积，避免同一轮过载被反复计入
+            self._latency_ewma = baseline * LATENCY_TOLERANCE
+        elif saturated and time.time() >= self._cooldown_until and self.limit < self.max_limit:
+            # 只有上限确实被用满时才上调，空闲时的成功不能证明后端承受得住更高并发
+            before = int(self.limit)
+            self.limit = min(self.max_limit, self.limit + ADDITIVE_INCREASE / self.limit)
+            if int(self.limit) != before:
+                self._record_change("increase")
+
+    def _on_error(self, error: BaseException):
+        kind = classify_error(error)
+        if kind == "throttle":
+            self.throttled += 1
+            self._cooldown_until = time.time() + THROTTLE_COOLDOWN_S
+            self._decrease(THROTTLE_DECREASE, "throttle")
+        elif kind == "overload":
+            self.errors += 1
+            self._decrease(OVERLOAD_DECREASE, "error")
+        else:
+            self.errors += 1
+
+    def _decrease(self, factor: float, reason: str):
+        before = int(self.limit)
+        self.limit = max(float(self.min_limit), self.limit * factor)
+        if int(self.limit) != before or reason == "throttle":
+            self._record_change(reason)
+
+    def _record_change(self, reason: str):
+        self.history.append({"ts": time.time(), "limit": int(self.limit), "reason": reason})
+
+    # --- 监控 ---
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            baseline = self._baseline()
+            return {
+                "endpoint": self.endpoint,
+                "limit": int(self.limit),
+                "max_limit": self.max_limit,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "errors": self.errors,
+                "latency_ms_per_token": round(self._latency_ewma * 1000, 2) if self._latency_ewma is not None else None,
+                "baseline_ms_per_token": round(baseline * 1000, 2) if baseline is not None else None,
+            }
+
+    def history_snapshot(self) -> List[Dict[str, Any]]:
+        with self._cond:
+            return list(self.history)
+
+
+_LIMITERS: Dict[str, EndpointLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_endpoint_limiter(endpoint: str) -> EndpointLimiter:
+    """返回进程级共享的端点限流器（同一端点的所有会话共用，参数来自 load_server_config）。"""
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(endpoint)
+        if limiter is None:
+            cfg = load_server_config()
+            limiter = EndpointLimiter(endpoint, cfg["endpoint_initial_concurrency"], cfg["endpoint_max_concurrency"])
+            _LIMITERS[endpoint] = limiter
+        return limiter
+
+
+def endpoint_stats() -> List[Dict[str, Any]]:
+    """各端点当前的在途上限、排队与延迟统计，供管理视图展示。"""
+    with _LIMITERS_LOCK:
+        limiters = list(_LIMITERS.values())
+    return [limiter.stats() for limiter in limiters]
+
+
+def endpoint_history() -> List[Dict[str, Any]]:
+    """各端点在途上限的变化记录（按时间排序），供管理视图绘制曲线。"""
+    with _LIMITERS_LOCK:
+        limiters = list(_LIMITERS.values())
+    rows = [dict(item, endpoint=limiter.endpoint) for limiter in limiters for item in limiter.history_snapshot()]
+    return sorted(rows, key=lambda r: r["ts"])
@@ -1,9 +1,27 @@
 import toml
 import os
+import copy
+import json
+import time
+import hmac
+import base64
 import hashlib
+import secrets
+import threading
 import bcrypt
-from typing import Optional, Dict, Any
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
 import streamlit as st
+from config import load_auth_settings
+
+# 单密钥模式下用于登录节流的标识
+ACCESS_KEY_IDENTITY = "__access_key__"
+# 最多保留的登录失败记录数（按最近失败时间淘汰），防止随意编造的用户名使内存无限增长
+LOGIN_FAILURES_MAX = 10000
+
+
+# 同时进行的 bcrypt 校验数上限，避免暴力尝试占满 CPU
+_BCRYPT_CHECK_SLOTS = threading.BoundedSemaphore(1)
 
 
 class AuthManager:
@@ -11,6 +29,15 @@ class AuthManager:
 
     def __init__(self, config_file: str = "auth_config.toml"):
         self.config_file = config_file
+        self.settings = load_auth_settings()
+        self._lock = threading.RLock()
+        self._cache: Optional[Dict[str, Any]] = None
+        self._cache_mtime: Optional[float] = None
+        # 会话令牌签名密钥：仅存于进程内存，进程重启后所有令牌失效
+        self._session_secret = secrets.token_bytes(32)
+        # 登录失败记录：(标识, 客户端地址) -> (连续失败次数, 锁定截止时间, 最近失败时间)
+        # 按客户端区分，他人无法靠反复输错密码锁定管理员账号
+        self._failures: "OrderedDict[Tuple[str, str], Tuple[int, float, float]]" = OrderedDict()
         self._ensure_config_exists()
 
     def _ensure_config_exists(self):
@@ -27,33 +54,67 @@ class AuthManager:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 toml.dump(default_config, f)
 
+    def _load_full_config(self) -> Dict[str, Any]:
+        """加载完整配置文件（auth 与 users 两个分节），文件修改时间不变时直接返回内存缓存"""
+        with self._lock:
+            try:
+                mtime = os.stat(self.config_file).st_mtime
+            except FileNotFoundError:
+                return {}
+            if self._cache is not None and mtime == self._cache_mtime:
+                return self._cache
+            try:
+                with open(self.config_file, 'r', encoding='utf-8') as f:
+                    self._cache = toml.load(f)
+            except (FileNotFoundError, toml.TomlDecodeError):
+                self._cache = {}
+            self._cache_mtime = mtime
+            return self._cache
+
+    def _cached_config(self) -> Dict[str, Any]:
+        """返回内存中的配置（不触发文件I/O），尚未加载时才读取文件"""
+        with self._lock:
+            if self._cache is None:
+                return self._load_full_config()
+            return self._cache
+
     def _load_config(self) -> Dict[str, Any]:
         """加载配置文件"""
-        try:
-            with open(self.config_file, 'r', encoding='utf-8') as f:
-                config = toml.load(f)
-                return config.get("auth", {})
-        except (FileNotFoundError, toml.TomlDecodeError):
-            return {"access_key_hash": None, "salt": None, "is_configured": False}
+        config = self._load_full_config()
+        return config.get("auth", {"access_key_hash": None, "salt": None, "is_configured": False})
+
+    def _save_full_config(self, full_config: Dict[str, Any]):
+        with self._lock:
+            with open(self.config_file, 'w', encoding='utf-8') as f:
+                toml.dump(full_config, f)
+            self._cache = full_config
+            self._cache_mtime = os.stat(self.config_file).st_mtime
 
     def _save_config(self, config: Dict[str, Any]):
-        """保存配置文件"""
-        full_config = {"auth": config}
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            toml.dump(full_config, f)
+        """保存配置文件（保留用户账号分节）"""
+        with self._lock:
+            full_config = copy.deepcopy(self._load_full_config())
+            full_config["auth"] = config
+            self._save_full_config(full_config)
+
+    def _hashpw(self, secret: str) -> bytes:
+        return bcrypt.hashpw(secret.encode('utf-8'), bcrypt.gensalt(rounds=self.settings["bcrypt_rounds"]))
+
+    @staticmethod
+    def _checkpw(secret: str, stored_hash: str) -> bool:
+        with _BCRYPT_CHECK_SLOTS:
+            return bcrypt.checkpw(secret.encode('utf-8'), stored_hash.encode('utf-8'))
 
     def set_access_key(self, access_key: str) -> bool:
         """设置访问密钥"""
         try:
-            # 生成盐值
-            salt = bcrypt.gensalt()
-            # 生成密码哈希
-            key_hash = bcrypt.hashpw(access_key.encode('utf-8'), salt)
+            # 生成密码哈希（成本因子见 AUTH_BCRYPT_ROUNDS）
+            key_hash = self._hashpw(access_key)
 
             # 保存配置
             config = {
                 "access_key_hash": key_hash.decode('utf-8'),
-                "salt": salt.decode('utf-8'),
+                "salt": key_hash[:29].decode('utf-8'),
                 "is_configured": True
             }
             self._save_config(config)
@@ -64,6 +125,8 @@ class AuthManager:
 
     def verify_access_key(self, access_key: str) -> bool:
         """验证访问密钥"""
+        if self.login_retry_after(ACCESS_KEY_IDENTITY) > 0:
+            return False
         try:
             config = self._load_config()
 
@@ -75,18 +138,204 @@ class AuthManager:
                 return False
 
             # 验证密码
-            return bcrypt.checkpw(access_key.encode('utf-8'), stored_hash.encode('utf-8'))
+            ok = self._checkpw(access_key, stored_hash)
+            self._record_attempt(ACCESS_KEY_IDENTITY, ok)
+            return ok
         except Exception as e:
             st.error(f"验证密钥失败: {e}")
             return False
 
+    # --- 登录节流 ---
+
+    @staticmethod
+    def _client_address() -> str:
+        """当前请求的客户端地址（无法获取时归为同一组）"""
+        try:
+            return st.context.ip_address or "unknown"
+        except Exception:
+            return "unknown"
+
+    def login_retry_after(self, identity: str) -> float:
+        """返回当前客户端对该标识还需等待多少秒才能再次尝试登录（0 表示可立即尝试）"""
+        with self._lock:
+            _, locked_until, _ = self._failures.get((identity, self._client_address()), (0, 0.0, 0.0))
+        return max(0.0, locked_until - time.time())
+
+    def _record_attempt(self, identity: str, success: bool):
+        """记录一次登录尝试；同一客户端连续失败超过阈值后按指数退避锁定"""
+        key = (identity, self._client_address())
+        now = time.time()
+        with self._lock:
+            if success:
+                self._failures.pop(key, None)
+                return
+            count, _, _ = self._failures.get(key, (0, 0.0, 0.0))
+            count += 1
+            locked_until = 0.0
+            free_attempts = self.settings["max_failed_attempts"]
+            if count >= free_attempts:
+                delay = self.settings["lockout_base_s"] * (2 ** (count - free_attempts))
+                locked_until = now + min(delay, self.settings["lockout_max_s"])
+            self._failures[key] = (count, locked_until, now)
+            self._failures.move_to_end(key)
+            self._prune_failures(now)
+
+    def _prune_failures(self, now: float):
+        """淘汰超过最长锁定时长未再失败的记录（其锁定必已到期），并限制记录总数"""
+        expire_before = now - self.settings["lockout_max_s"]
+        while self._failures:
+            _, (_, _, last_failure) = next(iter(self._failures.items()))
+            if last_failure >= expire_before and len(self._failures) <= LOGIN_FAILURES_MAX:
+                break
+            self._failures.popitem(last=False)
+
+    # --- 会话令牌 ---
+
+    def _credential_fingerprint(self, username: Optional[str]) -> str:
+        """当前凭据的指纹：密钥或密码变更、用户被删除后，已签发的令牌随之失效"""
+        config = self._cached_config()
+        if username:
+            stored = config.get("users", {}).get(username, {}).get("password_hash") or ""
+        else:
+            stored = config.get("auth", {}).get("access_key_hash") or ""
+        if not stored:
+            return ""
+        return hmac.new(self._session_secret, stored.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+    def issue_session_token(self, username: Optional[str] = None, role: Optional[str] = None) -> str:
+        """签发会话令牌：载荷包含用户、角色、过期时间与凭据指纹，以 HMAC-SHA256 签名"""
+        payload = {
+            "u": username,
+            "r": role,
+            "exp": int(time.time() + self.settings["session_ttl_s"]),
+            "cred": self._credential_fingerprint(username),
+        }
+        body = base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode('utf-8')).decode('ascii')
+        sig = hmac.new(self._session_secret, body.encode('ascii'), hashlib.sha256).hexdigest()
+        return f"{body}.{sig}"
+
+    def validate_session_token(self, token: Optional[str]) -> Optional[Dict[str, Any]]:
+        """校验会话令牌（仅内存计算，不读文件、不调用 bcrypt），有效时返回载荷"""
+        if not token or "." not in token:
+            return None
+        body, sig = token.rsplit(".", 1)
+        expected = hmac.new(self._session_secret, body.encode('ascii'), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(sig, expected):
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(body.encode('ascii')))
+        except (ValueError, json.JSONDecodeError):
+            return None
+        if payload.get("exp", 0) < time.time():
+            return None
+        cred = self._credential_fingerprint(payload.get("u"))
+        if not cred or not hmac.compare_digest(payload.get("cred", ""), cred):
+            return None
+        return payload
+
     def is_configured(self) -> bool:
         """检查是否已配置密钥"""
         config = self._load_config()
         return config.get("is_configured", False)
 
-    
-    
+    # --- 多用户账号（服务模式） ---
+
+    def _load_users(self) -> Dict[str, Dict[str, Any]]:
+        return self._load_full_config().get("users", {})
+
+    def has_users(self) -> bool:
+        """检查是否已创建任何用户账号"""
+        return bool(self._load_users())
+
+    def list_users(self) -> List[Dict[str, Any]]:
+        """列出所有用户（不含密码哈希）"""
+        return [self._public_user(name, record) for name, record in sorted(self._load_users().items())]
+
+    @staticmethod
+    def _public_user(username: str, record: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "username": username,
+            "role": record.get("role", "user"),
+            # 0 表示使用服务默认值
+            "max_concurrency": int(record.get("max_concurrency", 0) or 0),
+            "token_quota": record.get("token_quota"),
+        }
+
+    def add_user(self, username: str, password: str, role: str = "user",
+                 max_concurrency: int = 0, token_quota: Optional[int] = None) -> bool:
+        """新增或更新用户账号"""
+        try:
+            key_hash = self._hashpw(password)
+            full_config = copy.deepcopy(self._load_full_config())
+            users = full_config.setdefault("users", {})
+            record = {
+                "password_hash": key_hash.decode('utf-8'),
+                "role": role,
+                "max_concurrency": int(max_concurrency or 0),
+            }
+            if token_quota is not None:
+                record["token_quota"] = int(token_quota)
+            users[username] = record
+            self._save_full_config(full_config)
+            return True
+        except Exception as e:
+            st.error(f"保存用户失败: {e}")
+            return False
+
+    def remove_user(self, username: str) -> bool:
+        """删除用户账号"""
+        full_config = copy.deepcopy(self._load_full_config())
+        users = full_config.get("users", {})
+        if username not in users:
+            return False
+        del users[username]
+        self._save_full_config(full_config)
+        return True
+
+    def verify_user(self, username: str, password: str) -> Optional[Dict[str, Any]]:
+        """验证用户名与密码，成功时返回用户信息"""
+        if self.login_retry_after(username) > 0:
+            return None
+        try:
+            record = self._load_users().get(username)
+            if not record or not record.get("password_hash"):
+                self._record_attempt(username, False)
+                return None
+            ok = self._checkpw(password, record["password_hash"])
+            self._record_attempt(username, ok)
+            return self._public_user(username, record) if ok else None
+        except Exception as e:
+            st.error(f"验证用户失败: {e}")
+            return None
+
+
+_AUTH_MANAGERS: Dict[str, AuthManager] = {}
+_AUTH_MANAGERS_LOCK = threading.Lock()
+
+
+def get_auth_manager(config_file: str = "auth_config.toml") -> AuthManager:
+    """返回进程级共享的 AuthManager：配置只加载一次，之后按文件修改时间失效"""
+    with _AUTH_MANAGERS_LOCK:
+        manager = _AUTH_MANAGERS.get(config_file)
+        if manager is None:
+            manager = AuthManager(config_file)
+            _AUTH_MANAGERS[config_file] = manager
+        return manager
+
+
+def _set_authenticated_user(auth_manager: AuthManager, user: Optional[Dict[str, Any]] = None):
+    st.session_state.authenticated = True
+    st.session_state.auth_token = auth_manager.issue_session_token(
+        user["username"] if user else None, user["role"] if user else None
+    )
+    if user:
+        st.session_state.username = user["username"]
+        st.session_state.user_role = user["role"]
+        st.session_state.user_limits = {
+            "max_concurrency": user.get("max_concurrency") or None,
+            "token_quota": user.get("token_quota"),
+        }
+
 
 def render_auth_setup(auth_manager: AuthManager) -> bool:
     """渲染密钥设置界面"""
@@ -117,7 +366,7 @@ def render_auth_setup(auth_manager: AuthManager) -> bool:
                 st.error("两次输入的密钥不一致")
             else:
                 if auth_manager.set_access_key(access_key):
-                    st.session_state.authenticated = True
+                    _set_authenticated_user(auth_manager)
                     st.success("✅ 密钥设置成功！正在进入应用...")
                     st.rerun()
                 else:
@@ -145,10 +394,13 @@ def render_login_screen(auth_manager: AuthManager) -> bool:
         submitted = st.form_submit_button("🚀 登录", type="primary")
 
         if submitted:
-            if not access_key:
+            retry_after = auth_manager.login_retry_after(ACCESS_KEY_IDENTITY)
+            if retry_after > 0:
+                st.error(f"⏳ 尝试次数过多，请在 {int(retry_after) + 1} 秒后重试")
+            elif not access_key:
                 st.error("请输入访问密钥")
             elif auth_manager.verify_access_key(access_key):
-                st.session_state.authenticated = True
+                _set_authenticated_user(auth_manager)
                 st.success("✅ 验证成功！正在进入...")
                 st.rerun()
             else:
@@ -157,11 +409,102 @@ def render_login_screen(auth_manager: AuthManager) -> bool:
     return False
 
 
-def check_authentication(auth_manager: AuthManager) -> bool:
+def render_admin_setup(auth_manager: AuthManager) -> bool:
+    """渲染服务模式下的首个管理员账号创建界面"""
+    st.title("🔐 创建管理员账号")
+    st.markdown("---")
+    st.info("服务模式已开启，请先创建管理员账号。管理员可以维护 API 配置、用户账号并查看调用队列。")
+
+    with st.form("setup_admin_form"):
+        username = st.text_input("管理员用户名")
+        password = st.text_input("密码", type="password")
+        confirm = st.text_input("确认密码", type="password")
+        submitted = st.form_submit_button("🔒 创建管理员", type="primary")
+
+        if submitted:
+            if not username or not password:
+                st.error("请输入用户名和密码")
+            elif len(password) < 6:
+                st.error("密码长度至少需要6个字符")
+            elif password != confirm:
+                st.error("两次输入的密码不一致")
+            elif auth_manager.add_user(username, password, role="admin"):
+                _set_authenticated_user(auth_manager, auth_manager.verify_user(username, password))
+                st.success("✅ 管理员创建成功！正在进入应用...")
+                st.rerun()
+
+    return False
+
+
+def render_user_login(auth_manager: AuthManager) -> bool:
+    """渲染服务模式下的用户名/密码登录界面"""
+    st.title("🔐 专利撰写助手 - 用户登录")
+    st.markdown("---")
+
+    if not auth_manager.has_users():
+        return render_admin_setup(auth_manager)
+
+    with st.form("user_login_form"):
+        username = st.text_input("用户名")
+        password = st.text_input("密码", type="password")
+        submitted = st.form_submit_button("🚀 登录", type="primary")
+
+        if submitted:
+            retry_after = auth_manager.login_retry_after(username) if username else 0
+            user = auth_manager.verify_user(username, password) if username and password and retry_after <= 0 else None
+            if retry_after > 0:
+                st.error(f"⏳ 尝试次数过多，请在 {int(retry_after) + 1} 秒后重试")
+            elif user:
+                _set_authenticated_user(auth_manager, user)
+                st.success("✅ 验证成功！正在进入...")
+                st.rerun()
+            else:
+                st.error("❌ 用户名或密码错误，请重试")
+
+    return False
+
+
+def render_user_admin(auth_manager: AuthManager):
+    """渲染管理员的用户账号维护界面"""
+    users = auth_manager.list_users()
+    if users:
+        st.dataframe(users, hide_index=True, use_container_width=True)
+
+    with st.form("admin_user_form", clear_on_submit=True):
+        st.markdown("**新增 / 更新用户**")
+        username = st.text_input("用户名")
+        password = st.text_input("密码", type="password")
+        role = st.selectbox("角色", ["user", "admin"])
+        max_concurrency = st.number_input("并发上限（0 为默认）", min_value=0, max_value=64, value=0)
+        token_quota = st.number_input("每日 token 配额（-1 为默认，0 为不限）", min_value=-1, value=-1, step=10000)
+        if st.form_submit_button("💾 保存用户"):
+            if not username or len(password) < 6:
+                st.error("请输入用户名，且密码至少6个字符")
+            elif auth_manager.add_user(username, password, role=role, max_concurrency=int(max_concurrency),
+                                       token_quota=None if token_quota < 0 else int(token_quota)):
+                st.success(f"用户 {username} 已保存。")
+
+    removable = [u["username"] for u in users if u["username"] != st.session_state.get("username")]
+    if removable:
+        col_user, col_btn = st.columns([3, 1])
+        target = col_user.selectbox("删除用户", removable, label_visibility="collapsed")
+        if col_btn.button("🗑️ 删除"):
+            auth_manager.remove_user(target)
+            st.rerun()
+
+
+def check_authentication(auth_manager: AuthManager, server_mode: bool = False) -> bool:
     """检查用户认证状态"""
-    # 检查是否已认证
+    # 检查是否已认证：仅校验内存中的签名令牌，不读配置文件、不调用 bcrypt
     if st.session_state.get("authenticated", False):
-        return True
+        if auth_manager.validate_session_token(st.session_state.get("auth_token")):
+            return True
+        # 令牌过期、凭据变更或进程重启后要求重新登录
+        for k in ("authenticated", "auth_token", "username", "user_role", "user_limits"):
+            st.session_state.pop(k, None)
+
+    if server_mode:
+        return render_user_login(auth_manager)
 
     # 检查认证阶段
     auth_stage = st.session_state.get("auth_stage", "login")
@@ -0,0 +1,409 @@
+"""
+批量生成：把多份草稿中已就绪的工作流步骤合并为一个批量任务提交，轮询完成后将结果写回各草稿状态，
+再按依赖关系逐层提交下一批。适用于对实时性无要求的夜间批量撰写（提供商批量接口价格约为实时调用的一半）。
+
+用法：
+    python batch_runner.py briefs.json [--run-id RUN_ID] [--local] [--poll 30]
+
+briefs.json 为列表，每项 {"id": "...", "structured_brief": {...}} 或 {"id": "...", "user_input": "技术交底..."}。
+生成结果保存在 batch/<run_id>/drafts/<id>.json，可在应用首页导入继续编辑；中断后以相同 run_id 重新运行即可续跑。
+附图（Mermaid 代码与渲染校验）不参与批量生成。
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List, MutableMapping, Optional
+
+import prompts
+from config import UI_SECTION_CONFIG, UI_SECTION_ORDER, WORKFLOW_CONFIG, load_config
+from llm_pool import PRIORITY_BATCH, get_llm_pool
+from state_manager import get_active_content
+from workflows import assemble_ui_section, build_format_args, safe_format_prompt, ensure_version_state
+
+BATCH_DIR = "batch"
+# 轮询提供商批量任务的间隔（秒）
+BATCH_POLL_INTERVAL_S = 30
+# 单个批次的最大请求数（超出时拆分为多个批次）
+BATCH_MAX_REQUESTS = 5000
+# 批量生成的章节（附图需要逐图校验渲染，保留在交互模式中完成）
+BATCH_SECTIONS = [key for key in UI_SECTION_ORDER if key != "drawings"]
+# 由结构化摘要之前的“分析”步骤产生的伪步骤
+ANALYZE_STEP = "structured_brief"
+
+_ID_SEP = "::"
+
+
+def batch_steps() -> List[str]:
+    """批量生成涉及的工作流步骤（按章节顺序去重）。"""
+    steps: List[str] = []
+    for section in BATCH_SECTIONS:
+        for micro_key in UI_SECTION_CONFIG[section]["workflow_keys"]:
+            if micro_key not in steps:
+                steps.append(micro_key)
+    return steps
+
+
+def new_draft_state(item: Dict[str, Any]) -> Dict[str, Any]:
+    """由输入条目构建草稿状态（与会话状态同构，可直接用 import_draft_state 导入）。"""
+    return {
+        "stage": "writing",
+        "user_input": item.get("user_input", ""),
+        "structured_brief": item.get("structured_brief") or {},
+        "data_timestamps": {},
+        "globally_refined_draft": {},
+        "refined_version_available": False,
+        "skip_drawings": True,
+    }
+
+
+# -------------- 本地批量接口替身 --------------
+
+class LocalBatchBackend:
+    """
+    基于文件的批量接口替身，接口与 LLMClient.batch_submit / batch_status / batch_results 一致。
+    提交时写入 <root>/<batch_id>/input.jsonl，后台线程逐条调用 responder 写出 output.jsonl；
+    进程重启后查询未完成的批次会重新开始处理。
+    responder 缺省时返回占位文本，用于在不消耗额度的情况下演练整个批量流程。
+    每条请求以最低的批量优先级占用共享调用池槽位，与应用同进程运行时不会挤占交互调用。
+    """
+
+    def __init__(self, root: str = os.path.join(BATCH_DIR, "local"),
+                 responder: Optional[Callable[[Dict[str, Any]], str]] = None, latency_s: float = 0.0):
+        self.root = root
+        self.responder = responder or self._placeholder_response
+        self.latency_s = latency_s
+        self._workers: Dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _placeholder_response(request: Dict[str, Any]) -> str:
+        if request.get("json_mode"):
+            return "[]"
+        return f"（本地批量替身输出：{request['custom_id']}）"
+
+    def _path(self, batch_id: str, name: str) -> str:
+        return os.path.join(self.root, batch_id, name)
+
+    def _write_status(self, batch_id: str, status: str):
+        tmp = self._path(batch_id, "status.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"status": status, "updated_at": time.time()}, f)
+        os.replace(tmp, self._path(batch_id, "status.json"))
+
+    def batch_submit(self, requests: List[Dict], display_name: str = "patent-batch") -> str:
+        batch_id = f"local-{uuid.uuid4().hex[:12]}"
+        os.makedirs(os.path.join(self.root, batch_id), exist_ok=True)
+        with open(self._path(batch_id, "input.jsonl"), "w", encoding="utf-8") as f:
+            for r in requests:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        self._write_status(batch_id, "pending")
+        self._start(batch_id)
+        return batch_id
+
+    def _start(self, batch_id: str):
+        with self._lock:
+            worker = self._workers.get(batch_id)
+            if worker is not None and worker.is_alive():
+                return
+            worker = threading.Thread(target=self._process, args=(batch_id,), daemon=True, name=f"local-batch-{batch_id}")
+            self._workers[batch_id] = worker
+            worker.start()
+
+    def _process(self, batch_id: str):
+        with open(self._path(batch_id, "input.jsonl"), "r", encoding="utf-8") as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        tmp = self._path(batch_id, "output.jsonl.tmp")
+        with open(tmp, "w", encoding="utf-8") as out:
+            for r in requests:
+                if self.latency_s:
+                    time.sleep(self.latency_s)
+                try:
+                    with get_llm_pool().slot("batch", "batch", PRIORITY_BATCH):
+                        content = self.responder(r)
+                    record = {"custom_id": r["custom_id"], "content": content, "error": None}
+                except Exception as e:
+                    record = {"custom_id": r["custom_id"], "content": None, "error": str(e)}
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp, self._path(batch_id, "output.jsonl"))
+        self._write_status(batch_id, "completed")
+
+    def batch_status(self, batch_id: str) -> str:
+        try:
+            with open(self._path(batch_id, "status.json"), "r", encoding="utf-8") as f:
+                status = json.load(f)["status"]
+        except FileNotFoundError:
+            return "failed"
+        if status == "pending":
+            self._start(batch_id)
+        return status
+
+    def batch_results(self, batch_id: str) -> Dict[str, Dict]:
+        results: Dict[str, Dict] = {}
+        with open(self._path(batch_id, "output.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    results[record["custom_id"]] = {"content": record["content"], "error": record["error"]}
+        return results
+
+
+# -------------- 批量调度 --------------
+
+class BatchRun:
+    """
+    一次批量运行：草稿状态、已提交批次与日志都保存在 batch/<run_id>/ 下，
+    每轮结果写回后立即落盘，中断后以相同 run_id 重新运行会从上次的位置继续。
+    """
+
+    def __init__(self, run_id: str, backend: Any, poll_interval_s: float = BATCH_POLL_INTERVAL_S):
+        self.run_id = run_id
+        self.backend = backend
+        self.poll_interval_s = poll_interval_s
+        self.run_dir = os.path.join(BATCH_DIR, run_id)
+        self.drafts: Dict[str, Dict[str, Any]] = {}
+        # 已失败的步骤：{draft_id: {step: error}}，依赖失败步骤的后续步骤不再提交
+        self.failed: Dict[str, Dict[str, str]] = {}
+        self.pending_batch: Optional[Dict[str, Any]] = None
+        self.layers: List[Dict[str, Any]] = []
+        os.makedirs(os.path.join(self.run_dir, "drafts"), exist_ok=True)
+        self._load()
+
+    # --- 持久化 ---
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.run_dir, "manifest.json")
+
+    def _draft_path(self, draft_id: str) -> str:
+        return os.path.join(self.run_dir, "drafts", f"{draft_id}.json")
+
+    def _load(self):
+        if not os.path.exists(self._manifest_path()):
+            return
+        with open(self._manifest_path(), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.failed = manifest.get("failed", {})
+        self.pending_batch = manifest.get("pending_batch")
+        self.layers = manifest.get("layers", [])
+        for draft_id in manifest.get("draft_ids", []):
+            with open(self._draft_path(draft_id), "r", encoding="utf-8") as f:
+                self.drafts[draft_id] = json.load(f)
+
+    def save(self):
+        for draft_id, state in self.drafts.items():
+            tmp = self._draft_path(draft_id) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp, self._draft_path(draft_id))
+        manifest = {
+            "run_id": self.run_id,
+            "draft_ids": list(self.drafts),
+            "failed": self.failed,
+            "pending_batch": self.pending_batch,
+            "layers": self.layers,
+        }
+        tmp = self._manifest_path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self._manifest_path())
+
+    def log(self, level: str, action: str, message: str, context: Optional[Dict[str, Any]] = None):
+        record = {"ts": datetime.now().isoformat(timespec="seconds"), "level": level, "action": action, "message": message}
+        if context:
+            record["context"] = context
+        with open(os.path.join(self.run_dir, "batch.log"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def add_drafts(self, items: List[Dict[str, Any]]):
+        """加入新草稿；续跑时已存在的草稿保持原状态。"""
+        for item in items:
+            draft_id = str(item["id"])
+            if _ID_SEP in draft_id:
+                raise ValueError(f"草稿ID不能包含 '{_ID_SEP}'：{draft_id}")
+            if draft_id not in self.drafts:
+                self.drafts[draft_id] = new_draft_state(item)
+        self.save()
+
+    # --- 就绪步骤 ---
+
+    def _is_done(self, state: MutableMapping[str, Any], step: str) -> bool:
+        if step == ANALYZE_STEP:
+            return bool(state.get("structured_brief"))
+        return bool(state.get(f"{step}_versions"))
+
+    def _ready_steps(self, draft_id: str) -> List[str]:
+        state = self.drafts[draft_id]
+        failed = self.failed.get(draft_id, {})
+        if not self._is_done(state, ANALYZE_STEP):
+            return [] if ANALYZE_STEP in failed or not state.get("user_input") else [ANALYZE_STEP]
+        ready = []
+        for step in batch_steps():
+            if self._is_done(state, step) or step in failed:
+                continue
+            deps = [d for d in WORKFLOW_CONFIG[step]["dependencies"] if d in WORKFLOW_CONFIG]
+            if all(self._is_done(state, d) for d in deps):
+                ready.append(step)
+        return ready
+
+    def _requests_for(self, draft_id: str, step: str) -> List[Dict[str, Any]]:
+        state = self.drafts[draft_id]
+        if step == ANALYZE_STEP:
+            prompt = safe_format_prompt(prompts.PROMPT_ANALYZE, user_input=state["user_input"])
+            return [{"custom_id": _ID_SEP.join([draft_id, step]), "messages": [{"role": "user", "content": prompt}], "json_mode": True}]
+        step_config = WORKFLOW_CONFIG[step]
+        if step == "implementation_details":
+            # 逐个技术要点生成实施例，每个要点一条请求
+            points = get_active_content("solution_points", state) or []
+            return [
+                {
+                    "custom_id": _ID_SEP.join([draft_id, step, str(i)]),
+                    "messages": [{"role": "user", "content": safe_format_prompt(step_config["prompt"], point=point)}],
+                    "json_mode": False,
+                }
+                for i, point in enumerate(points)
+            ]
+        format_args = build_format_args(step_config["dependencies"], state=state)
+        prompt = safe_format_prompt(step_config["prompt"], **format_args)
+        return [{"custom_id": _ID_SEP.join([draft_id, step]), "messages": [{"role": "user", "content": prompt}], "json_mode": step_config["json_mode"]}]
+
+    # --- 结果写回 ---
+
+    def _save_version(self, state: MutableMapping[str, Any], step: str, value: Any):
+        ensure_version_state(step, state)
+        state[f"{step}_versions"].append(value)
+        state[f"{step}_active_index"] = len(state[f"{step}_versions"]) - 1
+        state["data_timestamps"][step] = time.time()
+
+    def _apply_results(self, requests: List[Dict[str, Any]], results: Dict[str, Dict]):
+        grouped: Dict[tuple, List[tuple]] = {}
+        for r in requests:
+            parts = r["custom_id"].split(_ID_SEP)
+            index = int(parts[2]) if len(parts) > 2 else 0
+            grouped.setdefault((parts[0], parts[1]), []).append((index, r))
+
+        for (draft_id, step), items in grouped.items():
+            state = self.drafts[draft_id]
+            values, error = [], None
+            for index, r in sorted(items, key=lambda x: x[0]):
+                result = results.get(r["custom_id"]) or {"content": None, "error": "批量结果中缺少该请求"}
+                if result["error"] or result["content"] is None:
+                    error = result["error"] or "空响应"
+                    break
+                content = result["content"].strip()
+                if r["json_mode"]:
+                    try:
+                        content = json.loads(content)
+                    except json.JSONDecodeError as e:
+                        error = f"JSON解析失败：{e}"
+                        break
+                values.append(content)
+            if error is None and step == ANALYZE_STEP and not (isinstance(values[0], dict) and values[0]):
+                # 分析结果为空或不是对象时记为失败，否则该草稿的分析步骤会被反复提交
+                error = f"分析结果为空或格式不符：{json.dumps(values[0], ensure_ascii=False)[:200]}"
+            if error is not None:
+                self.failed.setdefault(draft_id, {})[step] = error
+                self.log("ERROR", "batch:step_failed", "批量步骤失败", {"draft_id": draft_id, "step": step, "error": error})
+                continue
+            if step == ANALYZE_STEP:
+                state["structured_brief"] = values[0]
+                state["data_timestamps"]["structured_brief"] = time.time()
+            elif step == "implementation_details":
+                self._save_version(state, step, values)
+            else:
+                self._save_version(state, step, values[0])
+            self.log("INFO", "batch:step_done", "批量步骤结果已写回", {"draft_id": draft_id, "step": step})
+
+    # --- 主循环 ---
+
+    def _wait(self, batch_id: str) -> str:
+        while True:
+            status = self.backend.batch_status(batch_id)
+            if status != "pending":
+                return status
+            time.sleep(self.poll_interval_s)
+
+    def _run_pending_batch(self):
+        pending = self.pending_batch
+        status = self._wait(pending["batch_id"])
+        requests = pending["requests"]
+        if status == "completed":
+            self._apply_results(requests, self.backend.batch_results(pending["batch_id"]))
+        else:
+            for r in requests:
+                draft_id, step = r["custom_id"].split(_ID_SEP)[:2]
+                self.failed.setdefault(draft_id, {})[step] = f"批次 {pending['batch_id']} 状态：{status}"
+            self.log("ERROR", "batch:batch_failed", "批次失败", {"batch_id": pending["batch_id"], "status": status})
+        self.layers.append({"batch_id": pending["batch_id"], "requests": len(requests), "status": status,
+                            "finished_at": datetime.now().isoformat(timespec="seconds")})
+        self.pending_batch = None
+        self.save()
+
+    def run(self) -> Dict[str, Any]:
+        """逐层提交就绪步骤直至没有可执行的步骤，然后组装各草稿的章节。"""
+        if self.pending_batch is not None:
+            self.log("INFO", "batch:resume", "续跑未完成的批次", {"batch_id": self.pending_batch["batch_id"]})
+            self._run_pending_batch()
+
+        while True:
+            requests: List[Dict[str, Any]] = []
+            for draft_id in self.drafts:
+                for step in self._ready_steps(draft_id):
+                    requests.extend(self._requests_for(draft_id, step))
+            if not requests:
+                break
+            for start in range(0, len(requests), BATCH_MAX_REQUESTS):
+                chunk = requests[start:start + BATCH_MAX_REQUESTS]
+                batch_id = self.backend.batch_submit(chunk, display_name=f"{self.run_id}-{len(self.layers) + 1}")
+                self.pending_batch = {"batch_id": batch_id, "requests": chunk}
+                self.save()
+                self.log("INFO", "batch:submitted", "已提交批次", {"batch_id": batch_id, "requests": len(chunk)})
+                self._run_pending_batch()
+
+        return self.assemble()
+
+    def assemble(self) -> Dict[str, Any]:
+        """组装每份草稿中微观组件齐全、尚未组装的章节（不调用模型）。"""
+        summary: Dict[str, Any] = {}
+        for draft_id, state in self.drafts.items():
+            assembled = []
+            for section in BATCH_SECTIONS:
+                if state.get(f"{section}_versions"):
+                    continue
+                if all(self._is_done(state, k) for k in UI_SECTION_CONFIG[section]["workflow_keys"]):
+                    log = lambda level, action, message, context=None, _id=draft_id: self.log(level, action, message, {"draft_id": _id, **(context or {})})
+                    if assemble_ui_section(section, state=state, log=log):
+                        assembled.append(section)
+            summary[draft_id] = {"assembled": assembled, "failed": self.failed.get(draft_id, {})}
+        self.save()
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="通过提供商批量接口批量生成专利草稿")
+    parser.add_argument("briefs", help="输入 JSON 文件：[{\"id\": ..., \"structured_brief\": {...}} 或 {\"id\": ..., \"user_input\": ...}]")
+    parser.add_argument("--run-id", default=None, help="运行ID；与之前的运行相同则续跑")
+    parser.add_argument("--local", action="store_true", help="使用本地文件替身代替提供商批量接口（不消耗额度）")
+    parser.add_argument("--poll", type=float, default=BATCH_POLL_INTERVAL_S, help="轮询间隔（秒）")
+    args = parser.parse_args()
+
+    if args.local:
+        backend = LocalBatchBackend()
+    else:
+        from llm_client import LLMClient
+        backend = LLMClient(load_config())
+        if not backend.supports_batch():
+            raise SystemExit(f"提供商 {backend.provider} 不支持批量接口，可使用 --local 演练流程。")
+
+    with open(args.briefs, "r", encoding="utf-8") as f:
+        items = json.load(f)
+    run = BatchRun(args.run_id or datetime.now().strftime("%Y%m%d_%H%M%S"), backend, poll_interval_s=args.poll)
+    run.add_drafts(items)
+    summary = run.run()
+    print(json.dumps({"run_id": run.run_id, "drafts": summary}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
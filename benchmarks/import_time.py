@@ -0,0 +1,132 @@
+"""
+应用冷启动导入耗时基准（基于 python -X importtime）。
+
+用法（在仓库根目录执行）：
+    python benchmarks/import_time.py                  # 检查各入口模块是否超出启动预算
+    python benchmarks/import_time.py --write-profile  # 同时刷新 benchmarks/import_profile.txt
+
+每个模块在全新子进程中导入，重复若干次取中位数；任一模块超出预算，
+或在导入阶段加载了应当按需导入的提供商 SDK，脚本以非零状态退出。
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILE_PATH = os.path.join(REPO_ROOT, "benchmarks", "import_profile.txt")
+
+# 各入口模块的冷启动导入预算（毫秒，已扣除解释器自身启动耗时，含模块的全部依赖）
+STARTUP_BUDGET_MS = {
+    "config": 60,
+    "llm_client": 20,
+    "workflows": 800,
+    "main": 900,
+}
+
+# 这些提供商 SDK 只应在所选提供商首次构建客户端时导入
+LAZY_MODULES = ["openai", "httpx", "google.genai", "langchain", "langchain_openai"]
+
+REPEATS = 5
+TOP_N = 20
+
+
+def _run_importtime(module: str) -> Tuple[float, List[Tuple[int, str]], List[str]]:
+    """在子进程中导入模块，返回 (总耗时ms, [(累计us, 模块名)], 已加载的按需模块)。"""
+    import_stmt = f"import {module}; " if module else ""
+    probe = (
+        f"import sys; {import_stmt}"
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", probe],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{proc.stderr[-2000:]}")
+
+    entries: List[Tuple[int, str]] = []
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        cumulative = int(cumulative_us.strip())
+        # 名称前的缩进表示嵌套层级：顶层导入前仅有一个空格
+        name = name[1:].rstrip()
+        entries.append((cumulative, name.strip()))
+        # 顶层导入的累计耗时之和即为总导入耗时
+        if not name.startswith(" "):
+            total_us += cumulative
+    loaded_lazy = [m for m in proc.stdout.strip().split(",") if m]
+    return total_us / 1000.0, entries, loaded_lazy
+
+
+def measure_baseline(repeats: int = REPEATS) -> float:
+    """解释器自身启动（site 等）的导入耗时，从各模块的测量值中扣除。"""
+    return statistics.median(_run_importtime("")[0] for _ in range(repeats))
+
+
+def measure(module: str, baseline_ms: float, repeats: int = REPEATS) -> Dict[str, object]:
+    totals = []
+    entries: List[Tuple[int, str]] = []
+    loaded_lazy: List[str] = []
+    for _ in range(repeats):
+        total_ms, entries, loaded_lazy = _run_importtime(module)
+        totals.append(max(0.0, total_ms - baseline_ms))
+    return {
+        "module": module,
+        "median_ms": statistics.median(totals),
+        "min_ms": min(totals),
+        "budget_ms": STARTUP_BUDGET_MS[module],
+        "loaded_lazy": loaded_lazy,
+        "top": sorted(entries, reverse=True)[:TOP_N],
+    }
+
+
+def format_profile(results: List[Dict[str, object]], baseline_ms: float) -> str:
+    lines = [
+        f"# python {sys.version.split()[0]}, {REPEATS} runs per module, cumulative import time",
+        f"# interpreter baseline {baseline_ms:.1f} ms (subtracted from module totals)",
+        "",
+    ]
+    for r in results:
+        lines.append(f"## {r['module']}: median {r['median_ms']:.1f} ms (min {r['min_ms']:.1f} ms, budget {r['budget_ms']} ms)")
+        lines.append(f"lazy SDKs loaded at import: {', '.join(r['loaded_lazy']) or 'none'}")
+        for cumulative_us, name in r["top"]:
+            lines.append(f"{cumulative_us / 1000.0:10.1f} ms  {name}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--write-profile", action="store_true", help="将导入耗时明细写入 benchmarks/import_profile.txt")
+    parser.add_argument("modules", nargs="*", default=list(STARTUP_BUDGET_MS), help="要测量的入口模块")
+    args = parser.parse_args()
+
+    baseline_ms = measure_baseline()
+    results = [measure(m, baseline_ms) for m in args.modules]
+    failed = False
+    for r in results:
+        over = r["median_ms"] > r["budget_ms"]
+        failed = failed or over or bool(r["loaded_lazy"])
+        status = "OVER BUDGET" if over else "ok"
+        print(f"{r['module']:<12} {r['median_ms']:8.1f} ms / {r['budget_ms']} ms  {status}")
+        if r["loaded_lazy"]:
+            print(f"{'':<12} eagerly imported: {', '.join(r['loaded_lazy'])}")
+
+    if args.write_profile:
+        with open(PROFILE_PATH, "w", encoding="utf-8") as f:
+            f.write(format_profile(results, baseline_ms))
+        print(f"profile written to {os.path.relpath(PROFILE_PATH, REPO_ROOT)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
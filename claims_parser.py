@@ -0,0 +1,216 @@
+import re
+from typing import Any, Dict, List, Optional, Set
+
+from derived_views import DERIVED_VIEWS, content_fingerprint
+
+# 每条权利要求以行首编号开始：“1.”“1、”“1．”
+_CLAIM_START_RE = re.compile(r"^[ \t]*(\d+)[ \t]*[.、．][ \t]*", re.MULTILINE)
+# 引用部分：“根据权利要求1所述的”“如权利要求1或2所述”“根据权利要求1至3中任一项所述的”
+_REF_RE = re.compile(
+    r"(?:根据|如|按照|依据)?权利要求\s*((?:\d+\s*(?:[-~～至到、,，或和及]\s*)?)+)"
+    r"(?:中任一项|中任意一项|中的任一项|中任一|任一项|任意一项)?(?:所述|的)"
+)
+_REF_RANGE_TOKENS = ("-", "~", "～", "至", "到")
+# 前序部分：首个逗号/冒号之前的内容
+_PREAMBLE_END_RE = re.compile(r"[，,：:；;]")
+# “所述X”“该X”形式的在先引用（“应该”中的“该”不算）
+_ANTECEDENT_RE = re.compile(r"(?<!应)(?:所述|该)的?([一-鿿A-Za-z0-9]{2,16})")
+# 术语以常见名词后缀结束：取到第一个后缀为止（“所述采集模块用于” -> “采集模块”）
+_TERM_SUFFIXES = ("子系统", "模块", "单元", "装置", "组件", "部件", "机构", "电路", "系统", "设备",
+                  "方法", "步骤", "数据", "信号", "信息", "参数", "模型", "结构", "器", "部", "件", "层", "端")
+_TERM_RE = re.compile(r"^.{0,14}?(?:" + "|".join(_TERM_SUFFIXES) + ")")
+
+
+class Claim:
+    """一条权利要求：编号、正文（不含编号）、在全文中的位置与所引用的在先权利要求。"""
+
+    def __init__(self, number: int, text: str, start: int, end: int, body_start: int):
+        self.number = number
+        self.text = text
+        self.start = start
+        self.end = end
+        self.body_start = body_start
+        preamble_end = _PREAMBLE_END_RE.search(text)
+        self.preamble = text[: preamble_end.start()] if preamble_end else text
+        self.ref_spans = [(m.start(), m.end()) for m in _REF_RE.finditer(text)]
+        self.refs: List[int] = []
+        for m in _REF_RE.finditer(self.preamble):
+            self.refs.extend(n for n in _parse_ref_numbers(m.group(1)) if n not in self.refs)
+
+    @property
+    def independent(self) -> bool:
+        return not self.refs
+
+    @property
+    def multiple_dependent(self) -> bool:
+        return len(self.refs) > 1
+
+
+def _parse_ref_numbers(group: str) -> List[int]:
+    """解析引用编号：支持“1或2”“1、3”“1至3”“1-3”等写法。"""
+    numbers: List[int] = []
+    pending_range = False
+    for token in re.findall(r"\d+|[-~～至到]", group):
+        if token in _REF_RANGE_TOKENS:
+            pending_range = bool(numbers)
+            continue
+        n = int(token)
+        if pending_range and numbers and n > numbers[-1]:
+            numbers.extend(range(numbers[-1] + 1, n + 1))
+        else:
+            numbers.append(n)
+        pending_range = False
+    return numbers
+
+
+class ClaimTree:
+    """权利要求书的结构：按出现顺序的权利要求列表、编号索引与依赖关系。"""
+
+    def __init__(self, text: str, claims: List[Claim]):
+        self.text = text
+        self.claims = claims
+        self.by_number: Dict[int, Claim] = {}
+        for claim in claims:
+            self.by_number.setdefault(claim.number, claim)
+
+    def children(self, number: int) -> List[Claim]:
+        return [c for c in self.claims if number in c.refs]
+
+    def roots(self) -> List[Claim]:
+        return [c for c in self.claims if c.independent]
+
+    def ancestors(self, number: int) -> List[Claim]:
+        """沿引用关系向上可达的全部在先权利要求（只沿合法的在先引用）。"""
+        seen: Set[int] = set()
+        result: List[Claim] = []
+        stack = [number]
+        while stack:
+            claim = self.by_number.get(stack.pop())
+            if claim is None:
+                continue
+            for ref in claim.refs:
+                if ref < claim.number and ref not in seen and ref in self.by_number:
+                    seen.add(ref)
+                    result.append(self.by_number[ref])
+                    stack.append(ref)
+        return sorted(result, key=lambda c: c.number)
+
+    def descendants(self, number: int) -> List[Claim]:
+        return [c for c in self.claims if any(a.number == number for a in self.ancestors(c.number))]
+
+    def claim_number_at(self, position: int) -> Optional[int]:
+        """全文中某一位置所在的权利要求编号。"""
+        for claim in self.claims:
+            if claim.start <= position < claim.end:
+                return claim.number
+        return None
+
+
+def parse_claims(text: str) -> ClaimTree:
+    """按行首编号切分权利要求书并解析引用关系（不调用模型）。"""
+    text = text or ""
+    starts = list(_CLAIM_START_RE.finditer(text))
+    claims = []
+    for i, m in enumerate(starts):
+        end = starts[i + 1].start() if i + 1 < len(starts) else len(text)
+        claims.append(Claim(int(m.group(1)), text[m.end():end].strip(), m.start(), end, m.end()))
+    return ClaimTree(text, claims)
+
+
+def cached_claim_tree(text: str) -> ClaimTree:
+    """按全文指纹缓存的解析结果：界面多处展示与校验共用一次解析。"""
+    return DERIVED_VIEWS.get("claims_tree", text or "", parse_claims)
+
+
+def _structure_issues(tree: ClaimTree) -> List[Dict[str, Any]]:
+    issues = []
+    seen: Set[int] = set()
+    previous = 0
+    for claim in tree.claims:
+        if claim.number in seen:
+            issues.append({"claim_no": claim.number, "kind": "numbering", "message": f"编号 {claim.number} 重复"})
+        elif claim.number != previous + 1:
+            issues.append({"claim_no": claim.number, "kind": "numbering",
+                           "message": f"编号不连续：此处应为 {previous + 1}"})
+        seen.add(claim.number)
+        previous = claim.number
+        if not claim.text:
+            issues.append({"claim_no": claim.number, "kind": "numbering", "message": "权利要求内容为空"})
+        for ref in claim.refs:
+            if ref not in tree.by_number:
+                issues.append({"claim_no": claim.number, "kind": "reference",
+                               "message": f"引用的权利要求 {ref} 不存在"})
+            elif ref >= claim.number:
+                issues.append({"claim_no": claim.number, "kind": "reference",
+                               "message": f"只能引用在前的权利要求，不能引用权利要求 {ref}"})
+            elif claim.multiple_dependent and tree.by_number[ref].multiple_dependent:
+                issues.append({"claim_no": claim.number, "kind": "reference",
+                               "message": f"多项从属权利要求不得作为另一项多项从属权利要求（权利要求 {ref}）的基础"})
+    return issues
+
+
+def _antecedent_issues(claim: Claim, basis: str) -> List[Dict[str, Any]]:
+    """
+    检查“所述X/该X”是否有在先出现：X 须出现在本权利要求此前的文字或其引用的在先权利要求中。
+    能识别出名词后缀时要求完整术语出现；否则至少要求前两个字出现。
+    """
+    issues = []
+    reported: Set[str] = set()
+    for m in _ANTECEDENT_RE.finditer(claim.text):
+        if any(start <= m.start() < end for start, end in claim.ref_spans):
+            continue
+        window = m.group(1)
+        context = basis + "\n" + claim.text[: m.start()]
+        matched = 0
+        for length in range(len(window), 1, -1):
+            if window[:length] in context:
+                matched = length
+                break
+        term_match = _TERM_RE.match(window)
+        term = term_match.group(0) if term_match and len(term_match.group(0)) >= 2 else None
+        if (matched >= len(term)) if term else matched >= 2:
+            continue
+        term = term or window[:4]
+        if term in reported:
+            continue
+        reported.add(term)
+        issues.append({"claim_no": claim.number, "kind": "antecedent",
+                       "message": f"“{m.group(0)[: m.start(1) - m.start()]}{term}”缺少引用基础（此前未引入“{term}”）", "term": term})
+    return issues
+
+
+def validate_claim(tree: ClaimTree, number: int) -> List[Dict[str, Any]]:
+    """
+    校验单条权利要求的引用基础。结果按 (本条正文, 在先权利要求正文) 缓存：
+    编辑某一条后，只有它自己及引用它的权利要求需要重新校验。
+    """
+    claim = tree.by_number[number]
+    basis = "\n".join(a.text for a in tree.ancestors(number))
+    key = (content_fingerprint(claim.text), content_fingerprint(basis), claim.number)
+    return DERIVED_VIEWS.get_by_key("claim_antecedents", key, lambda: _antecedent_issues(claim, basis))
+
+
+def validate_claims(text: str) -> Dict[str, Any]:
+    """权利要求书的结构与引用基础校验：{"tree": ClaimTree, "issues": [...]}。"""
+    tree = cached_claim_tree(text)
+    issues = _structure_issues(tree)
+    for number in tree.by_number:
+        issues.extend(validate_claim(tree, number))
+    issues.sort(key=lambda item: item["claim_no"])
+    return {"tree": tree, "issues": issues}
+
+
+def strip_claim_number(text: str) -> str:
+    """去掉模型输出中可能带上的行首编号。"""
+    return _CLAIM_START_RE.sub("", (text or "").strip(), count=1).strip()
+
+
+def replace_claim(text: str, number: int, new_text: str) -> str:
+    """用 new_text 替换第 number 条权利要求的正文，保留编号与其余权利要求原样。"""
+    tree = parse_claims(text)
+    claim = tree.by_number.get(number)
+    if claim is None:
+        raise KeyError(f"权利要求 {number} 不存在")
+    tail = text[claim.body_start:claim.end]
+    trailing = tail[len(tail.rstrip()):]
+    return text[:claim.body_start] + strip_claim_number(new_text) + trailing + text[claim.end:]
@@ -3,15 +3,25 @@ from pathlib import Path
 from dotenv import find_dotenv, set_key, load_dotenv
 import prompts
 
-# 加载 .env 文件中的环境变量
-env_file = find_dotenv()
-if not env_file:
-    env_file = Path(".env")
-    env_file.touch()
-load_dotenv(env_file)
+# .env 文件路径：首次读取或保存配置时才查找并加载，避免模块导入时触发文件系统扫描
+env_file = None
+
+def _ensure_env_loaded():
+    """查找并加载 .env 文件中的环境变量（每个进程只执行一次）。"""
+    global env_file
+    if env_file is not None:
+        return env_file
+    found = find_dotenv()
+    if not found:
+        found = Path(".env")
+        found.touch()
+    load_dotenv(found)
+    env_file = found
+    return env_file
 
 def load_config() -> dict:
     """加载配置，支持 openai兼容格式 / google 分节嵌套结构。"""
+    _ensure_env_loaded()
     return {
         "provider": os.getenv("PROVIDER", "openai"),
         "azure": {
@@ -34,8 +44,78 @@ def load_config() -> dict:
         },
     }
 
+def load_server_config() -> dict:
+    """加载多用户服务模式配置（仅从环境变量读取，不在侧边栏中编辑）。"""
+    _ensure_env_loaded()
+    return {
+        # 开启后按用户账号登录，API 配置由管理员统一维护
+        "server_mode": os.getenv("SERVER_MODE", "").lower() in ("1", "true", "yes"),
+        # 全进程共享的 LLM 并发调用上限
+        "llm_pool_size": max(1, int(os.getenv("LLM_POOL_SIZE", "8"))),
+        # 单个用户默认的并发调用上限
+        "user_max_concurrency": max(1, int(os.getenv("USER_MAX_CONCURRENCY", "2"))),
+        # 单个用户默认的每日 token 配额，0 表示不限
+        "user_token_quota": max(0, int(os.getenv("USER_TOKEN_QUOTA", "0"))),
+        # 为交互式单章节调用保留的并发槽位（整稿、后台与批量任务不可占用）
+        "interactive_reserved_slots": max(0, int(os.getenv("INTERACTIVE_RESERVED_SLOTS", "1"))),
+        # 后台任务时限（秒，0 为不限）：一键生成初稿、全局润色等整稿任务，以及单章节生成与预生成
+        "job_deadline_s": max(0, int(os.getenv("JOB_DEADLINE_S", "1800"))),
+        "section_deadline_s": max(0, int(os.getenv("SECTION_DEADLINE_S", "300"))),
+        # 本地现有技术检索索引目录（为空或未构建时不检索）、注入背景技术的篇数与可选的向量模型
+        "prior_art_index_dir": os.getenv("PRIOR_ART_INDEX_DIR", "prior_art_index"),
+        "prior_art_top_k": max(1, int(os.getenv("PRIOR_ART_TOP_K", "5"))),
+        "prior_art_embed_model": os.getenv("PRIOR_ART_EMBED_MODEL", ""),
+        # 交底材料超过该字数时分块并行提炼再合并；并行提炼的分块数
+        "analyze_chunk_chars": max(1000, int(os.getenv("ANALYZE_CHUNK_CHARS", "8000"))),
+        "analyze_map_workers": max(1, int(os.getenv("ANALYZE_MAP_WORKERS", "4"))),
+        # 上传文档（PDF/DOCX）文本提取的进程数
+        "ingest_workers": max(1, int(os.getenv("INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))),
+        # 按端点自适应调整在途请求上限（AIMD）：初始值与上限；关闭后只受调用池并发限制
+        "adaptive_concurrency": os.getenv("ADAPTIVE_CONCURRENCY", "1").lower() in ("1", "true", "yes"),
+        "endpoint_initial_concurrency": max(1, int(os.getenv("ENDPOINT_INITIAL_CONCURRENCY", "4"))),
+        "endpoint_max_concurrency": max(1, int(os.getenv("ENDPOINT_MAX_CONCURRENCY", os.getenv("LLM_POOL_SIZE", "8")))),
+        # 输出达到长度上限被截断时的最多续写次数（0 为不续写）
+        "llm_max_continuations": max(0, int(os.getenv("LLM_MAX_CONTINUATIONS", "2"))),
+        # 失控检测：中文正文步骤改为流式生成，出现大段重复、偏离中文或超过字符上限时提前中止并重试
+        "generation_guard": os.getenv("GENERATION_GUARD", "1").lower() in ("1", "true", "yes"),
+        "guard_max_chars": max(0, int(os.getenv("GUARD_MAX_CHARS", "30000"))),
+        "guard_max_retries": max(0, int(os.getenv("GUARD_MAX_RETRIES", "1"))),
+        # 请求对冲（默认关闭）：调用耗时超过该步骤历史耗时的 HEDGE_QUANTILE 分位数仍未返回时再发一次，
+        # 额外调用不超过普通调用的 HEDGE_BUDGET_RATIO；可指定备用提供商/模型
+        "hedge_enabled": os.getenv("HEDGE_ENABLED", "").lower() in ("1", "true", "yes"),
+        "hedge_quantile": min(0.99, max(0.5, float(os.getenv("HEDGE_QUANTILE", "0.95")))),
+        "hedge_budget_ratio": min(1.0, max(0.0, float(os.getenv("HEDGE_BUDGET_RATIO", "0.05")))),
+        "hedge_min_delay_s": max(0.0, float(os.getenv("HEDGE_MIN_DELAY_S", "5"))),
+        "hedge_provider": os.getenv("HEDGE_PROVIDER", ""),
+        "hedge_model": os.getenv("HEDGE_MODEL", ""),
+        # 每份草稿默认的 token 预算（0 为不限）：一键生成与全局润色前预估超出时不允许启动，用尽后停止后续调用
+        "draft_token_budget": max(0, int(os.getenv("DRAFT_TOKEN_BUDGET", "0"))),
+        # 模型单价（每百万 token，输入/输出），用于预估费用；为 0 时只显示 token 数
+        "price_input_per_mtok": max(0.0, float(os.getenv("LLM_PRICE_INPUT_PER_MTOK", "0"))),
+        "price_output_per_mtok": max(0.0, float(os.getenv("LLM_PRICE_OUTPUT_PER_MTOK", "0"))),
+        "price_currency": os.getenv("LLM_PRICE_CURRENCY", "USD"),
+        # 每个会话预生成（投机生成）可消耗的 token 上限（估算值）
+        "speculation_token_budget": max(0, int(os.getenv("SPECULATION_TOKEN_BUDGET", "60000"))),
+    }
+
+def load_auth_settings() -> dict:
+    """加载认证相关参数（bcrypt 成本、会话有效期与登录节流）。"""
+    _ensure_env_loaded()
+    return {
+        # bcrypt 成本因子（4-31），每加 1 校验耗时翻倍
+        "bcrypt_rounds": min(31, max(4, int(os.getenv("AUTH_BCRYPT_ROUNDS", "12")))),
+        # 会话令牌有效期（秒）
+        "session_ttl_s": int(os.getenv("AUTH_SESSION_TTL_S", str(12 * 3600))),
+        # 同一客户端对同一账号连续失败多少次后开始锁定
+        "max_failed_attempts": max(1, int(os.getenv("AUTH_MAX_FAILED_ATTEMPTS", "5"))),
+        # 首次锁定时长（秒），此后每次失败翻倍，直至上限
+        "lockout_base_s": float(os.getenv("AUTH_LOCKOUT_BASE_S", "30")),
+        "lockout_max_s": float(os.getenv("AUTH_LOCKOUT_MAX_S", "900")),
+    }
+
 def save_config(cfg: dict):
     """将配置保存到 .env 文件。"""
+    env_file = _ensure_env_loaded()
     set_key(env_file, "PROVIDER", cfg.get("provider", "openai"))
     if "azure" in cfg:
         set_key(env_file, "AZURE_OPENAI_API_KEY", cfg["azure"].get("api_key", ""))
@@ -103,6 +183,8 @@ UI_SECTION_CONFIG = {
     },
 }
 
+# 各步骤：prompt、json_mode、dependencies；可选 max_tokens 为单次调用的输出上限（缺省使用提供商默认值），
+# 达到上限被截断的输出由 call_llm 自动续写拼接；可选 max_chars 为失控检测的字符上限（缺省 GUARD_MAX_CHARS）
 WORKFLOW_CONFIG = {
     # 发明名称
     "title_options": {
@@ -116,18 +198,19 @@ WORKFLOW_CONFIG = {
         "prompt": prompts.PROMPT_TECH_FIELD,
         "json_mode": False,
         "dependencies": ["core_inventive_concept", "technical_solution_summary"],
+        "max_chars": 1500,
     },
 
     # 背景技术
     "background_problem": {
         "prompt": prompts.PROMPT_BACKGROUND_PROBLEM,
         "json_mode": False,
-        "dependencies": ["problem_statement"],
+        "dependencies": ["problem_statement", "prior_art"],
     },
     "background_context": {
         "prompt": prompts.PROMPT_BACKGROUND_CONTEXT,
         "json_mode": False,
-        "dependencies": ["background_technology", "background_problem"],
+        "dependencies": ["background_technology", "background_problem", "prior_art"],
     },
 
     # 发明内容
@@ -145,6 +228,7 @@ WORKFLOW_CONFIG = {
         "prompt": prompts.PROMPT_INVENTION_SOLUTION_DETAIL,
         "json_mode": False,
         "dependencies": ["core_inventive_concept", "technical_solution_summary", "key_components_or_steps"],
+        "max_tokens": 8192,
     },
     "invention_effects": {
         "prompt": prompts.PROMPT_INVENTION_EFFECTS,
@@ -180,6 +264,7 @@ WORKFLOW_CONFIG = {
         "prompt": prompts.PROMPT_IMPLEMENTATION_POINT,
         "json_mode": False,
         "dependencies": ["solution_points"],
+        "max_tokens": 4096,
     },
 
     # 权利要求书
@@ -187,8 +272,14 @@ WORKFLOW_CONFIG = {
         "prompt": prompts.PROMPT_CLAIMS,
         "json_mode": False,
         "dependencies": ["core_inventive_concept", "technical_solution_summary", "key_components_or_steps", "solution_points"],
+        "max_tokens": 4096,
+    },
+    # 可选的校验与单项重写工作流（不作为章节直接展示）
+    "claim_regenerate": {
+        "prompt": prompts.PROMPT_CLAIM_REGENERATE,
+        "json_mode": False,
+        "dependencies": ["key_components_or_steps", "solution_points"],
     },
-    # 可选的校验工作流（不作为章节直接展示）
     "claims_check": {
         "prompt": prompts.PROMPT_CLAIMS_CHECK,
         "json_mode": True,
@@ -200,6 +291,7 @@ WORKFLOW_CONFIG = {
         "prompt": prompts.PROMPT_ABSTRACT,
         "json_mode": False,
         "dependencies": ["problem_statement", "solution_points", "achieved_effects"],
+        "max_chars": 1500,
     },
 
     # 全局重构与润色（用于预览阶段的总编，不直接归属某章节生成）
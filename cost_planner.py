@@ -0,0 +1,266 @@
+import functools
+import glob
+import json
+import os
+import re
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import streamlit as st
+
+import prompts
+from config import UI_SECTION_CONFIG, UI_SECTION_ORDER, WORKFLOW_CONFIG, load_server_config
+from derived_views import DERIVED_VIEWS, content_fingerprint
+from draft_document import get_draft_document
+from llm_client import LLMClient
+from llm_pool import estimate_tokens
+from state_manager import get_active_content
+from workflows import (LOG_DIR, REFINE_ORIGINAL_PROMPTS, REFINE_SKIP_KEYS, SKIP_DRAWINGS_DEFAULT, build_format_args,
+                       safe_format_prompt)
+
+# 没有历史记录时的输出 token 与耗时估计
+DEFAULT_OUTPUT_TOKENS = 800
+DEFAULT_OUTPUT_TOKENS_PER_S = 40.0
+DEFAULT_CALL_LATENCY_S = 2.0
+# 未生成技术要点/附图构思时按此数量估计逐点与逐图调用
+DEFAULT_SOLUTION_POINTS = 5
+DEFAULT_DRAWINGS = 3
+# 参与统计的最近日志文件数
+HISTORY_MAX_FILES = 50
+
+# 续写与失控重试的调用计入原步骤
+_RETRY_SUFFIX_RE = re.compile(r"(?::(?:continue|retry)\d+)+$")
+_TAG_STEP_PATTERNS = (
+    (re.compile(r"^implementation_detail_\d+$"), "implementation_details"),
+    (re.compile(r"^drawings_code_\d+(?:_fix_\d+)?$"), "mermaid_code"),
+    (re.compile(r"^drawings_ideas$"), "mermaid_ideas"),
+    (re.compile(r"^claims:claim_\d+$"), "claim_regenerate"),
+)
+
+
+# -------------- 分词 --------------
+
+@functools.lru_cache(maxsize=8)
+def _tiktoken_encoding(model: str):
+    """返回模型的 tiktoken 编码；未安装或词表无法下载时返回 None（结果同样缓存，离线时不反复下载）。"""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(text: str, llm_client: Optional[LLMClient] = None) -> int:
+    """
+    按当前模型的分词器计数：OpenAI/Azure 模型使用 tiktoken（未安装或词表不可用时退回估算）；
+    Gemini 没有本地分词器，使用与调用池相同的估算。
+    """
+    if not text:
+        return 0
+    if llm_client is not None and llm_client.provider in ("openai", "azure"):
+        encoding = _tiktoken_encoding(llm_client.model or "")
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+# -------------- 历史调用统计 --------------
+
+def step_for_tag(tag: str) -> str:
+    """由调用日志中的 tag 还原工作流步骤（“invention:solution_points” -> “solution_points”）。"""
+    tag = _RETRY_SUFFIX_RE.sub("", tag)
+    for pattern, step in _TAG_STEP_PATTERNS:
+        if pattern.match(tag):
+            return step
+    if tag.startswith("refine:"):
+        return tag
+    return tag.rsplit(":", 1)[-1]
+
+
+def _log_signature() -> Tuple[Tuple[str, float, int], ...]:
+    files = sorted(glob.glob(os.path.join(LOG_DIR, "run_*.log")), key=os.path.getmtime)[-HISTORY_MAX_FILES:]
+    signature = []
+    for path in files:
+        stat = os.stat(path)
+        signature.append((path, stat.st_mtime, stat.st_size))
+    return tuple(signature)
+
+
+def _build_history(signature: Tuple[Tuple[str, float, int], ...]) -> Dict[str, Dict[str, float]]:
+    samples: Dict[str, List[Tuple[float, float, float]]] = {}
+    for path, _, _ in signature:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if '"LLM:response"' not in line:
+                        continue
+                    try:
+                        ctx = json.loads(line).get("context") or {}
+                    except json.JSONDecodeError:
+                        continue
+                    output = ctx.get("response_tokens_est", ctx.get("response_len"))
+                    if output is None or not ctx.get("tag"):
+                        continue
+                    samples.setdefault(step_for_tag(ctx["tag"]), []).append(
+                        (float(output), float(ctx.get("elapsed_s") or 0), float(ctx.get("queue_wait_s") or 0))
+                    )
+        except OSError:
+            continue
+    history = {}
+    for step, rows in samples.items():
+        n = len(rows)
+        history[step] = {
+            "samples": n,
+            "output_tokens": sum(r[0] for r in rows) / n,
+            "seconds": sum(r[1] for r in rows) / n,
+            "queue_wait_s": sum(r[2] for r in rows) / n,
+        }
+    return history
+
+
+def call_history() -> Dict[str, Dict[str, float]]:
+    """按步骤汇总的历史调用：平均输出 token、耗时与排队等待；日志文件未变化时复用。"""
+    return DERIVED_VIEWS.get("call_history", _log_signature(), _build_history)
+
+
+# -------------- 规划 --------------
+
+class _Planner:
+    def __init__(self, llm_client: Optional[LLMClient], state: Mapping[str, Any]):
+        self.llm_client = llm_client
+        self.state = state
+        self.history = call_history()
+        self.steps: List[Dict[str, Any]] = []
+
+    def expected_output(self, step: str, fallback: Optional[int] = None) -> int:
+        hist = self.history.get(step)
+        if hist:
+            return int(hist["output_tokens"])
+        return fallback if fallback is not None else DEFAULT_OUTPUT_TOKENS
+
+    def expected_seconds(self, step: str, output_tokens: int) -> float:
+        hist = self.history.get(step)
+        if hist and hist["seconds"]:
+            return hist["seconds"] + hist["queue_wait_s"]
+        return DEFAULT_CALL_LATENCY_S + output_tokens / DEFAULT_OUTPUT_TOKENS_PER_S
+
+    def pending_inputs(self, dependencies: List[str]) -> int:
+        """依赖的步骤当前尚无内容时，按其预估输出大小计入本步输入。"""
+        return sum(self.expected_output(d) for d in dependencies
+                   if d in WORKFLOW_CONFIG and not get_active_content(d, self.state))
+
+    def add(self, step: str, label: str, prompt: str, calls: int = 1, output_tokens: Optional[int] = None,
+            extra_input: int = 0):
+        output = output_tokens if output_tokens is not None else self.expected_output(step)
+        input_tokens = count_tokens(prompt, self.llm_client) + extra_input
+        self.steps.append({
+            "step": step,
+            "label": label,
+            "calls": calls,
+            "input_tokens": input_tokens * calls,
+            "output_tokens": output * calls,
+            "seconds": self.expected_seconds(step, output) * calls,
+        })
+
+    def add_workflow_step(self, micro_key: str, label: str):
+        step_config = WORKFLOW_CONFIG[micro_key]
+        if micro_key == "implementation_details":
+            points = get_active_content("solution_points", self.state) or []
+            count = len(points) if isinstance(points, list) and points else DEFAULT_SOLUTION_POINTS
+            sample = points[0] if points else ""
+            prompt = safe_format_prompt(step_config["prompt"], point=sample)
+            extra = 0 if points else self.expected_output("solution_points") // DEFAULT_SOLUTION_POINTS
+            self.add(micro_key, label, prompt, calls=count, extra_input=extra)
+            return
+        format_args = build_format_args(step_config["dependencies"], state=self.state)
+        prompt = safe_format_prompt(step_config["prompt"], **format_args)
+        self.add(micro_key, label, prompt, extra_input=self.pending_inputs(step_config["dependencies"]))
+
+    def result(self) -> Dict[str, Any]:
+        cfg = load_server_config()
+        input_tokens = sum(s["input_tokens"] for s in self.steps)
+        output_tokens = sum(s["output_tokens"] for s in self.steps)
+        priced = cfg["price_input_per_mtok"] or cfg["price_output_per_mtok"]
+        return {
+            "steps": self.steps,
+            "calls": sum(s["calls"] for s in self.steps),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "tokens": input_tokens + output_tokens,
+            "cost": (input_tokens * cfg["price_input_per_mtok"] + output_tokens * cfg["price_output_per_mtok"]) / 1e6
+            if priced else None,
+            "currency": cfg["price_currency"],
+            # 章节与润色步骤按顺序执行：耗时为各调用之和（含历史平均排队等待）
+            "seconds": sum(s["seconds"] for s in self.steps),
+            "concurrency": cfg["user_max_concurrency"],
+            "history_samples": sum(int(h["samples"]) for h in self.history.values()),
+        }
+
+
+def _plan_full_draft(llm_client: Optional[LLMClient], state: Mapping[str, Any]) -> Dict[str, Any]:
+    planner = _Planner(llm_client, state)
+    skip_drawings = state.get("skip_drawings", SKIP_DRAWINGS_DEFAULT)
+    for ui_key in UI_SECTION_ORDER:
+        label = UI_SECTION_CONFIG[ui_key]["label"]
+        if ui_key == "drawings":
+            if skip_drawings:
+                continue
+            detail = get_active_content("invention_solution_detail", state) or ""
+            ideas = get_active_content("mermaid_ideas", state)
+            count = len(ideas) if isinstance(ideas, list) and ideas else DEFAULT_DRAWINGS
+            planner.add("mermaid_ideas", f"{label}：构思",
+                        safe_format_prompt(prompts.PROMPT_MERMAID_IDEAS, invention_solution_detail=detail))
+            planner.add("mermaid_code", f"{label}：代码",
+                        safe_format_prompt(prompts.PROMPT_MERMAID_CODE, title="", description="",
+                                           invention_solution_detail=detail), calls=count)
+            continue
+        for micro_key in UI_SECTION_CONFIG[ui_key]["workflow_keys"]:
+            planner.add_workflow_step(micro_key, f"{label}：{micro_key}")
+    return planner.result()
+
+
+def _plan_global_refinement(llm_client: Optional[LLMClient], state: Mapping[str, Any]) -> Dict[str, Any]:
+    """全局润色逐章节发送“排除自身的全文 + 本章节”：总输入随草稿长度近似平方增长。"""
+    planner = _Planner(llm_client, state)
+    draft = get_draft_document(state.get("skip_drawings", SKIP_DRAWINGS_DEFAULT))
+    for target_key in UI_SECTION_ORDER:
+        if target_key in REFINE_SKIP_KEYS:
+            continue
+        content = draft.data.get(target_key, "") or ""
+        prompt = safe_format_prompt(
+            prompts.PROMPT_GLOBAL_RESTRUCTURE_AND_POLISH,
+            global_context=draft.context_excluding(target_key),
+            target_section_name=UI_SECTION_CONFIG[target_key]["label"],
+            target_section_content=content,
+            original_generation_prompt="\n---\n".join(REFINE_ORIGINAL_PROMPTS.get(target_key, [])),
+        )
+        # 润色输出与原章节篇幅相当
+        planner.add(f"refine:{target_key}", UI_SECTION_CONFIG[target_key]["label"], prompt,
+                    output_tokens=planner.expected_output(f"refine:{target_key}", count_tokens(str(content), llm_client)))
+    return planner.result()
+
+
+_PLANNERS = {"full_draft": _plan_full_draft, "global_refine": _plan_global_refinement}
+
+
+def plan_job(kind: str, llm_client: Optional[LLMClient] = None, state: Optional[Mapping[str, Any]] = None) -> Dict[str, Any]:
+    """
+    预估一次整稿任务（full_draft / global_refine）的调用数、token、费用与耗时。
+    Prompt 按当前草稿实际渲染并用当前模型的分词器计数；输出大小与耗时取历史调用日志的平均值。
+    结果按 (草稿各部分的版本, 结构化摘要, 模型, 调用日志) 缓存，内容未变时不重复计算。
+    """
+    if state is None:
+        state = st.session_state
+    versions = {k: (len(state.get(f"{k}_versions") or []), state.get(f"{k}_active_index"))
+                for k in list(UI_SECTION_CONFIG) + list(WORKFLOW_CONFIG)}
+    key = content_fingerprint({
+        "kind": kind,
+        "versions": versions,
+        "brief": state.get("structured_brief") or {},
+        "skip_drawings": state.get("skip_drawings", SKIP_DRAWINGS_DEFAULT),
+        "model": f"{llm_client.provider}:{llm_client.model}" if llm_client is not None else None,
+        "history": _log_signature(),
+    })
+    return DERIVED_VIEWS.get_by_key("cost_plan", key, lambda: _PLANNERS[kind](llm_client, state))
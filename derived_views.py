@@ -0,0 +1,110 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+# 派生视图缓存的最大条目数（按 LRU 淘汰）
+DERIVED_CACHE_MAX_ENTRIES = 512
+# 按对象身份记忆内容指纹的条目数
+IDENTITY_FINGERPRINT_MAX_ENTRIES = 256
+
+
+def content_fingerprint(value: Any) -> str:
+    """计算任意源值的内容指纹（字符串直接哈希，其余对象先做规范化JSON序列化）。"""
+    if isinstance(value, str):
+        data = b"s:" + value.encode("utf-8")
+    else:
+        try:
+            data = b"j:" + json.dumps(value, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+        except (TypeError, ValueError):
+            data = b"r:" + repr(value).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+_IDENTITY_FINGERPRINTS: "OrderedDict[int, Tuple[Any, str]]" = OrderedDict()
+_IDENTITY_LOCK = threading.Lock()
+
+
+def identity_fingerprint(value: Any) -> str:
+    """
+    同一对象只计算一次内容指纹：按 id 记忆，并持有对象引用以防 id 被其他对象复用。
+    只用于不会被原地修改的源值，如草稿各版本的内容（每次编辑都追加新的版本对象）。
+    """
+    if not value or isinstance(value, (bool, int, float)):
+        return content_fingerprint(value)
+    key = id(value)
+    with _IDENTITY_LOCK:
+        entry = _IDENTITY_FINGERPRINTS.get(key)
+        if entry is not None and entry[0] is value:
+            _IDENTITY_FINGERPRINTS.move_to_end(key)
+            return entry[1]
+    fingerprint = content_fingerprint(value)
+    with _IDENTITY_LOCK:
+        _IDENTITY_FINGERPRINTS[key] = (value, fingerprint)
+        _IDENTITY_FINGERPRINTS.move_to_end(key)
+        while len(_IDENTITY_FINGERPRINTS) > IDENTITY_FINGERPRINT_MAX_ENTRIES:
+            _IDENTITY_FINGERPRINTS.popitem(last=False)
+    return fingerprint
+
+
+class DerivedViewCache:
+    """
+    以 (视图名, 源内容指纹) 为键的派生视图缓存。
+    同一源值的某种表示只在内容变化后计算一次，并在所有步骤与会话间共享。
+    返回的结果为共享对象，调用方不得原地修改。
+    """
+
+    def __init__(self, max_entries: int = DERIVED_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, Hashable], Any]" = OrderedDict()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, view: str, field: str):
+        view_stats = self._stats.setdefault(view, {"hits": 0, "misses": 0})
+        view_stats[field] += 1
+
+    def get(self, view: str, source: Any, builder: Callable[[Any], Any]) -> Any:
+        """返回 builder(source) 的结果，命中缓存时不重复计算。"""
+        return self.get_by_key(view, content_fingerprint(source), lambda: builder(source))
+
+    def get_by_key(self, view: str, key: Hashable, builder: Callable[[], Any]) -> Any:
+        """使用调用方给出的指纹键（如多个源指纹组成的元组）查询或构建视图。"""
+        cache_key = (view, key)
+        with self._lock:
+            if cache_key in self._entries:
+                self._entries.move_to_end(cache_key)
+                self._count(view, "hits")
+                return self._entries[cache_key]
+            self._count(view, "misses")
+
+        value = builder()
+
+        with self._lock:
+            self._entries[cache_key] = value
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """返回各视图的命中/未命中计数（副本）。"""
+        with self._lock:
+            return {view: dict(counts) for view, counts in self._stats.items()}
+
+    def totals(self) -> Dict[str, int]:
+        """返回所有视图合计的命中/未命中计数。"""
+        with self._lock:
+            hits = sum(c["hits"] for c in self._stats.values())
+            misses = sum(c["misses"] for c in self._stats.values())
+        return {"hits": hits, "misses": misses, "entries": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats.clear()
+
+
+# 进程级共享实例：键为内容指纹，因此可安全地在会话间复用
+DERIVED_VIEWS = DerivedViewCache()
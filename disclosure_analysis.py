@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
+import prompts
+from config import load_server_config
+from job_runner import bind_context
+from llm_client import LLMClient
+from workflows import call_llm, safe_format_prompt, write_log
+
+# 分块提炼结果的磁盘缓存：按 (模型, Prompt, 分块内容) 哈希，编辑交底材料后只重新提炼改动的分块
+ANALYZE_CACHE_DIR = os.path.join("cache", "analyze")
+# 内容决定的切分点：段落指纹落在 1/CHUNK_BOUNDARY_EVERY 时在其后切分，分块边界不随前文增删而整体漂移
+CHUNK_BOUNDARY_EVERY = 8
+# 分块达到上限的该比例后才允许在标题或内容切分点处切分
+CHUNK_MIN_RATIO = 0.5
+# 分块提炼结果无法解析时的重试次数
+CHUNK_PARSE_RETRIES = 1
+
+BRIEF_TEXT_FIELDS = ("background_technology", "problem_statement", "core_inventive_concept",
+                     "technical_solution_summary", "achieved_effects")
+
+# 章节标题行：Markdown 标题、“第一章”、“一、”、“1.”“1.2 ”等
+_HEADING_RE = re.compile(
+    r"^\s*(?:#{1,6}\s|第[一二三四五六七八九十百\d]+[章节部分]|[一二三四五六七八九十]+[、.．]|\d+(?:\.\d+)*[、.．\s])"
+)
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？；!?;])")
+
+
+def _units(text: str, max_chars: int) -> List[str]:
+    """按行切成段落；超长段落再按句切开，保证单个单元不超过上限。"""
+    units = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if len(line) <= max_chars:
+            units.append(line)
+            continue
+        piece = ""
+        for sentence in _SENTENCE_END_RE.split(line):
+            while len(sentence) > max_chars:
+                if piece:
+                    units.append(piece)
+                    piece = ""
+                units.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            if len(piece) + len(sentence) > max_chars:
+                units.append(piece)
+                piece = ""
+            piece += sentence
+        if piece:
+            units.append(piece)
+    return units
+
+
+def _is_boundary(unit: str) -> bool:
+    digest = hashlib.blake2b(unit.encode("utf-8"), digest_size=4).digest()
+    return int.from_bytes(digest, "big") % CHUNK_BOUNDARY_EVERY == 0
+
+
+def split_disclosure(text: str, max_chars: int) -> List[str]:
+    """
+    按结构把交底材料切成不超过 max_chars 的分块：优先在章节标题处切分，
+    其次在内容决定的段落切分点处切分，因此修改某一处只会改变其所在的分块。
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    min_chars = max_chars * CHUNK_MIN_RATIO
+    for unit in _units(text or "", max_chars):
+        if current and (size + len(unit) > max_chars or (_HEADING_RE.match(unit) and size >= min_chars)):
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(unit)
+        size += len(unit) + 1
+        if size >= min_chars and _is_boundary(unit):
+            chunks.append("\n".join(current))
+            current, size = [], 0
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+# -------------- 缓存 --------------
+
+def _cache_key(llm_client: LLMClient, template: str, content: str) -> str:
+    model = f"{llm_client.provider}:{llm_client.model}"
+    data = "\n\0".join([model, template, content]).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _read_cache(key: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(ANALYZE_CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _write_cache(key: str, value: Dict[str, Any]):
+    os.makedirs(ANALYZE_CACHE_DIR, exist_ok=True)
+    path = os.path.join(ANALYZE_CACHE_DIR, f"{key}.json")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(value, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _parse_object(response: str) -> Optional[Dict[str, Any]]:
+    try:
+        value = json.loads((response or "").strip())
+    except json.JSONDecodeError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+# -------------- map / reduce --------------
+
+def _extract_chunk(llm_client: LLMClient, chunk: str, index: int) -> Optional[Dict[str, Any]]:
+    """提炼单个分块；命中缓存时不调用模型。结果无法解析时重试，仍失败返回 None（不写缓存）。"""
+    key = _cache_key(llm_client, prompts.PROMPT_ANALYZE_CHUNK, chunk)
+    cached = _read_cache(key)
+    if cached is not None:
+        return cached
+    prompt = safe_format_prompt(prompts.PROMPT_ANALYZE_CHUNK, chunk_text=chunk)
+    for attempt in range(1 + CHUNK_PARSE_RETRIES):
+        response = call_llm(
+            llm_client,
+            messages=[{"role": "user", "content": prompt}],
+            json_mode=True,
+            tag=f"analyze_chunk_{index + 1}",
+            extra_ctx={"stage": "input", "chunk_chars": len(chunk), "attempt": attempt + 1},
+        )
+        partial = _parse_object(response)
+        if partial is not None:
+            _write_cache(key, partial)
+            return partial
+        write_log("WARN", "analyze:chunk_parse_error", "分块提炼结果无法解析", {"chunk_index": index + 1, "attempt": attempt + 1})
+    return None
+
+
+def merge_partial_briefs(partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """本地合并各分块的提炼结果：文本字段按行去重拼接，组件按名称合并并保留最完整的功能描述。"""
+    merged: Dict[str, Any] = {}
+    for field in BRIEF_TEXT_FIELDS:
+        lines: List[str] = []
+        for partial in partials:
+            value = partial.get(field)
+            if not isinstance(value, str):
+                continue
+            for line in value.splitlines():
+                line = line.strip()
+                if line and line not in lines:
+                    lines.append(line)
+        merged[field] = "\n".join(lines) or None
+    components: Dict[str, Dict[str, str]] = {}
+    for partial in partials:
+        for item in partial.get("key_components_or_steps") or []:
+            if not isinstance(item, dict) or not str(item.get("name") or "").strip():
+                continue
+            name = str(item["name"]).strip()
+            function = str(item.get("function") or "").strip()
+            if name not in components or len(function) > len(components[name]["function"]):
+                components[name] = {"name": name, "function": function}
+    merged["key_components_or_steps"] = list(components.values())
+    return merged
+
+
+def _reduce(llm_client: LLMClient, merged: Dict[str, Any]) -> Dict[str, Any]:
+    """由模型把初步合并的结果归纳为最终摘要；结果无法解析时退回本地合并结果。"""
+    partial_text = json.dumps(merged, ensure_ascii=False, indent=1)
+    key = _cache_key(llm_client, prompts.PROMPT_ANALYZE_REDUCE, partial_text)
+    cached = _read_cache(key)
+    if cached is not None:
+        return cached
+    prompt = safe_format_prompt(prompts.PROMPT_ANALYZE_REDUCE, partial_briefs=partial_text)
+    response = call_llm(
+        llm_client,
+        messages=[{"role": "user", "content": prompt}],
+        json_mode=True,
+        tag="analyze_reduce",
+        extra_ctx={"stage": "input", "merged_chars": len(partial_text)},
+    )
+    brief = _parse_object(response)
+    if brief is None:
+        write_log("WARN", "analyze:reduce_parse_error", "合并结果无法解析，采用本地合并结果", {})
+        return merged
+    _write_cache(key, brief)
+    return brief
+
+
+def analyze_disclosure(llm_client: LLMClient, text: str,
+                       progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, Any]:
+    """
+    将交底材料提炼为结构化摘要。不超过 ANALYZE_CHUNK_CHARS 时单次调用 PROMPT_ANALYZE；
+    更长的材料按结构分块并行提炼（map）、再合并为同一结构（reduce）。
+    progress(done, total) 在脚本线程中回调，用于更新进度条。
+    """
+    cfg = load_server_config()
+    chunks = split_disclosure(text, cfg["analyze_chunk_chars"])
+    if len(chunks) <= 1:
+        prompt = safe_format_prompt(prompts.PROMPT_ANALYZE, user_input=text)
+        response = call_llm(
+            llm_client,
+            messages=[{"role": "user", "content": prompt}],
+            json_mode=True,
+            tag="analyze_brief",
+            extra_ctx={"stage": "input"},
+        )
+        brief = _parse_object(response)
+        if brief is None:
+            raise ValueError(f"无法解析模型返回的核心要素。模型原始返回：\n{response}")
+        return brief
+
+    write_log("INFO", "analyze:map_start", "交底材料分块提炼", {"chunks": len(chunks), "chars": len(text)})
+    results: List[Optional[Dict[str, Any]]] = [None] * len(chunks)
+    extract = bind_context(_extract_chunk)
+    with ThreadPoolExecutor(max_workers=cfg["analyze_map_workers"], thread_name_prefix="analyze") as executor:
+        futures = {executor.submit(extract, llm_client, chunk, i): i for i, chunk in enumerate(chunks)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            results[futures[future]] = future.result()
+            if progress is not None:
+                progress(done, len(chunks))
+
+    partials = [r for r in results if r]
+    failed = len(chunks) - len(partials)
+    if not partials:
+        raise ValueError("所有分块的提炼结果均无法解析，请重试。")
+    brief = _reduce(llm_client, merge_partial_briefs(partials))
+    write_log("WARN" if failed else "INFO", "analyze:done", "分块提炼与合并完成", {"chunks": len(chunks), "failed_chunks": failed})
+    return brief
@@ -0,0 +1,200 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+# 上传文档的提取结果缓存：按文件内容哈希保存全文，重新上传同一文件时不再提取
+INGEST_CACHE_DIR = os.path.join("cache", "ingest")
+# 每个提取子任务处理的 PDF 页数（子任务完成即按页序把文本推给界面）
+PAGES_PER_TASK = 4
+SUPPORTED_TYPES = ["pdf", "docx", "md", "markdown", "txt"]
+
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_ingest_pool() -> ProcessPoolExecutor:
+    """进程级共享的提取进程池（spawn 启动，子进程只导入本模块与所用的解析库）。"""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            from config import load_server_config
+            _POOL = ProcessPoolExecutor(
+                max_workers=load_server_config()["ingest_workers"],
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _POOL
+
+
+def file_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _cached_text_path(digest: str) -> str:
+    return os.path.join(INGEST_CACHE_DIR, f"{digest}.txt")
+
+
+def cached_document_text(data: bytes) -> Optional[str]:
+    try:
+        with open(_cached_text_path(file_hash(data)), "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _save_text(digest: str, text: str):
+    os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+    path = _cached_text_path(digest)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# -------------- 提取（在子进程中执行） --------------
+
+def _markdown_table(rows: List[List[Optional[str]]]) -> str:
+    """表格转为 Markdown 表格，保留行列结构供模型理解。"""
+    rows = [[(cell or "").replace("\n", " ").replace("|", "\\|").strip() for cell in row] for row in rows if row]
+    if not rows:
+        return ""
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    lines = ["| " + " | ".join(rows[0]) + " |", "|" + " --- |" * width]
+    lines.extend("| " + " | ".join(row) + " |" for row in rows[1:])
+    return "\n".join(lines)
+
+
+def _pdf_page_text(page) -> str:
+    """单页正文与表格：表格区域内的文字不重复进入正文，表格以 Markdown 形式附在该页之后。"""
+    tables = page.find_tables()
+    if not tables:
+        return page.extract_text() or ""
+    bboxes = [t.bbox for t in tables]
+
+    def outside_tables(obj) -> bool:
+        if obj.get("object_type") != "char":
+            return True
+        x, y = (obj["x0"] + obj["x1"]) / 2, (obj["top"] + obj["bottom"]) / 2
+        return not any(x0 <= x <= x1 and top <= y <= bottom for x0, top, x1, bottom in bboxes)
+
+    parts = [page.filter(outside_tables).extract_text() or ""]
+    parts.extend(_markdown_table(t.extract()) for t in tables)
+    return "\n\n".join(p for p in parts if p.strip())
+
+
+def _extract_pdf_pages(path: str, start: int, end: int) -> List[str]:
+    import pdfplumber
+    with pdfplumber.open(path, pages=list(range(start + 1, end + 1))) as pdf:
+        return [_pdf_page_text(page) for page in pdf.pages]
+
+
+def _extract_docx(path: str) -> str:
+    """按文档顺序提取段落与表格；标题样式转为 Markdown 标题，便于后续按结构分块。"""
+    import docx
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+
+    document = docx.Document(path)
+    parts = []
+    for element in document.element.body.iterchildren():
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "p":
+            paragraph = Paragraph(element, document)
+            text = paragraph.text.strip()
+            if not text:
+                continue
+            style = (paragraph.style.name if paragraph.style is not None else "") or ""
+            if style.startswith("Heading") and style[7:].strip().isdigit():
+                text = "#" * min(6, int(style[7:].strip())) + " " + text
+            elif style == "Title":
+                text = "# " + text
+            parts.append(text)
+        elif tag == "tbl":
+            table = Table(element, document)
+            parts.append(_markdown_table([[cell.text for cell in row.cells] for row in table.rows]))
+    return "\n\n".join(p for p in parts if p)
+
+
+def _decode_text(data: bytes) -> str:
+    for encoding in ("utf-8-sig", "gb18030"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="replace")
+
+
+# -------------- 流式提取 --------------
+
+def _pdf_page_count(path: str) -> int:
+    import pdfplumber
+    with pdfplumber.open(path) as pdf:
+        return len(pdf.pages)
+
+
+def iter_document_text(filename: str, data: bytes) -> Iterator[Tuple[int, int, str]]:
+    """
+    逐步产出上传文档的文本：(已完成的单元数, 总单元数, 新增文本)，新增文本按文档顺序给出。
+    PDF 按页分成子任务在进程池中并行提取，前面的页一旦就绪即产出；DOCX 在子进程中整体提取；
+    Markdown/纯文本直接解码。全部完成后按文件哈希缓存全文，再次上传同一文件时一次性产出。
+    """
+    digest = file_hash(data)
+    cached = cached_document_text(data)
+    if cached is not None:
+        yield 1, 1, cached
+        return
+
+    ext = os.path.splitext(filename)[1].lower().lstrip(".")
+    if ext not in SUPPORTED_TYPES:
+        raise ValueError(f"不支持的文件类型：{ext or filename}")
+    if ext in ("md", "markdown", "txt"):
+        text = _decode_text(data)
+        _save_text(digest, text)
+        yield 1, 1, text
+        return
+
+    # 解析库在子进程中按路径读取文件：原始文件临时写入缓存目录，提取结束后删除
+    os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+    source = os.path.join(INGEST_CACHE_DIR, f"{digest}.{os.getpid()}.{threading.get_ident()}.{ext}")
+    with open(source, "wb") as f:
+        f.write(data)
+
+    pool = get_ingest_pool()
+    parts: List[str] = []
+    futures: List[Future] = []
+    try:
+        if ext == "docx":
+            futures.append(pool.submit(_extract_docx, source))
+            text = futures[0].result()
+            parts.append(text)
+            yield 1, 1, text
+        else:
+            total = _pdf_page_count(source)
+            futures.extend(
+                pool.submit(_extract_pdf_pages, source, start, min(start + PAGES_PER_TASK, total))
+                for start in range(0, total, PAGES_PER_TASK)
+            )
+            done_pages = 0
+            for future in futures:
+                pages = future.result()
+                done_pages += len(pages)
+                page_text = "\n\n".join(p for p in pages if p.strip())
+                parts.append(page_text)
+                yield done_pages, total, page_text
+    finally:
+        # 提前中止（出错或页面重跑）时撤销尚未开始的子任务；等进行中的子任务结束后再删除源文件
+        for future in futures:
+            future.cancel()
+        for future in futures:
+            if not future.cancelled():
+                future.exception()
+        os.remove(source)
+    _save_text(digest, "\n\n".join(p for p in parts if p.strip()))
+
+
+def extract_document_text(filename: str, data: bytes) -> str:
+    return "\n\n".join(text for _, _, text in iter_document_text(filename, data) if text.strip())
+
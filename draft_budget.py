@@ -0,0 +1,66 @@
+import threading
+from typing import Any, Dict, Optional
+
+import streamlit as st
+
+from config import load_server_config
+from job_runner import current_job
+
+USED_KEY = "draft_tokens_used"
+BUDGET_KEY = "draft_token_budget"
+
+# 同一会话的并行调用（如分块提炼）同时累加用量
+_record_lock = threading.Lock()
+
+
+class DraftBudgetExceeded(Exception):
+    """交互调用时本草稿的 token 预算已用尽。"""
+
+
+def draft_budget() -> int:
+    """本草稿的 token 预算（0 为不限）；未单独设置时取服务配置 DRAFT_TOKEN_BUDGET。"""
+    budget = st.session_state.get(BUDGET_KEY)
+    return int(budget) if budget is not None else load_server_config()["draft_token_budget"]
+
+
+def draft_tokens_used() -> int:
+    return int(st.session_state.get(USED_KEY, 0))
+
+
+def record_draft_tokens(tokens: int):
+    with _record_lock:
+        st.session_state[USED_KEY] = draft_tokens_used() + int(tokens or 0)
+
+
+def reset_draft_tokens():
+    """开始新草稿（重新分析交底材料）时清零已用量。"""
+    st.session_state[USED_KEY] = 0
+
+
+def budget_status(planned_tokens: Optional[int] = None) -> Dict[str, Any]:
+    budget = draft_budget()
+    used = draft_tokens_used()
+    remaining = max(0, budget - used) if budget else None
+    return {
+        "budget": budget,
+        "used": used,
+        "remaining": remaining,
+        "exceeds": bool(budget) and planned_tokens is not None and planned_tokens > remaining,
+    }
+
+
+def check_draft_budget(prompt_tokens: int):
+    """
+    调用前检查本草稿预算：发出本次请求会超出预算时停止。
+    在后台任务中按取消处理（已生成的内容照常保留，原因记为 budget）；交互调用抛出 DraftBudgetExceeded。
+    """
+    budget = draft_budget()
+    used = draft_tokens_used()
+    if not budget or used + prompt_tokens <= budget:
+        return
+    job = current_job()
+    if job is not None:
+        job.cancel_reason = job.cancel_reason or "budget"
+        job.cancel()
+        job.check_cancelled()
+    raise DraftBudgetExceeded(f"本草稿的 token 预算已用尽（已用 {used}/{budget}）")
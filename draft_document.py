@@ -0,0 +1,229 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import streamlit as st
+
+from config import UI_SECTION_ORDER, UI_SECTION_CONFIG
+from derived_views import DERIVED_VIEWS, content_fingerprint
+from state_manager import get_active_content
+
+# 组装全文需要读取的键：UI 章节，加上整段章节缺失时兜底拼接用的微观子键
+DRAFT_SOURCE_KEYS = list(UI_SECTION_ORDER) + [
+    "figure_labels",
+    "tech_field",
+    "background_context",
+    "background_problem",
+    "invention_purpose",
+    "invention_solution_detail",
+    "invention_effects",
+]
+
+
+def _parse_figure_labels(raw: Any) -> Optional[List[Dict[str, Any]]]:
+    """
+    解析附图标号表：接受对象数组，或只含一个数组字段的对象（json_mode 下模型常返回 {"labels": [...]}）。
+    不符合时返回 None。
+    """
+    labels = json.loads(raw) if isinstance(raw, str) else raw
+    if isinstance(labels, dict):
+        values = [v for v in labels.values() if isinstance(v, list)]
+        if len(values) != 1:
+            return None
+        labels = values[0]
+    if not isinstance(labels, list) or not all(isinstance(item, dict) for item in labels):
+        return None
+    return labels
+
+
+def resolve_draft_sections(draft_data: Dict[str, Any], skip_drawings: bool) -> Dict[str, Any]:
+    """
+    将草稿数据整理为各章节的最终文本（整段章节缺失时用微观子键兜底拼接）。
+    Markdown 预览、权利要求校验上下文与 DOCX/PDF 导出共用这一结果。
+    """
+    title = draft_data.get('title') or '无标题'
+    tech_field = draft_data.get('technical_field') or draft_data.get('tech_field') or ''
+
+    background = draft_data.get('background') or (
+        f"## 2.1 对最接近发明的同类现有技术状况加以分析说明\n{draft_data.get('background_context') or ''}\n\n"
+        f"## 2.2 实事求是地指出现有技术存在的问题，尽可能分析存在的原因。\n{draft_data.get('background_problem') or ''}"
+    )
+    invention = draft_data.get('invention') or (
+        f"## 3.1 发明目的\n{draft_data.get('invention_purpose') or ''}\n\n"
+        f"## 3.2 技术解决方案\n{draft_data.get('invention_solution_detail') or ''}\n\n"
+        f"## 3.3 技术效果\n{draft_data.get('invention_effects') or ''}"
+    )
+
+    # 附图说明与标号表（若跳过附图，则用占位）
+    figure_labels: List[Dict[str, Any]] = []
+    figure_labels_error = False
+    drawings: List[Dict[str, Any]] = []
+    if skip_drawings:
+        figure_description = "（本申请无附图）"
+    else:
+        figure_description = draft_data.get('figure_description', '') or '（附图说明待补充）'
+        raw_labels = draft_data.get("figure_labels")
+        if raw_labels:
+            try:
+                parsed = _parse_figure_labels(raw_labels)
+            except Exception:
+                parsed = None
+            if parsed is None:
+                figure_labels_error = True
+            else:
+                figure_labels = parsed
+        raw_drawings = draft_data.get("drawings")
+        if raw_drawings and isinstance(raw_drawings, list):
+            drawings = raw_drawings
+
+    return {
+        "title": title,
+        "technical_field": tech_field,
+        "background": background,
+        "invention": invention,
+        "figure_description": figure_description,
+        "figure_labels": figure_labels,
+        "figure_labels_error": figure_labels_error,
+        "implementation": draft_data.get('implementation', '') or '',
+        "claims": draft_data.get('claims', '') or '',
+        "abstract": draft_data.get('abstract', '') or '',
+        "drawings": drawings,
+    }
+
+
+def figure_labels_text(sections: Dict[str, Any]) -> str:
+    if sections["figure_labels_error"]:
+        return "附图标号表解析失败。"
+    if not sections["figure_labels"]:
+        return ""
+    return "附图标号表：\n" + "\n".join(
+        f"{item.get('id','')}: {item.get('name','')} - {item.get('description','')}" for item in sections["figure_labels"]
+    )
+
+
+class DraftDocument:
+    """
+    一份草稿的不可变快照：源数据只读取一次，各种视图（Markdown 全文、校验上下文、
+    排除某章节的润色上下文）首次使用时构建并保存在快照上。
+    快照按内容指纹缓存在 DERIVED_VIEWS 中，调用方不得修改 data。
+    """
+
+    def __init__(self, data: Dict[str, Any], skip_drawings: bool, fingerprint: str):
+        self.data = data
+        self.skip_drawings = skip_drawings
+        self.fingerprint = fingerprint
+        self._sections: Optional[Dict[str, Any]] = None
+        self._markdown: Optional[str] = None
+        self._claims_context: Optional[str] = None
+        self._excluded_contexts: Dict[str, str] = {}
+
+    @property
+    def title(self) -> str:
+        return self.sections["title"]
+
+    @property
+    def sections(self) -> Dict[str, Any]:
+        if self._sections is None:
+            self._sections = resolve_draft_sections(self.data, self.skip_drawings)
+        return self._sections
+
+    def markdown(self) -> str:
+        """完整草稿的 Markdown 全文（预览与 .md 下载）。"""
+        if self._markdown is None:
+            sections = self.sections
+            drawings_text = ""
+            for i, drawing in enumerate(sections["drawings"]):
+                drawings_text += f"## 附图{i+1}：{drawing.get('title', '')}\n"
+                drawings_text += f"```mermaid\n{drawing.get('code', '')}\n```\n\n"
+            labels_text = figure_labels_text(sections)
+            self._markdown = (
+                f"# 一、发明名称\n{sections['title']}\n\n"
+                f"# 二、技术领域\n{sections['technical_field']}\n\n"
+                f"# 三、背景技术\n{sections['background']}\n\n"
+                f"# 四、发明内容\n{sections['invention']}\n\n"
+                f"# 五、附图说明\n{sections['figure_description']}\n\n"
+                f"{labels_text if labels_text else ''}\n\n"
+                f"# 六、具体实施方式\n{sections['implementation']}\n\n"
+                f"# 七、权利要求书\n{sections['claims']}\n\n"
+                f"# 八、摘要\n{sections['abstract']}\n\n"
+                f"# 九、附图\n{drawings_text if drawings_text else '（本申请无附图）'}\n"
+            )
+        return self._markdown
+
+    def claims_check_context(self) -> str:
+        """权利要求一致性校验使用的说明书上下文（技术领域、背景技术、发明内容、具体实施方式）。"""
+        if self._claims_context is None:
+            sections = self.sections
+            self._claims_context = (
+                f"技术领域：{sections['technical_field']}\n"
+                f"背景技术：{sections['background']}\n"
+                f"发明内容：{sections['invention']}\n"
+                f"具体实施方式：{sections['implementation']}\n"
+            )
+        return self._claims_context
+
+    def context_excluding(self, target_key: str) -> str:
+        """除 target_key 外其余章节拼成的全局上下文（全局润色时作为参考）。"""
+        cached = self._excluded_contexts.get(target_key)
+        if cached is not None:
+            return cached
+        parts = []
+        for key in UI_SECTION_ORDER:
+            if key == target_key:
+                continue
+            content = self.data.get(key)
+            label = UI_SECTION_CONFIG[key]['label']
+            processed_content = ""
+            if key == 'title':
+                processed_content = content or ""
+            elif key in ('drawings', 'figures') and isinstance(content, list):
+                processed_content = "附图列表:\n" + "\n".join([f"- {d.get('title')}: {d.get('description')}" for d in content])
+            elif isinstance(content, str):
+                processed_content = content
+            if processed_content:
+                parts.append(f"--- {label} ---\n{processed_content}")
+        context = "\n".join(parts)
+        self._excluded_contexts[target_key] = context
+        return context
+
+
+def _active_version_key(key: str) -> Tuple[int, str]:
+    """
+    返回某章节 (激活版本序号, 内容指纹)。
+    版本一经加入便不再原地修改，因此按内容对象身份记住指纹，未切换版本时不重复哈希。
+    """
+    versions = st.session_state.get(f"{key}_versions") or []
+    if not versions:
+        return (-1, "")
+    active_index = st.session_state.get(f"{key}_active_index", 0)
+    content = versions[active_index]
+    memo = st.session_state.setdefault("_draft_fingerprints", {})
+    cached = memo.get(key)
+    if cached is not None and cached[0] is content:
+        return (active_index, cached[1])
+    fingerprint = content_fingerprint(content)
+    memo[key] = (content, fingerprint)
+    return (active_index, fingerprint)
+
+
+def get_draft_document(skip_drawings: Optional[bool] = None) -> DraftDocument:
+    """返回当前会话激活版本组成的草稿快照；各章节的激活版本与内容不变时复用同一快照。"""
+    if skip_drawings is None:
+        skip_drawings = st.session_state.get("skip_drawings", True)
+    version_key = tuple(_active_version_key(k) for k in DRAFT_SOURCE_KEYS)
+    fingerprint = content_fingerprint([list(version_key), skip_drawings])
+
+    def build() -> DraftDocument:
+        data = {k: get_active_content(k) for k in DRAFT_SOURCE_KEYS}
+        return DraftDocument(data, skip_drawings, fingerprint)
+
+    return DERIVED_VIEWS.get_by_key("draft_document", fingerprint, build)
+
+
+def draft_document_from_data(data: Dict[str, Any], skip_drawings: Optional[bool] = None) -> DraftDocument:
+    """为已组装好的草稿数据（如全局润色版）构建快照，按内容指纹复用。"""
+    if skip_drawings is None:
+        skip_drawings = st.session_state.get("skip_drawings", True)
+    fingerprint = content_fingerprint({"draft": data, "skip_drawings": skip_drawings})
+    return DERIVED_VIEWS.get_by_key(
+        "draft_document", fingerprint, lambda: DraftDocument(dict(data), skip_drawings, fingerprint)
+    )
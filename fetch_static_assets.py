@@ -0,0 +1,57 @@
+"""
+下载自托管前端资源（mermaid.min.js）到 static/ 目录，供离线/内网部署使用。
+
+在可联网的构建环境中执行一次，随部署产物一同分发：
+
+    python fetch_static_assets.py            # 从 ui_components.MERMAID_CDN_URL 下载
+    python fetch_static_assets.py --url URL  # 从内网镜像下载
+    python fetch_static_assets.py --force    # 覆盖已有文件
+"""
+import argparse
+import os
+import sys
+import urllib.request
+
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(_MODULE_DIR, "static")
+MERMAID_BUNDLE_FILE = "mermaid.min.js"
+# 与 ui_components.MERMAID_CDN_URL 保持一致（此处不导入 ui_components，避免依赖 streamlit）
+MERMAID_CDN_URL = "https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.min.js"
+DOWNLOAD_TIMEOUT_S = 60
+# 小于此大小的下载结果视为错误页而非 Mermaid 库
+MIN_BUNDLE_BYTES = 100_000
+
+
+def fetch_mermaid_bundle(url: str = MERMAID_CDN_URL, force: bool = False) -> str:
+    """下载 mermaid.min.js 到 static/，先写临时文件再原子替换；返回目标路径。"""
+    target = os.path.join(STATIC_DIR, MERMAID_BUNDLE_FILE)
+    if os.path.exists(target) and not force:
+        return target
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT_S) as response:
+        data = response.read()
+    if len(data) < MIN_BUNDLE_BYTES:
+        raise ValueError(f"下载内容过小（{len(data)} 字节），请检查地址: {url}")
+    os.makedirs(STATIC_DIR, exist_ok=True)
+    tmp = target + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, target)
+    return target
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="下载自托管的 mermaid.min.js 到 static/")
+    parser.add_argument("--url", default=MERMAID_CDN_URL, help="下载地址（默认 jsDelivr CDN）")
+    parser.add_argument("--force", action="store_true", help="已存在时仍重新下载")
+    args = parser.parse_args(argv)
+    try:
+        path = fetch_mermaid_bundle(args.url, force=args.force)
+    except Exception as e:
+        print(f"下载失败: {e}", file=sys.stderr)
+        return 1
+    print(f"{path}（{os.path.getsize(path)} 字节）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
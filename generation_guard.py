@@ -0,0 +1,85 @@
+import re
+from typing import Optional
+
+from config import WORKFLOW_CONFIG, load_server_config
+
+# 重复检测：在结尾窗口内统计字符 n-gram 的去重比例，低于阈值视为陷入重复循环
+GUARD_NGRAM = 12
+GUARD_REPEAT_WINDOW = 1500
+GUARD_MIN_DISTINCT_RATIO = 0.35
+# 语言漂移：结尾窗口内中文字符在（中文 + 拉丁字母）中的占比低于阈值视为偏离中文
+GUARD_LANGUAGE_WINDOW = 400
+GUARD_MIN_CJK_RATIO = 0.3
+# 截断重复内容时用于定位循环起点的结尾片段长度
+GUARD_TRIM_PROBE = 50
+
+REASON_REPETITION = "repetition"
+REASON_LANGUAGE = "language_drift"
+REASON_LENGTH = "length_overrun"
+REASON_LABELS = {
+    REASON_REPETITION: "大段重复",
+    REASON_LANGUAGE: "偏离中文的内容",
+    REASON_LENGTH: "篇幅远超预期",
+}
+
+_SENTENCE_END_RE = re.compile(r"[。！？；\n]")
+
+
+def _is_cjk(ch: str) -> bool:
+    return "一" <= ch <= "鿿"
+
+
+class RunawayGuard:
+    """
+    流式生成的失控检测：对已生成的文本调用，返回失控原因（REASON_*），正常时返回 None。
+    - 重复：结尾窗口内 n-gram 去重比例过低（同一句/段落反复出现）
+    - 语言漂移：要求中文的步骤在结尾窗口内中文占比过低
+    - 超长：超过该步骤的字符上限
+    """
+
+    def __init__(self, max_chars: int, require_chinese: bool = True):
+        self.max_chars = max_chars
+        self.require_chinese = require_chinese
+
+    def __call__(self, text: str) -> Optional[str]:
+        if self.max_chars and len(text) > self.max_chars:
+            return REASON_LENGTH
+        if len(text) >= GUARD_REPEAT_WINDOW:
+            window = text[-GUARD_REPEAT_WINDOW:]
+            grams = [window[i:i + GUARD_NGRAM] for i in range(len(window) - GUARD_NGRAM + 1)]
+            if len(set(grams)) / len(grams) < GUARD_MIN_DISTINCT_RATIO:
+                return REASON_REPETITION
+        if self.require_chinese and len(text) >= GUARD_LANGUAGE_WINDOW:
+            window = text[-GUARD_LANGUAGE_WINDOW:]
+            cjk = sum(1 for ch in window if _is_cjk(ch))
+            latin = sum(1 for ch in window if ch.isascii() and ch.isalpha())
+            if cjk + latin and cjk / (cjk + latin) < GUARD_MIN_CJK_RATIO:
+                return REASON_LANGUAGE
+        return None
+
+
+def guard_for_step(step_key: str) -> Optional[RunawayGuard]:
+    """
+    中文正文步骤的失控检测器；JSON 步骤或关闭 GENERATION_GUARD 时返回 None（不使用流式）。
+    字符上限取 WORKFLOW_CONFIG 中该步骤的 max_chars，缺省为 GUARD_MAX_CHARS。
+    """
+    cfg = load_server_config()
+    step_config = WORKFLOW_CONFIG.get(step_key, {})
+    if not cfg["generation_guard"] or step_config.get("json_mode"):
+        return None
+    return RunawayGuard(step_config.get("max_chars") or cfg["guard_max_chars"])
+
+
+def trim_runaway(text: str, reason: str) -> str:
+    """
+    重试后仍失控时保留可用部分：重复内容截到循环首次出现处，其余情况截到最后一个完整句子。
+    """
+    if reason == REASON_REPETITION and len(text) > GUARD_TRIM_PROBE * 2:
+        # 结尾片段首次与第二次出现的位置相差一个循环周期：截到第二次出现处即只保留一遍循环内容
+        probe = text[-GUARD_TRIM_PROBE:]
+        first = text.find(probe)
+        second = text.find(probe, first + 1)
+        if 0 <= first < second:
+            text = text[:second]
+    ends = [m.end() for m in _SENTENCE_END_RE.finditer(text)]
+    return text[:ends[-1]].rstrip() if ends else text
@@ -0,0 +1,177 @@
+import copy
+import queue
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from config import load_server_config
+
+# 每个 (端点, 步骤) 保留的最近调用耗时样本数
+HEDGE_LATENCY_SAMPLES = 200
+# 样本不足时不对冲（分位数不可信）
+HEDGE_MIN_SAMPLES = 20
+# 对冲预算可累积的上限（次）：空闲期攒下的额度不会在过载时集中花掉
+HEDGE_BUDGET_BURST = 5.0
+
+_STEP_SUFFIX_RE = re.compile(r"_\d+(?:_fix_\d+)?$")
+
+
+def hedge_key(endpoint: str, tag: str) -> str:
+    """同一步骤的逐项调用（implementation_detail_3、drawings_code_2_fix_1）共用一组耗时统计。"""
+    return f"{endpoint}|{_STEP_SUFFIX_RE.sub('', tag)}"
+
+
+class HedgePolicy:
+    """
+    进程级对冲策略：按 (端点, 步骤) 记录调用耗时，超过其分位数仍未返回时允许发出一次对冲请求。
+    对冲预算为令牌桶：每次普通调用累积 budget_ratio 次额度，每次对冲消耗 1 次，
+    因此对冲带来的额外调用不超过普通调用的 budget_ratio 比例。
+    """
+
+    def __init__(self, quantile: float, budget_ratio: float, min_delay_s: float):
+        self.quantile = quantile
+        self.budget_ratio = budget_ratio
+        self.min_delay_s = min_delay_s
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._credits = 1.0
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "primary_wins": 0, "denied_budget": 0}
+
+    def record(self, key: str, elapsed_s: float):
+        with self._lock:
+            self._latencies.setdefault(key, deque(maxlen=HEDGE_LATENCY_SAMPLES)).append(elapsed_s)
+            self.stats["calls"] += 1
+            self._credits = min(HEDGE_BUDGET_BURST, self._credits + self.budget_ratio)
+
+    def delay_for(self, key: str) -> Optional[float]:
+        """该步骤的对冲触发时刻（秒）；样本不足时返回 None。"""
+        with self._lock:
+            samples = self._latencies.get(key)
+            if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(samples)
+        return max(self.min_delay_s, ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))])
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._credits < 1.0:
+                self.stats["denied_budget"] += 1
+                return False
+            self._credits -= 1.0
+            self.stats["hedged"] += 1
+            return True
+
+    def record_outcome(self, winner: str):
+        with self._lock:
+            self.stats["hedge_wins" if winner == "hedge" else "primary_wins"] += 1
+
+
+_POLICY: Optional[HedgePolicy] = None
+_POLICY_LOCK = threading.Lock()
+
+
+def get_hedge_policy() -> Optional[HedgePolicy]:
+    """返回进程级对冲策略；未开启 HEDGE_ENABLED 时返回 None。"""
+    global _POLICY
+    cfg = load_server_config()
+    if not cfg["hedge_enabled"]:
+        return None
+    with _POLICY_LOCK:
+        if _POLICY is None:
+            _POLICY = HedgePolicy(cfg["hedge_quantile"], cfg["hedge_budget_ratio"], cfg["hedge_min_delay_s"])
+        return _POLICY
+
+
+def hedge_client_for(llm_client):
+    """对冲请求使用的客户端：配置了 HEDGE_PROVIDER / HEDGE_MODEL 时切换到备用提供商或模型，否则沿用原客户端。"""
+    cfg = load_server_config()
+    if not (cfg["hedge_provider"] or cfg["hedge_model"]):
+        return llm_client
+    from llm_client import get_llm_client
+
+    config = copy.deepcopy(llm_client.full_config)
+    provider = cfg["hedge_provider"] or llm_client.provider
+    config["provider"] = provider
+    if cfg["hedge_model"]:
+        config.setdefault(provider, {})["model"] = cfg["hedge_model"]
+    return get_llm_client(config)
+
+
+def race(primary: Callable[[], Any], hedge: Optional[Callable[[], Any]], delay_s: Optional[float],
+         poll_s: float, check: Optional[Callable[[], None]] = None,
+         may_hedge: Optional[Callable[[], bool]] = None, thread_name: str = "llm-call",
+         on_late_primary: Optional[Callable[[float], None]] = None) -> Tuple[Any, Dict[str, Any]]:
+    """
+    在辅助线程中执行 primary；到 delay_s 仍未返回且 may_hedge() 允许时，再发出 hedge。
+    先成功返回者胜出，另一请求被放弃（其结果不再使用）；两者都失败时抛出先发请求的异常。
+    check 在等待期间每 poll_s 秒调用一次（用于任务取消与时限）。
+    对冲胜出后，被放弃的 primary 若最终成功，以其实际耗时调用 on_late_primary（可能在返回之后）。
+    返回 (响应, 对冲信息)。
+    """
+    results: "queue.Queue[Tuple[str, Any, Optional[BaseException]]]" = queue.Queue()
+    # primary 的实际耗时与胜出方在两个线程间交接：先到的一方留下记录，后到的一方调用 on_late_primary
+    late = {"primary_s": None, "hedge_won": False}
+    late_lock = threading.Lock()
+
+    def primary_done(elapsed_s: float):
+        with late_lock:
+            late["primary_s"] = elapsed_s
+            report = late["hedge_won"]
+        if report and on_late_primary is not None:
+            on_late_primary(elapsed_s)
+
+    def run(name: str, fn: Callable[[], Any]):
+        run_started = time.perf_counter()
+        try:
+            response = fn()
+        except BaseException as e:
+            results.put((name, None, e))
+            return
+        results.put((name, response, None))
+        if name == "primary":
+            primary_done(time.perf_counter() - run_started)
+
+    started = time.perf_counter()
+    threading.Thread(target=run, args=("primary", primary), daemon=True, name=thread_name).start()
+    running = 1
+    hedged_at: Optional[float] = None
+    # 到时刻只尝试一次：预算不足或端点饱和时本次调用不再对冲
+    hedge_pending = hedge is not None and delay_s is not None
+    errors: Dict[str, BaseException] = {}
+    while True:
+        wait_s = poll_s
+        if hedge_pending:
+            # 对冲时刻不必等到下一次轮询
+            wait_s = max(0.01, min(poll_s, delay_s - (time.perf_counter() - started)))
+        try:
+            name, response, error = results.get(timeout=wait_s)
+        except queue.Empty:
+            if check is not None:
+                check()
+            elapsed = time.perf_counter() - started
+            if hedge_pending and elapsed >= delay_s:
+                hedge_pending = False
+                if may_hedge is not None and not may_hedge():
+                    continue
+                hedged_at = elapsed
+                running += 1
+                threading.Thread(target=run, args=("hedge", hedge), daemon=True, name=f"{thread_name}-hedge").start()
+            continue
+        running -= 1
+        if error is None:
+            info: Dict[str, Any] = {"hedged": hedged_at is not None}
+            if hedged_at is not None:
+                info.update({"winner": name, "hedge_after_s": round(hedged_at, 3),
+                             "loser_failed": bool(errors)})
+                if name == "hedge" and "primary" not in errors:
+                    with late_lock:
+                        late["hedge_won"] = True
+                        primary_s = late["primary_s"]
+                    if primary_s is not None and on_late_primary is not None:
+                        on_late_primary(primary_s)
+            return response, info
+        errors[name] = error
+        if running == 0:
+            raise errors.get("primary") or error
@@ -0,0 +1,298 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# 后台任务线程池大小（长耗时生成任务数量上限，排队的任务按提交顺序执行）
+JOB_MAX_WORKERS = 4
+# 每个任务保留的最大事件条数
+JOB_EVENTS_MAX = 500
+# 已结束任务在注册表中的保留时长（秒）
+JOB_RETENTION_S = 6 * 3600
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+JOB_FINISHED_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+    """任务被用户取消时在检查点抛出。"""
+
+
+class JobDeadlineExceeded(JobCancelled):
+    """任务超出时限时在检查点抛出（按取消处理）。"""
+
+
+def current_job() -> Optional["Job"]:
+    """返回当前线程正在执行的后台任务；在脚本线程中返回 None。"""
+    return getattr(_local, "job", None)
+
+
+def current_session_id() -> Optional[str]:
+    """返回当前脚本线程所属会话的ID。"""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+
+def bind_context(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    包装 fn，使其在辅助线程中执行时沿用当前线程的会话上下文与所属后台任务
+    （用于并行调用：st.session_state 读写、取消与时限检查照常生效）。
+    """
+    ctx = get_script_run_ctx()
+    job = current_job()
+
+    def wrapper(*args, **kwargs):
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        _local.job = job
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.job = None
+
+    return wrapper
+
+
+class Job:
+    """
+    一个在脚本线程之外运行的生成任务。
+    任务通过 emit 记录进度事件供 UI 轮询，通过 completed_steps 支持取消后续跑。
+    deadline_s 为任务开始运行后的时限（秒），超出后与取消一样在下一个检查点停止。
+    """
+
+    def __init__(self, kind: str, label: str, fn: Callable[["Job"], Any], session_id: Optional[str],
+                 steps: Optional[List[str]] = None, completed_steps: Optional[List[str]] = None,
+                 snapshot_fn: Optional[Callable[[], Dict[str, Any]]] = None, owner: Optional[str] = None,
+                 deadline_s: Optional[float] = None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.label = label
+        self.fn = fn
+        self.session_id = session_id
+        self.owner = owner
+        self.steps = list(steps or [])
+        self.completed_steps: List[str] = list(completed_steps or [])
+        self.snapshot_fn = snapshot_fn
+        self.snapshot: Optional[Dict[str, Any]] = None
+        self.status = JOB_QUEUED
+        self.error: Optional[str] = None
+        self.progress = 0.0
+        # 本任务中模型调用消耗的 token（估算值，由 call_llm 累加）
+        self.tokens_used = 0
+        self.events: List[Dict[str, Any]] = []
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.resumed_from: Optional[str] = None
+        self.deadline_s = deadline_s or None
+        self.deadline: Optional[float] = None
+        # "user"（用户取消）、"deadline"（超出时限）或 "budget"（草稿 token 预算用尽）
+        self.cancel_reason: Optional[str] = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._update_progress()
+
+    # --- 进度与事件 ---
+
+    def emit(self, level: str, message: str, progress: Optional[float] = None):
+        with self._lock:
+            if progress is not None:
+                self.progress = max(0.0, min(1.0, progress))
+            self.events.append({"ts": time.time(), "level": level, "message": message, "progress": self.progress})
+            if len(self.events) > JOB_EVENTS_MAX:
+                del self.events[: len(self.events) - JOB_EVENTS_MAX]
+
+    def events_tail(self, n: int = 20) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self.events[-n:])
+
+    def problems(self) -> List[Dict[str, Any]]:
+        """任务过程中发出的警告与错误事件（如模型输出无法解析），任务结束后需要展示给用户。"""
+        with self._lock:
+            return [e for e in self.events if e["level"] in ("warning", "error")]
+
+    def is_step_done(self, step: str) -> bool:
+        return step in self.completed_steps
+
+    def mark_step_done(self, step: str):
+        with self._lock:
+            if step not in self.completed_steps:
+                self.completed_steps.append(step)
+            self._update_progress()
+
+    def _update_progress(self):
+        if self.steps:
+            done = len([s for s in self.steps if s in self.completed_steps])
+            self.progress = done / len(self.steps)
+
+    # --- 取消 ---
+
+    def cancel(self):
+        if self._cancel_event.is_set():
+            return
+        self.cancel_reason = self.cancel_reason or "user"
+        self._cancel_event.set()
+        self.emit("warning", "已请求取消，正在中止进行中的调用。")
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def remaining_s(self) -> Optional[float]:
+        """距时限的剩余秒数；未设时限（或尚未开始）时返回 None。"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def check_cancelled(self):
+        """
+        在步骤之间、排队与等待模型返回时调用。
+        已请求取消时抛出 JobCancelled；超出时限时抛出 JobDeadlineExceeded。
+        """
+        if self.deadline is not None and not self._cancel_event.is_set() and time.time() >= self.deadline:
+            self.cancel_reason = "deadline"
+            self._cancel_event.set()
+            self.emit("warning", f"任务超出时限（{int(self.deadline_s)} 秒），正在中止。")
+        if self._cancel_event.is_set():
+            if self.cancel_reason == "deadline":
+                raise JobDeadlineExceeded(self.id)
+            raise JobCancelled(self.id)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in JOB_FINISHED_STATES
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "label": self.label,
+            "owner": self.owner,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "completed_steps": list(self.completed_steps),
+            "error": self.error,
+            "deadline_s": self.deadline_s,
+            "cancel_reason": self.cancel_reason,
+        }
+
+
+class JobRunner:
+    """
+    进程级后台任务执行器。
+    任务线程绑定提交会话的 ScriptRunContext，因此工作流中的 st.session_state 读写照常生效，
+    且任务生命周期与单次脚本执行（rerun、切换标签页）无关。
+    """
+
+    def __init__(self, max_workers: int = JOB_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="patent-job")
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, label: str, fn: Callable[[Job], Any], steps: Optional[List[str]] = None,
+               snapshot_fn: Optional[Callable[[], Dict[str, Any]]] = None,
+               completed_steps: Optional[List[str]] = None, owner: Optional[str] = None,
+               deadline_s: Optional[float] = None) -> Job:
+        ctx = get_script_run_ctx()
+        job = Job(kind, label, fn, ctx.session_id if ctx else None, steps=steps,
+                  completed_steps=completed_steps, snapshot_fn=snapshot_fn, owner=owner, deadline_s=deadline_s)
+        job.emit("info", f"任务已提交：{label}")
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, ctx)
+        return job
+
+    def resume(self, job_id: str) -> Optional[Job]:
+        """以原任务已完成的步骤为起点，在当前会话中重新提交一个任务。"""
+        old = self.get(job_id)
+        if old is None or not old.finished or old.status == JOB_DONE:
+            return None
+        job = self.submit(old.kind, old.label, old.fn, steps=old.steps,
+                          snapshot_fn=old.snapshot_fn, completed_steps=old.completed_steps, owner=old.owner,
+                          deadline_s=old.deadline_s)
+        job.resumed_from = old.id
+        job.emit("info", f"从任务 {old.id} 续跑，已跳过 {len(old.completed_steps)} 个完成步骤。")
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel()
+        return True
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> List[Job]:
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created_at)
+
+    def _prune(self):
+        now = time.time()
+        expired = [jid for jid, j in self._jobs.items()
+                   if j.finished and j.finished_at and now - j.finished_at > JOB_RETENTION_S]
+        for jid in expired:
+            del self._jobs[jid]
+
+    def _run(self, job: Job, ctx):
+        # 线程池线程会被复用：每个任务开始时重新绑定其提交会话的上下文
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        _local.job = job
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        if job.deadline_s:
+            job.deadline = job.started_at + job.deadline_s
+        job.emit("info", f"任务开始：{job.label}")
+        final_status = JOB_DONE
+        try:
+            job.check_cancelled()
+            job.fn(job)
+            job.emit("success", f"任务完成：{job.label}", progress=1.0)
+        except JobDeadlineExceeded:
+            final_status = JOB_CANCELLED
+            job.emit("warning", f"任务超出时限已中止，已完成 {len(job.completed_steps)} 个步骤。")
+        except JobCancelled:
+            final_status = JOB_CANCELLED
+            job.emit("warning", f"任务已取消，已完成 {len(job.completed_steps)} 个步骤。")
+        except Exception as e:
+            final_status = JOB_FAILED
+            job.error = str(e)
+            job.emit("error", f"任务失败：{e}")
+        finally:
+            # 先保存快照再公布结束状态，保证 UI 看到结束时快照已就绪
+            if job.snapshot_fn is not None:
+                try:
+                    job.snapshot = job.snapshot_fn()
+                except Exception as e:
+                    job.emit("warning", f"保存任务状态快照失败：{e}")
+            job.finished_at = time.time()
+            job.status = final_status
+            _local.job = None
+
+
+_RUNNER: Optional[JobRunner] = None
+_RUNNER_LOCK = threading.Lock()
+
+
+def get_job_runner() -> JobRunner:
+    """返回进程级共享的 JobRunner（所有会话共用）。"""
+    global _RUNNER
+    with _RUNNER_LOCK:
+        if _RUNNER is None:
+            _RUNNER = JobRunner()
+        return _RUNNER
@@ -1,100 +1,402 @@
-import openai
-import httpx
-import os
-from typing import List, Dict
-from google import genai
-import os
-from langchain.chat_models import init_chat_model
-
-# model = init_chat_model(
-#     "azure_openai:gpt-5",
-#     azure_deployment=os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"],
-# )
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterator, List, Dict, Optional, Tuple
+
+# 各提供商 SDK（openai / httpx / google-genai / langchain）体积较大，
+# 仅在所选提供商首次构建客户端时按需导入，以缩短应用冷启动时间。
+
+# 统一的结束原因：正常结束 / 达到输出上限被截断
+FINISH_STOP = "stop"
+FINISH_LENGTH = "length"
+# 流式生成时每新增这么多字符检查一次失控
+STREAM_CHECK_CHARS = 200
+
+
+class GenerationAborted(Exception):
+    """流式生成被失控检测中止；partial 为中止前已生成的文本。"""
+
+    def __init__(self, reason: str, partial: str):
+        super().__init__(f"生成已中止：{reason}")
+        self.reason = reason
+        self.partial = partial
 
 class LLMClient:
-    """一个统一的、简化的LLM客户端，支持OpenAI兼容接口和Google Gemini，并统一处理代理。"""
+    """
+    一个统一的、简化的LLM客户端，支持OpenAI兼容接口、Azure 与 Google Gemini。
+    代理只作用于本客户端自己的 HTTP 传输层，不修改进程级环境变量，
+    因此不同会话、不同代理配置的客户端可以并发使用。
+    """
     def __init__(self, config: dict):
         self.full_config = config
         self.provider = config.get("provider", "openai")
         provider_cfg = config.get(self.provider, {})
-        
-        proxy_url = provider_cfg.get("proxy_url")
+
+        self.proxy_url = provider_cfg.get("proxy_url") or None
         self.model = provider_cfg.get("model")
+        # 并发自适应按端点区分：同一地址上的同一模型共享限流额度
+        self.endpoint = f"{self.provider}:{provider_cfg.get('api_base') or ''}:{self.model or ''}"
         api_key = provider_cfg.get("api_key")
+        # 本客户端自有的 HTTP 连接池，close() 时释放（Gemini 由其 SDK 自行管理）
+        self._http_client = None
 
         if self.provider == "google":
-            if proxy_url:
-                os.environ["HTTP_PROXY"] = proxy_url
-                os.environ["HTTPS_PROXY"] = proxy_url
-            else:
-                if "HTTP_PROXY" in os.environ:
-                    del os.environ["HTTP_PROXY"]
-                if "HTTPS_PROXY" in os.environ:
-                    del os.environ["HTTPS_PROXY"]
-            self.client = genai.Client(api_key=api_key)
-        if self.provider == "azure":
-            if proxy_url:
-                os.environ["HTTP_PROXY"] = proxy_url
-                os.environ["HTTPS_PROXY"] = proxy_url
-            else:
-                if "HTTP_PROXY" in os.environ:
-                    del os.environ["HTTP_PROXY"]
-                if "HTTPS_PROXY" in os.environ:
-                    del os.environ["HTTPS_PROXY"]
+            from google import genai
+            self._genai_types = genai.types
+            http_options = None
+            if self.proxy_url:
+                http_options = genai.types.HttpOptions(
+                    client_args={"proxy": self.proxy_url},
+                    async_client_args={"proxy": self.proxy_url},
+                )
+            self.client = genai.Client(api_key=api_key, http_options=http_options)
+        elif self.provider == "azure":
+            import httpx
+            from langchain.chat_models import init_chat_model
+            self._http_client = httpx.Client(proxy=self.proxy_url)
             self.client = init_chat_model(
-                "azure_openai:gpt-5",
-                azure_deployment=os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"],
+                f"azure_openai:{self.model}",
+                azure_deployment=self.model,
+                azure_endpoint=provider_cfg.get("api_base") or None,
+                api_key=api_key or None,
+                api_version=provider_cfg.get("api_version") or None,
+                http_client=self._http_client,
                 temperature=0.1,
             )
         else:  # openai 兼容
-            http_client = httpx.Client(proxy=proxy_url or None)
+            import httpx
+            import openai
+            self._http_client = httpx.Client(proxy=self.proxy_url)
             self.client = openai.OpenAI(
                 api_key=api_key,
                 base_url=provider_cfg.get("api_base", ""),
-                http_client=http_client,
+                http_client=self._http_client,
             )
 
-    def call(self, messages: List[Dict], json_mode: bool = False) -> str:
-        """根据提供商调用相应的LLM API"""
+    def close(self):
+        """释放本客户端的连接池。"""
+        try:
+            if self._http_client is not None:
+                self._http_client.close()
+            elif self.provider == "google" and hasattr(self.client, "close"):
+                self.client.close()
+        except Exception:
+            pass
+
+    def __del__(self):
+        # 注册表淘汰时不主动关闭：运行中的任务或对冲仍可能持有本客户端，最后一个引用释放时才关闭连接池
+        self.close()
+
+    def call(self, messages: List[Dict], json_mode: bool = False, timeout: Optional[float] = None) -> str:
+        """根据提供商调用相应的LLM API；timeout（秒）为本次 HTTP 请求的超时，缺省使用 SDK 默认值。"""
+        return self.call_with_finish(messages, json_mode=json_mode, timeout=timeout)[0]
+
+    def call_with_finish(self, messages: List[Dict], json_mode: bool = False, timeout: Optional[float] = None,
+                         max_tokens: Optional[int] = None,
+                         guard: Optional[Callable[[str], Optional[str]]] = None) -> Tuple[str, str]:
+        """
+        调用模型并返回 (文本, 结束原因)。结束原因统一为 FINISH_STOP、FINISH_LENGTH（达到输出上限被截断）
+        或提供商原始值的小写形式；max_tokens 为本次输出上限，缺省使用提供商默认值。
+        提供 guard 时改为流式生成：每新增 STREAM_CHECK_CHARS 个字符以已生成文本调用 guard，
+        返回失控原因时关闭流并抛出 GenerationAborted，不再为后续输出付费。
+        """
+        if guard is not None:
+            return self._call_streaming(messages, json_mode, timeout, max_tokens, guard)
         if self.provider == "azure":
             extra_params = {"response_format": {"type": "json_object"}} if json_mode else {}
+            if timeout is not None:
+                extra_params["timeout"] = timeout
+            if max_tokens:
+                extra_params["max_tokens"] = max_tokens
             response = self.client.invoke(messages, **extra_params)
-            return response.content
+            finish = (getattr(response, "response_metadata", None) or {}).get("finish_reason")
+            return response.content, _normalize_finish(finish)
         elif self.provider == "google":
-            generation_config_params = {}
-            generation_config_params["temperature"] = 0.1
-            generation_config_params["top_p"] = 0.1
-            if json_mode:
-                generation_config_params["response_mime_type"] = "application/json"
-            config = genai.types.GenerateContentConfig(**generation_config_params)
+            params = self._google_config_params(json_mode)
+            if timeout is not None:
+                params["http_options"] = self._genai_types.HttpOptions(timeout=max(1, int(timeout * 1000)))
+            if max_tokens:
+                params["max_output_tokens"] = max_tokens
+            config = self._genai_types.GenerateContentConfig(**params)
             response = self.client.models.generate_content(
                 model=self.model, 
                 config=config,
-                contents=messages[0]["content"],
+                contents=_google_contents(messages),
             )
-            
-            raw_text = response.text
-            if json_mode:
-                # 查找第一个 '{' 和最后一个 '}' 来提取潜在的JSON字符串,这可以处理模型返回被markdown代码块包裹或带有前缀文本的JSON
-                start = raw_text.find('{')
-                end = raw_text.rfind('}')
-                if start != -1 and end != -1 and start < end:
-                    return raw_text[start:end+1]
-            return raw_text
+            candidates = response.candidates or []
+            finish = _normalize_finish(getattr(candidates[0].finish_reason, "name", None) if candidates else None)
+            text = response.text or ""
+            # 截断的 JSON 不做提取：保留原文供续写与修复
+            return (_extract_json(text) if json_mode and finish != FINISH_LENGTH else text), finish
         else: # openai 兼容
-            extra_params = {"response_format": {"type": "json_object"}} if json_mode else {}
-            
-            # 检查是否存在非标准的 `enable_thinking` 参数，并将其设置为 False
-            # 使用 extra_body 来传递非标准参数，以避免库验证错误
-            extra_body = {}
-            extra_body["enable_thinking"] = False
+            # 使用 extra_body 来传递非标准参数（enable_thinking=False），以避免库验证错误
+            params = self._openai_request_body(messages, json_mode)
+            extra_body = {"enable_thinking": params.pop("enable_thinking")}
+            if timeout is not None:
+                params["timeout"] = timeout
+            if max_tokens:
+                params["max_tokens"] = max_tokens
+            response = self.client.chat.completions.create(extra_body=extra_body, **params)
+            choice = response.choices[0]
+            return choice.message.content, _normalize_finish(choice.finish_reason)
 
-            response = self.client.chat.completions.create(
+    def _call_streaming(self, messages: List[Dict], json_mode: bool, timeout: Optional[float],
+                        max_tokens: Optional[int], guard: Callable[[str], Optional[str]]) -> Tuple[str, str]:
+        parts: List[str] = []
+        size = checked = 0
+        finish = None
+        chunks = self._stream_chunks(messages, json_mode, timeout, max_tokens)
+        try:
+            for delta, reason in chunks:
+                if delta:
+                    parts.append(delta)
+                    size += len(delta)
+                if reason:
+                    finish = reason
+                if size - checked >= STREAM_CHECK_CHARS:
+                    checked = size
+                    problem = guard("".join(parts))
+                    if problem:
+                        raise GenerationAborted(problem, "".join(parts))
+        finally:
+            # 关闭生成器即关闭底层 HTTP 流
+            chunks.close()
+        text = "".join(parts)
+        finish = _normalize_finish(finish)
+        if self.provider == "google" and json_mode and finish != FINISH_LENGTH:
+            text = _extract_json(text)
+        return text, finish
+
+    def _stream_chunks(self, messages: List[Dict], json_mode: bool, timeout: Optional[float],
+                       max_tokens: Optional[int]) -> Iterator[Tuple[str, Optional[str]]]:
+        """逐块产出 (新增文本, 结束原因或 None)。"""
+        if self.provider == "azure":
+            extra_params = {"response_format": {"type": "json_object"}} if json_mode else {}
+            if timeout is not None:
+                extra_params["timeout"] = timeout
+            if max_tokens:
+                extra_params["max_tokens"] = max_tokens
+            for chunk in self.client.stream(messages, **extra_params):
+                yield chunk.content or "", (getattr(chunk, "response_metadata", None) or {}).get("finish_reason")
+        elif self.provider == "google":
+            params = self._google_config_params(json_mode)
+            if timeout is not None:
+                params["http_options"] = self._genai_types.HttpOptions(timeout=max(1, int(timeout * 1000)))
+            if max_tokens:
+                params["max_output_tokens"] = max_tokens
+            stream = self.client.models.generate_content_stream(
                 model=self.model,
-                temperature=0.1,
-                top_p=0.1,
-                messages=messages,
-                extra_body=extra_body,
-                **extra_params,
+                config=self._genai_types.GenerateContentConfig(**params),
+                contents=_google_contents(messages),
             )
-            return response.choices[0].message.content
+            for response in stream:
+                candidates = response.candidates or []
+                reason = candidates[0].finish_reason if candidates else None
+                yield response.text or "", getattr(reason, "name", None)
+        else:
+            params = self._openai_request_body(messages, json_mode)
+            extra_body = {"enable_thinking": params.pop("enable_thinking")}
+            if timeout is not None:
+                params["timeout"] = timeout
+            if max_tokens:
+                params["max_tokens"] = max_tokens
+            stream = self.client.chat.completions.create(extra_body=extra_body, stream=True, **params)
+            try:
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    yield choice.delta.content or "", choice.finish_reason
+            finally:
+                stream.close()
+
+    def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        """文本向量化（用于现有技术检索的向量重排）；Azure 通道暂不支持。"""
+        if self.provider == "google":
+            result = self.client.models.embed_content(model=model, contents=texts)
+            return [e.values for e in result.embeddings]
+        elif self.provider == "azure":
+            raise RuntimeError("Azure 通道暂不支持向量嵌入")
+        else:
+            response = self.client.embeddings.create(model=model, input=texts)
+            return [d.embedding for d in response.data]
+
+    # --- 请求参数（实时调用与批量调用共用） ---
+
+    def _google_config_params(self, json_mode: bool) -> dict:
+        params = {"temperature": 0.1, "top_p": 0.1}
+        if json_mode:
+            params["response_mime_type"] = "application/json"
+        return params
+
+    def _openai_request_body(self, messages: List[Dict], json_mode: bool) -> dict:
+        body = {
+            "model": self.model,
+            "temperature": 0.1,
+            "top_p": 0.1,
+            "messages": messages,
+            "enable_thinking": False,
+        }
+        if json_mode:
+            body["response_format"] = {"type": "json_object"}
+        return body
+
+    # --- 批量接口 ---
+    # 请求格式：[{"custom_id": str, "messages": [...], "json_mode": bool}]
+    # 结果格式：{custom_id: {"content": str 或 None, "error": str 或 None}}
+
+    def supports_batch(self) -> bool:
+        return self.provider in ("openai", "google")
+
+    def batch_submit(self, requests: List[Dict], display_name: str = "patent-batch") -> str:
+        """提交一个提供商批量任务，返回批次ID。"""
+        if self.provider == "google":
+            inlined = [
+                {
+                    "contents": [{"role": "user", "parts": [{"text": r["messages"][0]["content"]}]}],
+                    "config": self._google_config_params(r.get("json_mode", False)),
+                    "metadata": {"custom_id": r["custom_id"], "json_mode": "1" if r.get("json_mode") else ""},
+                }
+                for r in requests
+            ]
+            job = self.client.batches.create(model=self.model, src=inlined, config={"display_name": display_name})
+            return job.name
+        if self.provider == "openai":
+            lines = [
+                json.dumps({
+                    "custom_id": r["custom_id"],
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": self._openai_request_body(r["messages"], r.get("json_mode", False)),
+                }, ensure_ascii=False)
+                for r in requests
+            ]
+            uploaded = self.client.files.create(
+                file=(f"{display_name}.jsonl", "\n".join(lines).encode("utf-8"), "application/jsonl"),
+                purpose="batch",
+            )
+            batch = self.client.batches.create(
+                input_file_id=uploaded.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+                metadata={"display_name": display_name},
+            )
+            return batch.id
+        raise ValueError(f"提供商 {self.provider} 不支持批量接口")
+
+    def batch_status(self, batch_id: str) -> str:
+        """返回批次状态：pending / completed / failed。"""
+        if self.provider == "google":
+            state = self.client.batches.get(name=batch_id).state.name
+            if state in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+                return "completed"
+            if state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+                return "failed"
+            return "pending"
+        if self.provider == "openai":
+            status = self.client.batches.retrieve(batch_id).status
+            if status == "completed":
+                return "completed"
+            if status in ("failed", "expired", "cancelled"):
+                return "failed"
+            return "pending"
+        raise ValueError(f"提供商 {self.provider} 不支持批量接口")
+
+    def batch_results(self, batch_id: str) -> Dict[str, Dict]:
+        """读取已完成批次的逐条结果。"""
+        results: Dict[str, Dict] = {}
+        if self.provider == "google":
+            job = self.client.batches.get(name=batch_id)
+            for item in (job.dest.inlined_responses if job.dest else None) or []:
+                meta = item.metadata or {}
+                custom_id = meta.get("custom_id")
+                if item.error is not None or item.response is None:
+                    results[custom_id] = {"content": None, "error": str(item.error)}
+                    continue
+                text = item.response.text
+                results[custom_id] = {"content": _extract_json(text) if meta.get("json_mode") else text, "error": None}
+            return results
+        if self.provider == "openai":
+            batch = self.client.batches.retrieve(batch_id)
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                for line in self.client.files.content(file_id).text.splitlines():
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    response = record.get("response") or {}
+                    if record.get("error") or response.get("status_code", 200) != 200:
+                        results[record["custom_id"]] = {"content": None, "error": json.dumps(record.get("error") or response.get("body"), ensure_ascii=False)}
+                    else:
+                        results[record["custom_id"]] = {"content": response["body"]["choices"][0]["message"]["content"], "error": None}
+            return results
+        raise ValueError(f"提供商 {self.provider} 不支持批量接口")
+
+
+def _normalize_finish(reason: Optional[str]) -> str:
+    """统一各提供商的结束原因：OpenAI/Azure 的 length 与 Gemini 的 MAX_TOKENS 均为 FINISH_LENGTH。"""
+    reason = (reason or FINISH_STOP).lower()
+    if reason in ("length", "max_tokens"):
+        return FINISH_LENGTH
+    if reason in ("stop", "end_turn", "finish_reason_unspecified"):
+        return FINISH_STOP
+    return reason
+
+
+def _google_contents(messages: List[Dict]):
+    """单条消息直接传文本；多轮（如续写）转为 Gemini 的 user/model 对话内容。"""
+    if len(messages) == 1:
+        return messages[0]["content"]
+    return [
+        {"role": "model" if m.get("role") == "assistant" else "user", "parts": [{"text": m.get("content", "")}]}
+        for m in messages
+    ]
+
+
+def _extract_json(raw_text: str) -> str:
+    """查找第一个 '{' 和最后一个 '}' 来提取潜在的JSON字符串,这可以处理模型返回被markdown代码块包裹或带有前缀文本的JSON"""
+    start = raw_text.find('{')
+    end = raw_text.rfind('}')
+    if start != -1 and end != -1 and start < end:
+        return raw_text[start:end+1]
+    return raw_text
+
+
+# -------------- 进程级客户端注册表 --------------
+# 相同提供商、地址、密钥与代理的会话共享同一个客户端，从而复用已建立的连接。
+# 注册表按最近使用保留 CLIENT_REGISTRY_MAX 个客户端；被淘汰的客户端在其他持有者（运行中的任务、
+# 对冲请求）都释放后关闭连接池，配置或密钥变更后旧客户端不会一直占用连接。
+
+CLIENT_REGISTRY_MAX = 16
+
+_CLIENT_REGISTRY: "OrderedDict[Tuple[str, ...], LLMClient]" = OrderedDict()
+_REGISTRY_LOCK = threading.Lock()
+
+def client_registry_key(config: dict) -> Tuple[str, ...]:
+    """(provider, api_base, api_key 哈希, proxy, model, api_version)；密钥只以哈希形式出现。"""
+    provider = config.get("provider", "openai")
+    provider_cfg = config.get(provider, {})
+    key_hash = hashlib.sha256((provider_cfg.get("api_key") or "").encode("utf-8")).hexdigest()[:16]
+    return (
+        provider,
+        provider_cfg.get("api_base") or "",
+        key_hash,
+        provider_cfg.get("proxy_url") or "",
+        provider_cfg.get("model") or "",
+        provider_cfg.get("api_version") or "",
+    )
+
+def get_llm_client(config: dict) -> LLMClient:
+    """从进程级注册表获取（必要时创建）与配置对应的 LLMClient。"""
+    key = client_registry_key(config)
+    with _REGISTRY_LOCK:
+        client = _CLIENT_REGISTRY.get(key)
+        if client is None:
+            client = LLMClient(dict(config))
+            _CLIENT_REGISTRY[key] = client
+        _CLIENT_REGISTRY.move_to_end(key)
+        while len(_CLIENT_REGISTRY) > CLIENT_REGISTRY_MAX:
+            _CLIENT_REGISTRY.popitem(last=False)
+    return client
@@ -0,0 +1,93 @@
+import json
+from typing import Optional
+
+# 续写拼接时检查的最大重叠长度（模型续写时常会重复上文结尾的几个字）
+STITCH_MAX_OVERLAP = 200
+# 重叠少于此长度时不去重，避免误删恰好与上文结尾相同的正常内容
+STITCH_MIN_OVERLAP = 3
+# 修复截断 JSON 时最多回退到前面多少个逗号处
+JSON_REPAIR_MAX_CUTS = 20
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def strip_code_fence(text: str) -> str:
+    """去掉模型输出首尾的 Markdown 代码块标记（```json ... ```）。"""
+    text = (text or "").strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+    if text.endswith("```"):
+        text = text[:-3]
+    return text
+
+
+def stitch_continuation(previous: str, continuation: str) -> str:
+    """把续写内容接到已输出内容之后：去掉续写开头与上文结尾重复的部分，保证拼接处无重复。"""
+    if not continuation:
+        return previous
+    limit = min(STITCH_MAX_OVERLAP, len(previous), len(continuation))
+    for size in range(limit, STITCH_MIN_OVERLAP - 1, -1):
+        if previous.endswith(continuation[:size]):
+            return previous + continuation[size:]
+    return previous + continuation
+
+
+def is_valid_json(text: str) -> bool:
+    try:
+        json.loads(strip_code_fence(text))
+        return True
+    except (json.JSONDecodeError, TypeError):
+        return False
+
+
+def _close_json(fragment: str) -> str:
+    """补全被截断的 JSON 片段：闭合未结束的字符串，去掉末尾悬空的逗号，再按嵌套顺序补齐括号。"""
+    stack = []
+    in_string = False
+    escaped = False
+    for ch in fragment:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+        elif ch in "}]" and stack:
+            stack.pop()
+    if in_string:
+        if escaped:
+            fragment = fragment[:-1]
+        fragment += '"'
+    fragment = fragment.rstrip()
+    if fragment.endswith(","):
+        fragment = fragment[:-1]
+    return fragment + "".join(reversed(stack))
+
+
+def repair_truncated_json(text: str) -> Optional[str]:
+    """
+    修复在结构中途被截断的 JSON：先直接补全；仍无法解析时逐个回退到前一个逗号处
+    （丢弃最后一个不完整的成员）再补全。无法修复时返回 None。
+    """
+    text = strip_code_fence(text)
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        return None
+    candidate = text[min(starts):]
+    for _ in range(JSON_REPAIR_MAX_CUTS):
+        closed = _close_json(candidate)
+        try:
+            json.loads(closed)
+            return closed
+        except json.JSONDecodeError:
+            pass
+        cut = candidate.rfind(",")
+        if cut <= 0:
+            break
+        candidate = candidate[:cut]
+    return None
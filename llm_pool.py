@@ -0,0 +1,309 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import date
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+from config import load_server_config
+
+# 优先级类别（数值越小越优先）
+PRIORITY_INTERACTIVE = 0   # 用户在界面上单独生成/重生成某一章节
+PRIORITY_FULL_DRAFT = 1    # 一键生成初稿、全局润色等整稿任务
+PRIORITY_BACKGROUND = 2    # 预生成等后台投机任务
+PRIORITY_BATCH = 3         # 批量生成
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_FULL_DRAFT: "full_draft",
+    PRIORITY_BACKGROUND: "background",
+    PRIORITY_BATCH: "batch",
+}
+# 后台任务类型 → 优先级；不在后台任务中的调用视为交互调用
+JOB_KIND_PRIORITY = {
+    "section": PRIORITY_INTERACTIVE,
+    "full_draft": PRIORITY_FULL_DRAFT,
+    "global_refine": PRIORITY_FULL_DRAFT,
+    "speculate": PRIORITY_BACKGROUND,
+    "batch": PRIORITY_BATCH,
+}
+# 老化：排队每满这么多秒，有效优先级提升一级，避免低优先级请求饿死
+PRIORITY_AGING_S = 20.0
+# 每个类别保留最近多少次排队等待时长用于计算分位数
+WAIT_SAMPLES = 200
+# 排队请求带有取消检查时的检查间隔（秒）
+QUEUE_CHECK_S = 0.5
+
+
+class QuotaExceededError(Exception):
+    """用户的 token 配额已用尽。"""
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个计，其余字符按 4 个字符 1 个计。"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "一" <= ch <= "鿿" or "　" <= ch <= "〿" or "＀" <= ch <= "￯")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def priority_for_job_kind(kind: Optional[str]) -> int:
+    """按后台任务类型确定调用的优先级类别（无任务即交互调用）。"""
+    if kind is None:
+        return PRIORITY_INTERACTIVE
+    return JOB_KIND_PRIORITY.get(kind, PRIORITY_FULL_DRAFT)
+
+
+class _Ticket:
+    __slots__ = ("user", "tag", "priority", "enqueued_at", "granted")
+
+    def __init__(self, user: str, tag: str, priority: int, enqueued_at: Optional[float] = None):
+        self.user = user
+        self.tag = tag
+        self.priority = priority
+        self.enqueued_at = enqueued_at or time.time()
+        self.granted = False
+
+    def effective_priority(self, now: float) -> int:
+        return max(PRIORITY_INTERACTIVE, self.priority - int((now - self.enqueued_at) / PRIORITY_AGING_S))
+
+
+class _ClassStats:
+    """单个优先级类别的排队等待统计。"""
+
+    def __init__(self):
+        self.granted = 0
+        self.total_wait_s = 0.0
+        self.max_wait_s = 0.0
+        self.recent: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+    def record(self, waited_s: float):
+        self.granted += 1
+        self.total_wait_s += waited_s
+        self.max_wait_s = max(self.max_wait_s, waited_s)
+        self.recent.append(waited_s)
+
+    def percentile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _UserState:
+    def __init__(self, max_concurrency: int, token_quota: int):
+        self.max_concurrency = max_concurrency
+        self.token_quota = token_quota
+        self.queue: Deque[_Ticket] = deque()
+        self.in_flight = 0
+        self.usage_day = date.today()
+        self.tokens_used = 0
+        self.calls = 0
+
+    def roll_day(self):
+        today = date.today()
+        if today != self.usage_day:
+            self.usage_day = today
+            self.tokens_used = 0
+            self.calls = 0
+
+
+class LLMWorkerPool:
+    """
+    进程级 LLM 调用池，所有会话共享。
+    - 全局并发上限 size
+    - 每个用户的并发上限与每日 token 配额
+    - 按优先级类别调度：交互调用先于整稿任务，整稿任务先于后台与批量任务；
+      新到的高优先级请求直接越过排队中的低优先级请求（已在途的调用不受影响）
+    - 老化：排队越久有效优先级越高，低优先级请求不会被无限推迟
+    - 为交互调用保留 interactive_reserve 个槽位，整稿任务无法占满全部并发
+    - 同一有效优先级内，用户之间轮转（round-robin）公平排队：重度用户的积压不会阻塞其他用户
+    """
+
+    def __init__(self, size: int, default_max_concurrency: int, default_token_quota: int, interactive_reserve: int = 0):
+        self.size = size
+        self.default_max_concurrency = default_max_concurrency
+        self.default_token_quota = default_token_quota
+        self.interactive_reserve = min(max(0, interactive_reserve), size - 1)
+        self._class_stats: Dict[int, _ClassStats] = {p: _ClassStats() for p in PRIORITY_NAMES}
+        self._users: Dict[str, _UserState] = {}
+        self._rotation: Deque[str] = deque()
+        self._in_flight: List[Dict[str, Any]] = []
+        self._cond = threading.Condition()
+
+    # --- 用户配置 ---
+
+    def _user(self, user: str) -> _UserState:
+        state = self._users.get(user)
+        if state is None:
+            state = _UserState(self.default_max_concurrency, self.default_token_quota)
+            self._users[user] = state
+            self._rotation.append(user)
+        state.roll_day()
+        return state
+
+    def set_user_limits(self, user: str, max_concurrency: Optional[int] = None, token_quota: Optional[int] = None):
+        """设置用户的并发上限与每日 token 配额（None 表示使用默认值，配额 0 表示不限）。"""
+        with self._cond:
+            state = self._user(user)
+            state.max_concurrency = max_concurrency if max_concurrency else self.default_max_concurrency
+            state.token_quota = token_quota if token_quota is not None else self.default_token_quota
+            self._dispatch()
+
+    # --- 调度 ---
+
+    def _pick(self, now: float) -> Optional[_Ticket]:
+        """
+        选出下一个授予槽位的请求：有效优先级最高者；同级时按用户轮转顺序，
+        用户自己的队列内按有效优先级、再按先来后到。
+        非交互请求不得占用为交互调用保留的槽位（按基础优先级判断：老化只影响排序，不能让积压的整稿、
+        后台与批量请求逐渐占满保留槽位）。
+        """
+        bulk_allowed = len(self._in_flight) < self.size - self.interactive_reserve
+        best: Optional[_Ticket] = None
+        best_rank = None
+        for order, user in enumerate(self._rotation):
+            state = self._users[user]
+            if not state.queue or state.in_flight >= state.max_concurrency:
+                continue
+            for ticket in state.queue:
+                if ticket.priority > PRIORITY_INTERACTIVE and not bulk_allowed:
+                    continue
+                effective = ticket.effective_priority(now)
+                rank = (effective, order, ticket.enqueued_at)
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = ticket, rank
+        return best
+
+    def _dispatch(self):
+        """在全局空闲槽位内，按优先级与用户轮转顺序依次授予排队的请求。"""
+        granted_any = False
+        now = time.time()
+        while len(self._in_flight) < self.size:
+            ticket = self._pick(now)
+            if ticket is None:
+                break
+            state = self._users[ticket.user]
+            state.queue.remove(ticket)
+            # 被选中的用户移到轮转队尾
+            self._rotation.remove(ticket.user)
+            self._rotation.append(ticket.user)
+            ticket.granted = True
+            state.in_flight += 1
+            self._class_stats[ticket.priority].record(now - ticket.enqueued_at)
+            self._in_flight.append({
+                "user": ticket.user, "tag": ticket.tag, "priority": ticket.priority,
+                "started_at": now, "ticket": ticket,
+            })
+            granted_any = True
+        if granted_any:
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, user: str, tag: str = "llm_call", priority: int = PRIORITY_INTERACTIVE,
+             check: Optional[Callable[[], None]] = None, enqueued_at: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """
+        占用一个调用槽位（阻塞直至轮到该请求）。
+        返回的字典用于回填本次调用消耗的 token：slot_info["tokens"] = n；
+        未发出请求即交还槽位时设置 slot_info["requeued"] = True，不计入调用次数。
+        check 在排队期间定期调用，抛出异常即撤出队列并向上抛出（用于任务取消与超时）。
+        enqueued_at 为重新排队时沿用的最初排队时刻（老化与等待统计由此计算）。
+        """
+        with self._cond:
+            state = self._user(user)
+            if state.token_quota and state.tokens_used >= state.token_quota:
+                raise QuotaExceededError(f"用户 {user} 今日 token 配额已用尽（{state.tokens_used}/{state.token_quota}）")
+            ticket = _Ticket(user, tag, priority, enqueued_at)
+            state.queue.append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                # 定时醒来重新调度：老化会改变排队请求的有效优先级
+                if not self._cond.wait(timeout=QUEUE_CHECK_S if check is not None else PRIORITY_AGING_S):
+                    self._dispatch()
+                if check is not None and not ticket.granted:
+                    try:
+                        check()
+                    except BaseException:
+                        state.queue.remove(ticket)
+                        raise
+        slot_info: Dict[str, Any] = {"tokens": 0, "waited_s": round(time.time() - ticket.enqueued_at, 3),
+                                     "requeued": False}
+        try:
+            yield slot_info
+        finally:
+            with self._cond:
+                state = self._user(user)
+                state.in_flight -= 1
+                if not slot_info["requeued"]:
+                    state.calls += 1
+                state.tokens_used += int(slot_info.get("tokens") or 0)
+                self._in_flight = [f for f in self._in_flight if f["ticket"] is not ticket]
+                self._dispatch()
+
+    # --- 监控 ---
+
+    def stats(self) -> Dict[str, Any]:
+        """返回队列深度、在途请求、各用户用量与各优先级类别的排队等待统计，供管理视图展示。"""
+        now = time.time()
+        with self._cond:
+            users = []
+            for name, state in self._users.items():
+                state.roll_day()
+                users.append({
+                    "user": name,
+                    "in_flight": state.in_flight,
+                    "queued": len(state.queue),
+                    "max_concurrency": state.max_concurrency,
+                    "tokens_used": state.tokens_used,
+                    "token_quota": state.token_quota,
+                    "calls": state.calls,
+                })
+            in_flight = [
+                {
+                    "user": f["user"], "tag": f["tag"], "priority": PRIORITY_NAMES[f["priority"]],
+                    "running_s": round(now - f["started_at"], 1),
+                }
+                for f in self._in_flight
+            ]
+            queued_by_class = {p: 0 for p in PRIORITY_NAMES}
+            for state in self._users.values():
+                for ticket in state.queue:
+                    queued_by_class[ticket.priority] += 1
+            classes = []
+            for p, name in PRIORITY_NAMES.items():
+                cs = self._class_stats[p]
+                classes.append({
+                    "class": name,
+                    "queued": queued_by_class[p],
+                    "in_flight": sum(1 for f in self._in_flight if f["priority"] == p),
+                    "granted": cs.granted,
+                    "avg_wait_s": round(cs.total_wait_s / cs.granted, 3) if cs.granted else 0.0,
+                    "p95_wait_s": round(cs.percentile(0.95), 3),
+                    "max_wait_s": round(cs.max_wait_s, 3),
+                })
+            return {
+                "size": self.size,
+                "in_flight": len(self._in_flight),
+                "queue_depth": sum(len(s.queue) for s in self._users.values()),
+                "users": users,
+                "in_flight_calls": in_flight,
+                "classes": classes,
+            }
+
+
+_POOL: Optional[LLMWorkerPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_llm_pool() -> LLMWorkerPool:
+    """返回进程级共享的 LLMWorkerPool（参数来自 load_server_config）。"""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            cfg = load_server_config()
+            _POOL = LLMWorkerPool(
+                size=cfg["llm_pool_size"],
+                default_max_concurrency=cfg["user_max_concurrency"],
+                default_token_quota=cfg["user_token_quota"],
+                interactive_reserve=cfg["interactive_reserved_slots"],
+            )
+        return _POOL
@@ -1,29 +1,70 @@
 import streamlit as st
 import json
+import os
 import time
 from typing import Any
 
 # --- 从模块导入 ---
 import prompts
-from config import UI_SECTION_ORDER, UI_SECTION_CONFIG
-from llm_client import LLMClient
+from config import UI_SECTION_ORDER, UI_SECTION_CONFIG, load_server_config
+from llm_client import LLMClient, get_llm_client
 from state_manager import (
     initialize_session_state,
     get_active_content,
     is_stale,
+    export_draft_state,
+    import_draft_state,
+    version_labels,
+    partial_version_note,
 )
 from ui_components import (
     render_sidebar,
-    render_mermaid_component,
+    render_admin_panel,
+    render_mermaid_gallery,
+    render_mermaid_image,
+    render_prior_art_hits,
+    render_terminology_report,
+    render_claim_structure,
+    render_cost_plan,
     clean_mermaid_code,
 )
 from workflows import (
     generate_ui_section,
-    generate_all_drawings,
+    generate_full_draft,
+    speculate_ui_section,
+    validate_drawing_code,
     run_global_refinement,
+    regenerate_claim,
+    render_logs_viewer,
     call_llm,  # 统一模型调用与日志记录
 )
-from auth import AuthManager, check_authentication
+from job_runner import get_job_runner, current_session_id, JOB_DONE
+from llm_pool import get_llm_pool
+from adaptive_concurrency import endpoint_history, endpoint_stats
+from mermaid_render import find_mermaid_cli
+from draft_document import DraftDocument, get_draft_document, draft_document_from_data
+from speculation import (
+    SPECULATION_IDLE_S,
+    SPECULATION_POLL_S,
+    next_speculation_target,
+    prune_candidates,
+    speculation_status,
+    start_speculation,
+)
+from prior_art import cached_prior_art
+from terminology import analyze_terminology, format_terminology_findings
+from claims_parser import validate_claims
+from disclosure_analysis import analyze_disclosure
+from cost_planner import plan_job
+from draft_budget import BUDGET_KEY, DraftBudgetExceeded, budget_status, draft_budget, reset_draft_tokens
+from document_ingest import SUPPORTED_TYPES, file_hash, iter_document_text
+from patent_export import export_draft, export_fingerprint, DOCX_MIME, PDF_MIME
+from auth import AuthManager, get_auth_manager, check_authentication, render_user_admin
+
+# 后台任务进度轮询间隔（秒）
+JOB_POLL_INTERVAL_S = 1.0
+# 交互调用超出本草稿预算时附在错误信息后的提示
+BUDGET_EXCEEDED_HINT = "，可在“预估用量与预算”中调高预算后重试。"
 
 # --- 安全模板格式化辅助函数 ---
 def safe_format_prompt(template: str, **kwargs) -> str:
@@ -39,10 +80,12 @@ def ensure_skip_drawings_state():
     if "skip_drawings" not in st.session_state:
         st.session_state.skip_drawings = True
 
-def add_new_version(key: str, content: Any):
+def add_new_version(key: str, content: Any, scope: str = "fragment"):
     """
-    为指定key添加一个新版本，更新状态并触发UI刷新。
+    为指定key添加一个新版本，更新状态并刷新界面。
     兼容动态新增章节（如“附图说明”“附图标号表”“权利要求书”等），无需预初始化。
+    默认只重跑当前章节面板（key 属于本面板时）；其他章节的过期标记在下一次整页重跑时更新。
+    key 由其他面板展示时（如在附图面板中生成“附图说明”）传入 scope="app"，整页重跑以刷新该面板。
     """
     if f"{key}_versions" not in st.session_state:
         st.session_state[f"{key}_versions"] = []
@@ -52,13 +95,230 @@ def add_new_version(key: str, content: Any):
     if "data_timestamps" not in st.session_state:
         st.session_state.data_timestamps = {}
     st.session_state.data_timestamps[key] = time.time()
+    st.rerun(scope=scope)
+
+# --- 后台生成任务 ---
+
+def start_generation_job(kind: str, label: str, fn, steps: list, deadline_s=None):
+    """
+    提交一个后台生成任务，并把任务ID写入会话与URL，以便刷新或重新打开页面后继续跟踪。
+    时限缺省取服务配置：单章节生成用 section_deadline_s，其余任务用 job_deadline_s。
+    """
+    if deadline_s is None:
+        cfg = load_server_config()
+        deadline_s = cfg["section_deadline_s"] if kind == "section" else cfg["job_deadline_s"]
+    job = get_job_runner().submit(kind, label, fn, steps=steps, snapshot_fn=export_draft_state,
+                                  owner=st.session_state.get("username"), deadline_s=deadline_s)
+    st.session_state.active_job_id = job.id
+    st.query_params["job"] = job.id
+    return job
+
+def start_section_job(llm_client: LLMClient, key: str):
+    """单章节生成同样作为后台任务执行，生成过程中可随时取消；完成后展开该章节。"""
+    def section_job(job):
+        # 生成失败（输出无法解析等）时不记为完成，提示已写入任务事件
+        if generate_ui_section(llm_client, key):
+            job.mark_step_done(key)
+            st.session_state.just_generated_key = key
+    start_generation_job("section", f"生成 {UI_SECTION_CONFIG[key]['label']}", section_job, steps=[key])
+    st.rerun()
+
+def start_claim_job(llm_client: LLMClient, claim_no: int):
+    """单项权利要求重写：与单章节生成一样作为可取消的后台任务执行。"""
+    def claim_job(job):
+        if regenerate_claim(llm_client, claim_no):
+            job.mark_step_done("claims")
+            st.session_state.just_generated_key = "claims"
+    start_generation_job("section", f"重写权利要求 {claim_no}", claim_job, steps=["claims"])
     st.rerun()
 
+def get_active_job():
+    return get_job_runner().get(st.session_state.get("active_job_id"))
+
+def is_job_running() -> bool:
+    job = get_active_job()
+    return job is not None and not job.finished
+
+def attach_job_from_url():
+    """新会话（刷新或重新打开标签页）时，根据URL中的任务ID重新关联后台任务。"""
+    if "active_job_id" in st.session_state:
+        return
+    job_id = st.query_params.get("job")
+    if job_id and get_job_runner().get(job_id):
+        st.session_state.active_job_id = job_id
+
+def _adopt_job_state(job):
+    """任务由其他（已关闭的）会话提交时，将其状态快照迁入当前会话。"""
+    if job.session_id != current_session_id() and job.snapshot:
+        import_draft_state(job.snapshot)
+
+def _dismiss_job():
+    st.session_state.pop("active_job_id", None)
+    st.session_state.pop("job_acknowledged", None)
+    if "job" in st.query_params:
+        del st.query_params["job"]
+
+@st.fragment(run_every=JOB_POLL_INTERVAL_S)
+def _render_job_progress():
+    job = get_active_job()
+    if job is None:
+        return
+    if job.finished:
+        _adopt_job_state(job)
+        st.session_state.job_acknowledged = job.id
+        st.rerun()
+
+    with st.container(border=True):
+        col_info, col_cancel = st.columns([4, 1])
+        col_info.markdown(f"**⏳ 后台任务：{job.label}**（可切换页面或刷新，任务不会中断）")
+        if col_cancel.button("⏹️ 取消任务", key=f"cancel_job_{job.id}", disabled=job.cancel_requested):
+            job.cancel()
+        progress_text = f"已完成 {len(job.completed_steps)}/{len(job.steps)} 个步骤"
+        remaining = job.remaining_s()
+        if remaining is not None:
+            progress_text += f" · 剩余时限 {int(remaining // 60)}:{int(remaining % 60):02d}"
+        st.progress(job.progress, text=progress_text)
+        for event in job.events_tail(6):
+            st.caption(event["message"])
+
+def render_job_panel():
+    """渲染当前会话关联的后台任务：运行中时以片段轮询进度，结束后显示结果与续跑入口。"""
+    job = get_active_job()
+    if job is None:
+        return
+    if not (job.finished and st.session_state.get("job_acknowledged") == job.id):
+        _render_job_progress()
+        return
+
+    if job.status == JOB_DONE:
+        problems = job.problems()
+        # 单章节生成顺利完成后结果已在章节面板中展开，无需再提示；有警告或错误时保留面板
+        if job.kind == "section" and not problems:
+            _dismiss_job()
+            return
+        col_msg, col_close = st.columns([4, 1])
+        if problems:
+            col_msg.warning(f"⚠️ {job.label} 已结束，但有以下问题：")
+            for event in problems:
+                getattr(st, event["level"])(event["message"])
+        else:
+            col_msg.success(f"✅ {job.label} 已完成。")
+        if col_close.button("关闭", key=f"dismiss_job_{job.id}"):
+            _dismiss_job()
+            st.rerun()
+        return
+
+    with st.container(border=True):
+        if job.error:
+            st.error(f"{job.label} 失败：{job.error}")
+        else:
+            if job.cancel_reason == "deadline":
+                reason = f"超出时限（{int(job.deadline_s)} 秒）已中止"
+            elif job.cancel_reason == "budget":
+                reason = "因本草稿 token 预算用尽已中止"
+            else:
+                reason = "已取消"
+            st.warning(
+                f"{job.label} {reason}，已完成 {len(job.completed_steps)}/{len(job.steps)} 个步骤。"
+                "已生成的内容均已保留，中途停止的章节以“⚠️ 部分结果”版本保存。"
+            )
+        col_resume, col_close = st.columns([1, 1])
+        if col_resume.button("▶️ 从中断处继续", key=f"resume_job_{job.id}"):
+            new_job = get_job_runner().resume(job.id)
+            if new_job is not None:
+                st.session_state.active_job_id = new_job.id
+                st.query_params["job"] = new_job.id
+            st.rerun()
+        if col_close.button("关闭", key=f"dismiss_job_{job.id}"):
+            _dismiss_job()
+            st.rerun()
+
+# --- 预生成（投机生成） ---
+
+def render_speculation_controls(llm_client: LLMClient):
+    """预生成开关；开启后输入稳定一段时间即在后台生成下一章节，点击生成时直接采用。"""
+    st.toggle(
+        "⚡ 预生成下一章节",
+        key="speculative_mode",
+        help=f"输入 {SPECULATION_IDLE_S} 秒未编辑后，在后台预先生成依赖已就绪的下一章节；点击生成时若输入未变则立即采用。预生成消耗计入本会话的预生成额度。",
+    )
+    if st.session_state.get("speculative_mode"):
+        _run_speculation(llm_client)
+
+@st.fragment(run_every=SPECULATION_POLL_S)
+def _run_speculation(llm_client: LLMClient):
+    prune_candidates()
+    # 用户发起的生成任务优先，进行中时不启动预生成
+    if not is_job_running():
+        target = next_speculation_target()
+        if target:
+            start_speculation(target, lambda job, fingerprint: speculate_ui_section(llm_client, target, job, fingerprint))
+    status = speculation_status()
+    parts = []
+    if status["running"]:
+        parts.append(f"正在预生成：{UI_SECTION_CONFIG[status['running']]['label']}")
+    if status["ready"]:
+        parts.append("已就绪：" + "、".join(UI_SECTION_CONFIG[k]["label"] for k in status["ready"]))
+    parts.append(f"额度 {status['spent']}/{status['budget']} tokens")
+    st.caption(" · ".join(parts))
+
 # --- 阶段渲染函数 ---
 
+def render_disclosure_upload():
+    """
+    上传交底文档（PDF/DOCX/Markdown）：文本在本地进程池中按页提取，边提取边预览，
+    完成后填入下方输入框。同一文件（按内容哈希）只提取一次。
+    """
+    uploaded = st.file_uploader("或上传交底文档（PDF / DOCX / Markdown）", type=SUPPORTED_TYPES, key="disclosure_upload")
+    if uploaded is None:
+        return
+    data = uploaded.getvalue()
+    digest = file_hash(data)
+    if st.session_state.get("uploaded_disclosure_hash") == digest:
+        return
+    bar = st.progress(0.0, text=f"正在提取 {uploaded.name} ...")
+    preview = st.empty()
+    parts = []
+    try:
+        for done, total, text in iter_document_text(uploaded.name, data):
+            if text.strip():
+                parts.append(text)
+            bar.progress(done / total, text=f"正在提取 {uploaded.name}：{done}/{total} 页" if total > 1 else f"已提取 {uploaded.name}")
+            preview.text(text[-1500:])
+    except Exception as e:
+        bar.empty()
+        st.error(f"文档提取失败：{e}")
+        return
+    bar.empty()
+    preview.empty()
+    full_text = "\n\n".join(parts)
+    if not full_text.strip():
+        st.warning("未能从文档中提取到文字（扫描件需先进行文字识别）。")
+        return
+    st.session_state.uploaded_disclosure_hash = digest
+    st.session_state.user_input = full_text
+    # 清除输入框的控件状态，使其按新的 user_input 重新初始化
+    st.session_state.pop("user_input_area", None)
+    st.success(f"已从 {uploaded.name} 提取 {len(full_text)} 字。")
+
+def render_cost_preflight(llm_client: LLMClient, kind: str) -> bool:
+    """
+    展示整稿任务的预估用量，并可调整本草稿的 token 预算（0 为不限）。
+    返回预估用量是否超出剩余预算（超出时应禁用对应按钮）。
+    """
+    with st.expander("💰 预估用量与预算", expanded=True):
+        plan = plan_job(kind, llm_client)
+        budget = st.number_input("本草稿 token 预算（0 为不限）", min_value=0, step=10000,
+                                 value=draft_budget(), key=f"draft_budget_input_{kind}")
+        st.session_state[BUDGET_KEY] = int(budget)
+        status = budget_status(plan["tokens"])
+        render_cost_plan(plan, status)
+    return status["exceeds"]
+
 def render_input_stage(llm_client: LLMClient):
     """渲染阶段一：输入核心技术构思"""
     st.header("Step 1️⃣: 输入核心技术构思")
+    render_disclosure_upload()
     user_input = st.text_area(
         "在此处粘贴您的技术交底、项目介绍、或任何描述发明的文字：",
         value=st.session_state.user_input,
@@ -68,28 +328,40 @@ def render_input_stage(llm_client: LLMClient):
     if st.button("🔬 分析并提炼核心要素", type="primary"):
         if user_input:
             st.session_state.user_input = user_input
-            prompt = safe_format_prompt(prompts.PROMPT_ANALYZE, user_input=user_input)
+            # 长材料分块并行提炼，进度条按完成的分块推进
+            bar = st.progress(0.0, text="正在调用分析代理，请稍候...")
+            def on_progress(done, total):
+                bar.progress(done / total, text=f"正在分块提炼：{done}/{total}")
+            # 重新分析即开始新草稿：预算用量从本次分析起重新累计
+            reset_draft_tokens()
             with st.spinner("正在调用分析代理，请稍候..."):
                 try:
-                    response_str = call_llm(
-                        llm_client,
-                        messages=[{"role": "user", "content": prompt}],
-                        json_mode=True,
-                        tag="analyze_brief",
-                        extra_ctx={"stage": "input"}
-                    )
-                    st.session_state.structured_brief = json.loads(response_str.strip())
+                    st.session_state.structured_brief = analyze_disclosure(llm_client, user_input, progress=on_progress)
                     st.session_state.stage = "review_brief"
                     st.rerun()
-                except (json.JSONDecodeError, KeyError) as e:
-                    st.error(f"无法解析模型返回的核心要素，请检查模型输出或尝试调整输入。错误: {e}\n模型原始返回: \n{response_str}")
+                except DraftBudgetExceeded as e:
+                    st.error(f"{e}{BUDGET_EXCEEDED_HINT}")
+                except ValueError as e:
+                    st.error(f"无法解析模型返回的核心要素，请检查模型输出或尝试调整输入。错误: {e}")
         else:
             st.warning("请输入您的技术构思。")
 
+    # 批量生成（batch_runner.py）产出的草稿状态文件可直接导入继续编辑
+    with st.expander("📦 导入批量生成的草稿", expanded=False):
+        uploaded = st.file_uploader("选择 batch/<run_id>/drafts/ 下的草稿文件", type=["json"], key="batch_draft_upload")
+        if uploaded is not None and st.button("导入草稿", key="batch_draft_import"):
+            try:
+                import_draft_state(json.loads(uploaded.getvalue().decode("utf-8")))
+                st.session_state.stage = "writing"
+                st.rerun()
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                st.error(f"草稿文件解析失败：{e}")
+
 def render_review_brief_stage(llm_client: LLMClient):
     """渲染阶段二：审核并确认核心要素"""
     st.header("Step 2️⃣: 审核核心要素并选择模式")
     st.info("请检查并编辑AI提炼的发明核心信息。为保证后续章节的一致性，请以规范JSON编辑关键组件/步骤。")
+    render_speculation_controls(llm_client)
 
     ensure_skip_drawings_state()
     st.checkbox("跳过附图生成（当前模型不支持文生图/图形生成）", value=st.session_state.skip_drawings, key="skip_drawings")
@@ -131,24 +403,13 @@ def render_review_brief_stage(llm_client: LLMClient):
 
     brief['achieved_effects'] = st.text_area("有益效果（可量化表述，逐行）", value=brief.get('achieved_effects', ''), on_change=update_brief_timestamp)
 
+    over_budget = render_cost_preflight(llm_client, "full_draft")
     col1, col2, col3 = st.columns([2,2,1])
-    if col1.button("🚀 一键生成初稿", type="primary"):
-        with st.status("正在为您生成完整专利初稿...", expanded=True) as status:
-            # 先生成 UI_SECTION_ORDER 中的所有键
-            for key in UI_SECTION_ORDER:
-                status.update(label=f"正在生成: {UI_SECTION_CONFIG[key]['label']}...")
-                generate_ui_section(llm_client, key)
-            # 补齐组合章节键，避免预览为空（仅在配置存在的情况下）
-            COMPOSITE_SECTION_KEYS = ["title", "technical_field", "background", "invention", 
-                                "figure_description", "implementation", "claims", "abstract", "drawings"]
-
-            for k in COMPOSITE_SECTION_KEYS:
-                if (k in UI_SECTION_CONFIG) and (not get_active_content(k)):
-                    label = UI_SECTION_CONFIG.get(k, {}).get('label', k)
-                    status.update(label=f"正在生成: {label}...")
-                    generate_ui_section(llm_client, k)
-            status.update(label="✅ 所有章节生成完毕！", state="complete")
-        st.session_state.stage = "writing"
+    if col1.button("🚀 一键生成初稿", type="primary", disabled=is_job_running() or over_budget):
+        def draft_job(job):
+            generate_full_draft(llm_client)
+            st.session_state.stage = "writing"
+        start_generation_job("full_draft", "一键生成初稿", draft_job, steps=list(UI_SECTION_ORDER))
         st.rerun()
 
     if col2.button("✍️ 进入分步精修模式"):
@@ -162,6 +423,7 @@ def render_review_brief_stage(llm_client: LLMClient):
 def render_writing_stage(llm_client: LLMClient):
     """渲染阶段三：分步生成与撰写（按专利结构标准）"""
     st.header("Step 3️⃣: 逐章生成与编辑专利草稿")
+    render_speculation_controls(llm_client)
 
     if st.button("⬅️ 返回修改核心要素"):
         st.session_state.stage = "review_brief"
@@ -184,15 +446,22 @@ def render_writing_stage(llm_client: LLMClient):
 
         is_expanded = (not versions) or is_section_stale or (key == just_generated_key)
         with st.expander(expander_label, expanded=is_expanded):
-            # 专用渲染器：附图与权利要求书
-            if key == 'drawings':
-                render_drawings_section(llm_client)
-                continue
-            if key == 'claims':
-                render_claims_section(llm_client, key, versions)
-                continue
+            render_section_fragment(llm_client, key)
 
-            render_standard_section(llm_client, key, versions)
+@st.fragment
+def render_section_fragment(llm_client: LLMClient, key: str):
+    """
+    单个章节的面板。组件交互只重跑本章节（保存编辑、切换版本不会重建其他章节与附图）；
+    生成类按钮仍通过 st.rerun() 触发整页重跑，以刷新依赖章节的过期标记。
+    """
+    versions = st.session_state.get(f"{key}_versions", [])
+    # 专用渲染器：附图与权利要求书
+    if key == 'drawings':
+        render_drawings_section(llm_client)
+    elif key == 'claims':
+        render_claims_section(llm_client, key, versions)
+    else:
+        render_standard_section(llm_client, key, versions)
 
 def render_drawings_section(llm_client: LLMClient):
     """渲染'附图'专属UI和逻辑，并支持生成附图说明与标号表"""
@@ -209,13 +478,14 @@ def render_drawings_section(llm_client: LLMClient):
     invention_solution_detail = get_active_content("invention_solution_detail")
 
     # 全量生成附图
-    if st.button("💡 (重新)构思并生成所有附图", key="regen_all_drawings"):
-        with st.spinner("正在为您重新生成全套附图..."):
-            generate_all_drawings(llm_client, invention_solution_detail)
-            st.rerun()
+    if st.button("💡 (重新)构思并生成所有附图", key="regen_all_drawings", disabled=is_job_running()):
+        start_section_job(llm_client, "drawings")
 
     drawings = get_active_content("drawings")
     if drawings:
+        notice = st.session_state.pop("drawings_notice", None)
+        if notice:
+            st.success(notice)
         st.caption("为保证独立性，可对单个附图重新生成，或在下方编辑代码。")
 
         # 生成“附图说明”与“附图标号表”
@@ -225,34 +495,46 @@ def render_drawings_section(llm_client: LLMClient):
                 mermaid_ideas_json = json.dumps([{"title": d.get("title", ""), "description": d.get("description", "")} for d in drawings], ensure_ascii=False)
                 fd_prompt = safe_format_prompt(prompts.PROMPT_FIGURE_DESCRIPTION, mermaid_ideas=mermaid_ideas_json)
                 with st.spinner("正在生成附图说明..."):
-                    fd_text = call_llm(
-                        llm_client,
-                        messages=[{"role": "user", "content": fd_prompt}],
-                        json_mode=False,
-                        tag="figure_description",
-                        extra_ctx={"section": "drawings"}
-                    )
-                    add_new_version('figure_description', fd_text)
+                    try:
+                        fd_text = call_llm(
+                            llm_client,
+                            messages=[{"role": "user", "content": fd_prompt}],
+                            json_mode=False,
+                            tag="figure_description",
+                            extra_ctx={"section": "drawings"}
+                        )
+                    except DraftBudgetExceeded as e:
+                        st.error(f"{e}{BUDGET_EXCEEDED_HINT}")
+                    else:
+                        add_new_version('figure_description', fd_text, scope="app")
         with col_fl:
             if st.button("🏷️ 生成附图标号表"):
                 key_components = st.session_state.structured_brief.get('key_components_or_steps', [])
                 kc_json = json.dumps(key_components, ensure_ascii=False)
                 fl_prompt = safe_format_prompt(prompts.PROMPT_FIGURE_LABELS, key_components_or_steps=kc_json)
                 with st.spinner("正在生成附图标号表..."):
-                    fl_json_str = call_llm(
-                        llm_client,
-                        messages=[{"role": "user", "content": fl_prompt}],
-                        json_mode=True,
-                        tag="figure_labels",
-                        extra_ctx={"section": "drawings"}
-                    )
                     try:
+                        fl_json_str = call_llm(
+                            llm_client,
+                            messages=[{"role": "user", "content": fl_prompt}],
+                            json_mode=True,
+                            tag="figure_labels",
+                            extra_ctx={"section": "drawings"}
+                        )
                         json.loads(fl_json_str)
-                        add_new_version('figure_labels', fl_json_str)
-                        st.success("附图标号表已生成。")
+                        # 重跑后才能显示的提示，在下一次渲染本面板时展示
+                        st.session_state.drawings_notice = "附图标号表已生成。"
+                        add_new_version('figure_labels', fl_json_str, scope="app")
+                    except DraftBudgetExceeded as e:
+                        st.error(f"{e}{BUDGET_EXCEEDED_HINT}")
                     except json.JSONDecodeError:
                         st.error("生成的附图标号表JSON解析失败，请重试。")
 
+        # 本机有 mermaid-cli 时展示服务端渲染的静态图片；否则所有附图在同一个组件中由浏览器渲染
+        server_render = find_mermaid_cli() is not None
+        if not server_render:
+            render_mermaid_gallery(drawings, key_prefix="mermaid")
+
         for i, drawing in enumerate(drawings):
             with st.container(border=True):
                 col1, col2 = st.columns([3, 1])
@@ -265,19 +547,25 @@ def render_drawings_section(llm_client: LLMClient):
                             description=drawing.get('description', ''),
                             invention_solution_detail=invention_solution_detail
                         )
-                        new_code = call_llm(
-                            llm_client,
-                            messages=[{"role": "user", "content": code_prompt}],
-                            json_mode=False,
-                            tag=f"drawing_{i+1}",
-                            extra_ctx={"section": "drawings"}
-                        )
-                        active_drawings = json.loads(json.dumps(get_active_content("drawings")))
-                        active_drawings[i]["code"] = clean_mermaid_code(new_code)
-                        add_new_version('drawings', active_drawings)
+                        try:
+                            new_code = call_llm(
+                                llm_client,
+                                messages=[{"role": "user", "content": code_prompt}],
+                                json_mode=False,
+                                tag=f"drawing_{i+1}",
+                                extra_ctx={"section": "drawings"}
+                            )
+                            fixed_code = validate_drawing_code(llm_client, drawing.get('title', ''), clean_mermaid_code(new_code), tag=f"drawing_{i+1}")
+                        except DraftBudgetExceeded as e:
+                            st.error(f"{e}{BUDGET_EXCEEDED_HINT}")
+                        else:
+                            active_drawings = json.loads(json.dumps(get_active_content("drawings")))
+                            active_drawings[i]["code"] = fixed_code
+                            add_new_version('drawings', active_drawings)
 
                 st.markdown(f"**构思说明:** *{drawing.get('description', '无')}*")
-                render_mermaid_component(f"mermaid_{i}", drawing)
+                if server_render:
+                    render_mermaid_image(f"mermaid_{i}", drawing)
 
                 edited_code = st.text_area("编辑Mermaid代码:", value=drawing["code"], key=f"edit_code_{i}", height=150)
                 if edited_code != drawing["code"]:
@@ -297,11 +585,8 @@ def render_claims_section(llm_client: LLMClient, key: str, versions: list):
             for dep in config["dependencies"]
         )
         if deps_met:
-            if st.button(f"🔄 重新生成 {label}" if versions else f"✍️ 生成 {label}", key=f"btn_{key}"):
-                with st.spinner(f"正在执行 {label} 的生成流程..."):
-                    generate_ui_section(llm_client, key)
-                    st.session_state.just_generated_key = key
-                    st.rerun()
+            if st.button(f"🔄 重新生成 {label}" if versions else f"✍️ 生成 {label}", key=f"btn_{key}", disabled=is_job_running()):
+                start_section_job(llm_client, key)
         else:
             st.info(f"请先生成前置章节: {', '.join(config['dependencies'])}")
 
@@ -309,38 +594,49 @@ def render_claims_section(llm_client: LLMClient, key: str, versions: list):
     active_idx = st.session_state.get(f"{key}_active_index", 0)
     if len(versions) > 1:
         with col2:
-            version_labels = [f"版本 {i+1}" for i in range(len(versions))]
-            new_idx = st.selectbox(f"选择版本", version_labels, index=active_idx, key=f"select_{key}")
-            active_idx = version_labels.index(new_idx)
+            labels = version_labels(key, len(versions))
+            new_idx = st.selectbox(f"选择版本", labels, index=active_idx, key=f"select_{key}")
+            active_idx = labels.index(new_idx)
             if active_idx != st.session_state.get(f"{key}_active_index", 0):
                 st.session_state[f"{key}_active_index"] = active_idx
-                st.rerun()
+                st.rerun(scope="fragment")
 
-    # 一致性校验按钮
+    partial_note = partial_version_note(key, active_idx) if versions else None
+    if partial_note:
+        st.warning(f"当前版本为部分结果：{partial_note}。可重新生成以获得完整内容。")
+
+    # 术语层面的一致性由本地分析即时给出（按章节内容缓存，编辑后只重扫改动的章节）
+    components = (st.session_state.get("structured_brief") or {}).get("key_components_or_steps", [])
+    term_report = analyze_terminology(get_draft_document().sections, components) if versions else None
+
+    # 语义支持度校验按钮（模型只处理本地分析无法判断的部分）
     with col3:
         if get_active_content(key):
-            if st.button("🧪 权利要求一致性校验"):
+            if st.button("🧪 语义支持度校验"):
                 claims_text = get_active_content(key)
-                global_context = assemble_global_context_for_claims_check()
-                kc_json = json.dumps(st.session_state.structured_brief.get('key_components_or_steps', []), ensure_ascii=False)
+                global_context = get_draft_document().claims_check_context()
+                kc_json = json.dumps(components, ensure_ascii=False)
                 check_prompt = safe_format_prompt(
                     prompts.PROMPT_CLAIMS_CHECK,
                     claims_text=claims_text,
                     global_context=global_context,
-                    key_components_or_steps=kc_json
+                    key_components_or_steps=kc_json,
+                    local_findings=format_terminology_findings(term_report),
                 )
-                with st.spinner("正在执行权利要求支持度校验..."):
-                    check_str = call_llm(
-                        llm_client,
-                        messages=[{"role": "user", "content": check_prompt}],
-                        json_mode=True,
-                        tag="claims_check",
-                        extra_ctx={"section": "claims"}
-                    )
+                with st.spinner("正在执行权利要求语义支持度校验..."):
                     try:
+                        check_str = call_llm(
+                            llm_client,
+                            messages=[{"role": "user", "content": check_prompt}],
+                            json_mode=True,
+                            tag="claims_check",
+                            extra_ctx={"section": "claims"}
+                        )
                         check_report = json.loads(check_str)
                         st.session_state.claims_check_report = check_report
                         st.success("校验完成。")
+                    except DraftBudgetExceeded as e:
+                        st.error(f"{e}{BUDGET_EXCEEDED_HINT}")
                     except json.JSONDecodeError as e:
                         st.error(f"校验报告解析失败：{e}")
 
@@ -354,9 +650,29 @@ def render_claims_section(llm_client: LLMClient, key: str, versions: list):
             if submitted and edited_content != active_content:
                 add_new_version(key, edited_content)
 
+    if term_report is not None:
+        st.markdown("**术语一致性（本地分析）**")
+        render_terminology_report(term_report)
+
+        # 结构与引用基础：按条缓存校验结果，编辑后只重新校验改动的权利要求及其从属项
+        structure = validate_claims(get_active_content(key) or "")
+        st.markdown("**结构与引用基础（本地校验）**")
+        render_claim_structure(structure["tree"], structure["issues"])
+        numbers = [c.number for c in structure["tree"].claims]
+        if numbers:
+            flagged = [i["claim_no"] for i in structure["issues"]]
+            default = numbers.index(flagged[0]) if flagged and flagged[0] in numbers else 0
+            rc1, rc2 = st.columns([1, 2])
+            with rc1:
+                claim_no = st.selectbox("选择权利要求", numbers, index=default, key="regen_claim_no")
+            with rc2:
+                st.write("")
+                if st.button(f"🔁 只重写权利要求 {claim_no}", key="btn_regen_claim", disabled=is_job_running()):
+                    start_claim_job(llm_client, claim_no)
+
     # 显示校验报告
     if "claims_check_report" in st.session_state:
-        st.markdown("**权利要求支持度校验报告**")
+        st.markdown("**权利要求语义支持度校验报告**")
         try:
             report = st.session_state.claims_check_report
             for item in report:
@@ -384,23 +700,30 @@ def render_standard_section(llm_client: LLMClient, key: str, versions: list):
             for dep in config["dependencies"]
         )
         if deps_met:
-            if st.button(f"🔄 重新生成 {label}" if versions else f"✍️ 生成 {label}", key=f"btn_{key}"):
-                with st.spinner(f"正在执行 {label} 的生成流程..."):
-                    generate_ui_section(llm_client, key)
-                    st.session_state.just_generated_key = key
-                    st.rerun()
+            if st.button(f"🔄 重新生成 {label}" if versions else f"✍️ 生成 {label}", key=f"btn_{key}", disabled=is_job_running()):
+                start_section_job(llm_client, key)
         else:
             st.info(f"请先生成前置章节: {', '.join(config['dependencies'])}")
 
+    if key == "background":
+        try:
+            render_prior_art_hits(cached_prior_art(st.session_state.get("structured_brief") or {}))
+        except Exception as e:
+            st.caption(f"现有技术检索不可用：{e}")
+
     active_idx = st.session_state.get(f"{key}_active_index", 0)
     if len(versions) > 1:
         with col2:
-            version_labels = [f"版本 {i+1}" for i in range(len(versions))]
-            new_idx = st.selectbox(f"选择版本", version_labels, index=active_idx, key=f"select_{key}")
-            active_idx = version_labels.index(new_idx)
+            labels = version_labels(key, len(versions))
+            new_idx = st.selectbox(f"选择版本", labels, index=active_idx, key=f"select_{key}")
+            active_idx = labels.index(new_idx)
             if active_idx != st.session_state.get(f"{key}_active_index", 0):
                 st.session_state[f"{key}_active_index"] = active_idx
-                st.rerun()
+                st.rerun(scope="fragment")
+
+    partial_note = partial_version_note(key, active_idx) if versions else None
+    if partial_note:
+        st.warning(f"当前版本为部分结果：{partial_note}。可重新生成以获得完整内容。")
 
     if versions:
         active_content = get_active_content(key)
@@ -421,121 +744,96 @@ def render_preview_stage(llm_client: LLMClient):
     st.header("Step 4️⃣: 预览、精炼与下载")
     st.markdown("---")
 
-    if st.button("✨ 全局重构与润色", type="primary", help="调用顶级专利总编AI，对所有章节进行深度重构、润色和细节补充，确保全文逻辑、深度和专业性达到最佳状态。"):
-        run_global_refinement(llm_client)
+    over_budget = render_cost_preflight(llm_client, "global_refine")
+    if st.button("✨ 全局重构与润色", type="primary", disabled=is_job_running() or over_budget, help="调用顶级专利总编AI，对所有章节进行深度重构、润色和细节补充，确保全文逻辑、深度和专业性达到最佳状态。"):
+        start_generation_job("global_refine", "全局重构与润色", lambda job: run_global_refinement(llm_client), steps=list(UI_SECTION_ORDER))
         st.rerun()
 
+    render_preview_fragment()
+
+@st.fragment
+def render_preview_fragment():
+    """预览与导出面板：切换预览版本、导出文件只重跑本面板。"""
     tabs = ["✍️ 初稿"]
+    unrefined = st.session_state.get("refined_version_partial") or []
+    refined_tab = "✨ 全局重构润色版" + ("（⚠️ 部分结果）" if unrefined else "")
     if st.session_state.get("refined_version_available"):
-        tabs.append("✨ 全局重构润色版")
+        tabs.append(refined_tab)
 
     selected_tab = st.radio("选择预览版本", tabs, horizontal=True)
 
+    skip_drawings = st.session_state.get("skip_drawings", True)
     if selected_tab == "✍️ 初稿":
-        draft_data = {key: get_active_content(key) for key in UI_SECTION_ORDER}
-        draft_data["figure_description"] = get_active_content("figure_description")
-        draft_data["figure_labels"] = get_active_content("figure_labels")
+        doc = get_draft_document(skip_drawings)
         st.subheader("初稿预览")
     else:  # 全局精炼版
-        draft_data = st.session_state.globally_refined_draft
+        doc = draft_document_from_data(st.session_state.globally_refined_draft, skip_drawings)
         st.subheader("全局重构润色版预览")
+        if unrefined:
+            st.warning("润色在完成前已中止，以下章节仍为初稿内容：" + "、".join(UI_SECTION_CONFIG[k]["label"] for k in unrefined)
+                       + "。可在任务面板中从中断处继续。")
 
-    # 章节正文直接取整段内容，若缺失则用微观子键兜底拼接
-    title = draft_data.get('title', '无标题')
-    tech_field = draft_data.get('technical_field') or draft_data.get('tech_field') or ''
-
-    background_full = draft_data.get('background') or (
-        f"## 2.1 对最接近发明的同类现有技术状况加以分析说明\n{draft_data.get('background_context','')}\n\n"
-        f"## 2.2 实事求是地指出现有技术存在的问题，尽可能分析存在的原因。\n{draft_data.get('background_problem','')}"
-    )
-
-    invention_full = draft_data.get('invention') or (
-        f"## 3.1 发明目的\n{draft_data.get('invention_purpose','')}\n\n"
-        f"## 3.2 技术解决方案\n{draft_data.get('invention_solution_detail','')}\n\n"
-        f"## 3.3 技术效果\n{draft_data.get('invention_effects','')}"
-    )
-
-    implementation = draft_data.get('implementation', '')
-    claims_text = draft_data.get('claims', '')
-    abstract_text = draft_data.get('abstract', '')
-
-    # 附图说明与标号表（若跳过附图，则用占位）
-    if st.session_state.get("skip_drawings", True):
-        figure_description_text = "（本申请无附图）"
-        figure_labels_text = ""
-    else:
-        figure_description_text = draft_data.get('figure_description', '') or '（附图说明待补充）'
-        figure_labels = draft_data.get("figure_labels")
-        figure_labels_text = ""
-        if figure_labels:
-            try:
-                labels = json.loads(figure_labels) if isinstance(figure_labels, str) else figure_labels
-                figure_labels_text = "附图标号表：\n" + "\n".join([f"{item.get('id','')}: {item.get('name','')} - {item.get('description','')}" for item in labels])
-            except Exception:
-                figure_labels_text = "附图标号表解析失败。"
-
-    # 附图（Mermaid）
-    drawings_text = ""
-    drawings = draft_data.get("drawings")
-    if drawings and isinstance(drawings, list) and not st.session_state.get("skip_drawings", True):
-        for i, drawing in enumerate(drawings):
-            drawings_text += f"## 附图{i+1}：{drawing.get('title', '')}\n"
-            drawings_text += f"```mermaid\n{drawing.get('code', '')}\n```\n\n"
-
-    full_text = (
-        f"# 一、发明名称\n{title}\n\n"
-        f"# 二、技术领域\n{tech_field}\n\n"
-        f"# 三、背景技术\n{background_full}\n\n"
-        f"# 四、发明内容\n{invention_full}\n\n"
-        f"# 五、附图说明\n{figure_description_text}\n\n"
-        f"{figure_labels_text if figure_labels_text else ''}\n\n"
-        f"# 六、具体实施方式\n{implementation}\n\n"
-        f"# 七、权利要求书\n{claims_text}\n\n"
-        f"# 八、摘要\n{abstract_text}\n\n"
-        f"# 九、附图\n{drawings_text if drawings_text else '（本申请无附图）'}\n"
-    )
+    # 草稿快照按激活版本与内容指纹缓存：内容未变时重跑不再重新拼接
+    full_text = doc.markdown()
 
     st.subheader("完整草稿预览")
     st.markdown(full_text)
-    st.download_button("📄 下载当前预览版本 (.md)", full_text, file_name=f"{title}_patent_draft.md")
+    st.download_button("📄 下载当前预览版本 (.md)", full_text, file_name=f"{doc.title}_patent_draft.md")
+    render_export_panel(doc)
 
-# --- 权利要求校验上下文组装 ---
 
-def assemble_global_context_for_claims_check() -> str:
+def render_export_panel(doc: DraftDocument):
     """
-    组装用于权利要求一致性校验的说明书全文上下文。
-    使用已组装的整段章节，确保上下文完整；若缺失则兜底。
+    DOCX/PDF 导出：仅在点击生成时构建文件，结果以内容指纹缓存在磁盘上。
+    下载按钮直接读取磁盘文件，会话状态中只保存路径。
     """
-    tech_field = get_active_content("technical_field") or get_active_content("tech_field") or ""
-    background = get_active_content("background") or (
-        f"## 2.1 对最接近发明的同类现有技术状况加以分析说明\n{get_active_content('background_context') or ''}\n\n"
-        f"## 2.2 实事求是地指出现有技术存在的问题，尽可能分析存在的原因。\n{get_active_content('background_problem') or ''}"
-    )
-    invention = get_active_content("invention") or (
-        f"## 3.1 发明目的\n{get_active_content('invention_purpose') or ''}\n\n"
-        f"## 3.2 技术解决方案\n{get_active_content('invention_solution_detail') or ''}\n\n"
-        f"## 3.3 技术效果\n{get_active_content('invention_effects') or ''}"
-    )
-    implementation = get_active_content("implementation") or ""
-
-    ctx = (
-        f"技术领域：{tech_field}\n"
-        f"背景技术：{background}\n"
-        f"发明内容：{invention}\n"
-        f"具体实施方式：{implementation}\n"
-    )
-    return ctx
+    st.markdown("##### 导出申请文件")
+    fingerprint = export_fingerprint(doc)
+    exports = st.session_state.setdefault("export_paths", {})
+    for fmt, label, mime in (("docx", "Word (.docx)", DOCX_MIME), ("pdf", "PDF (.pdf)", PDF_MIME)):
+        col_build, col_download = st.columns([1, 2])
+        if col_build.button(f"⚙️ 生成 {label}", key=f"export_build_{fmt}"):
+            try:
+                with st.spinner(f"正在生成 {label}..."):
+                    exports[fmt] = {"fingerprint": fingerprint, "path": export_draft(doc, fmt)}
+            except RuntimeError as e:
+                st.error(str(e))
+        entry = exports.get(fmt)
+        if entry and entry["fingerprint"] == fingerprint and os.path.exists(entry["path"]):
+            with open(entry["path"], "rb") as f:
+                col_download.download_button(f"📥 下载 {label}", f, file_name=f"{doc.title}_patent_draft.{fmt}", mime=mime, key=f"export_download_{fmt}")
+        elif entry:
+            col_download.caption("草稿内容已变化，请重新生成。")
+
+# --- 服务模式（多用户） ---
+
+def render_server_sidebar(auth_manager: AuthManager, is_admin: bool):
+    """服务模式侧边栏：当前用户信息、登出，以及管理员的队列与账号视图。"""
+    with st.sidebar:
+        st.markdown(f"👤 当前用户：**{st.session_state.get('username', '')}**")
+        if st.button("退出登录"):
+            for k in ("authenticated", "auth_token", "username", "user_role", "user_limits"):
+                st.session_state.pop(k, None)
+            st.rerun()
+        if is_admin:
+            with st.expander("🛠️ 管理员视图：调用队列", expanded=False):
+                render_admin_panel(get_llm_pool().stats(), get_job_runner().list_jobs(), endpoint_stats(), endpoint_history())
+            with st.expander("👥 管理员视图：用户账号", expanded=False):
+                render_user_admin(auth_manager)
 
 # --- 主应用逻辑 ---
 
 def main():
     st.set_page_config(page_title="智能专利撰写助手", layout="wide", page_icon="📝")
 
-    # 初始化认证管理器
-    auth_manager = AuthManager()
+    server_cfg = load_server_config()
+    server_mode = server_cfg["server_mode"]
+
+    # 认证管理器在进程内共享，配置按文件修改时间失效
+    auth_manager = get_auth_manager()
 
     # 检查认证状态
-    if not check_authentication(auth_manager):
+    if not check_authentication(auth_manager, server_mode=server_mode):
         return
 
     # 认证通过后显示主界面
@@ -545,16 +843,24 @@ def main():
     initialize_session_state()
     ensure_skip_drawings_state()
     config = st.session_state.config
-    render_sidebar(config)
+    # 服务模式下仅管理员可维护 API 配置
+    is_admin = (not server_mode) or st.session_state.get("user_role") == "admin"
+    if is_admin:
+        render_sidebar(config)
+    if server_mode:
+        get_llm_pool().set_user_limits(st.session_state.username, **st.session_state.get("user_limits", {}))
+        render_server_sidebar(auth_manager, is_admin)
 
     active_provider = st.session_state.config["provider"]
     if not st.session_state.config.get(active_provider, {}).get("api_key"):
-        st.warning("请在左侧边栏配置并保存您的 API Key。")
+        st.warning("请在左侧边栏配置并保存您的 API Key。" if is_admin else "管理员尚未配置 API Key，请联系管理员。")
         st.stop()
 
-    if 'llm_client' not in st.session_state or st.session_state.llm_client.full_config != st.session_state.config:
-        st.session_state.llm_client = LLMClient(st.session_state.config)
-    llm_client = st.session_state.llm_client
+    # 客户端来自进程级注册表：相同配置的会话共享连接，代理按客户端隔离
+    llm_client = get_llm_client(st.session_state.config)
+
+    attach_job_from_url()
+    render_job_panel()
 
     # 使用分派字典来调用对应阶段的渲染函数
     stage_renderers = {
@@ -571,6 +877,11 @@ def main():
     if st.session_state.stage == "writing":
         render_preview_stage(llm_client)
 
+    # 日志目录包含所有会话的记录，仅对管理员开放
+    if is_admin:
+        with st.expander("🧾 执行日志", expanded=False):
+            render_logs_viewer()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
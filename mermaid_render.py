@@ -0,0 +1,200 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+# 服务端渲染使用本地 mermaid-cli（mmdc，需 Node.js 与其自带的无头浏览器）。
+# 可通过 MERMAID_CLI 指定可执行文件路径；找不到时退回浏览器端渲染。
+MERMAID_CLI_ENV = "MERMAID_CLI"
+MERMAID_CACHE_DIR = os.path.join("cache", "mermaid")
+MERMAID_RENDER_TIMEOUT_S = 60
+MERMAID_THEME = "neutral"
+# 渲染失败时（语法错误）的自动修复次数上限
+MERMAID_FIX_MAX_ATTEMPTS = 2
+# 页面展示用的后台渲染线程数
+MERMAID_RENDER_WORKERS = 2
+# 环境类失败（浏览器无法启动、超时等）后，同一份代码在这段时间内不再重试渲染
+MERMAID_TRANSIENT_RETRY_S = 60.0
+
+# mermaid 解析器报错的特征：只有这类失败说明代码本身有误（缓存并交给模型修复）；
+# 其余非零退出（无头浏览器启动失败、沙箱限制等）均视为环境问题，不缓存、不触发修复
+_SYNTAX_ERROR_MARKERS = ("parse error", "syntax error", "lexical error", "unknowndiagramerror", "no diagram type detected")
+
+# 同一份代码只渲染一次：并发请求同一哈希时串行等待；代码哈希 -> [锁, 持有与等待者数]，无人使用时移除
+_render_locks: Dict[str, list] = {}
+_render_locks_guard = threading.Lock()
+# 环境类失败的短期记录：代码哈希 -> (结果, 可重试时刻)；过期记录在写入新记录时清理
+_transient_failures: Dict[str, Tuple[Dict[str, Any], float]] = {}
+# 后台渲染：代码哈希 -> 进行中的任务
+_pending: Dict[str, Future] = {}
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def find_mermaid_cli() -> Optional[str]:
+    """返回 mermaid-cli 可执行文件路径；未安装时返回 None。"""
+    configured = os.getenv(MERMAID_CLI_ENV)
+    if configured:
+        return configured if os.path.exists(configured) or shutil.which(configured) else None
+    return shutil.which("mmdc")
+
+
+def code_hash(code: str) -> str:
+    return hashlib.sha256(f"{MERMAID_THEME}\n{code.strip()}".encode("utf-8")).hexdigest()[:24]
+
+
+def _cache_path(digest: str, fmt: str) -> str:
+    return os.path.join(MERMAID_CACHE_DIR, f"{digest}.{fmt}")
+
+
+def _error_path(digest: str) -> str:
+    return os.path.join(MERMAID_CACHE_DIR, f"{digest}.error.txt")
+
+
+def get_cached_render(code: str, fmt: str = "png") -> Optional[str]:
+    """返回已缓存的渲染结果路径（不触发渲染）。"""
+    path = _cache_path(code_hash(code), fmt)
+    return path if os.path.exists(path) else None
+
+
+@contextmanager
+def _render_lock(digest: str):
+    with _render_locks_guard:
+        entry = _render_locks.setdefault(digest, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _render_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                _render_locks.pop(digest, None)
+
+
+def _record_transient_failure(digest: str, result: Dict[str, Any]):
+    now = time.time()
+    with _render_locks_guard:
+        for key in [k for k, (_, until) in _transient_failures.items() if until <= now]:
+            del _transient_failures[key]
+        _transient_failures[digest] = (result, now + MERMAID_TRANSIENT_RETRY_S)
+
+
+def _run_cli(cli: str, code: str, out_path: str) -> Tuple[Optional[str], bool]:
+    """调用 mmdc 渲染到 out_path；返回 (错误信息, 是否为偶发错误)，成功时错误信息为 None。"""
+    with tempfile.TemporaryDirectory() as tmp:
+        in_path = os.path.join(tmp, "diagram.mmd")
+        tmp_out = os.path.join(tmp, "diagram" + os.path.splitext(out_path)[1])
+        with open(in_path, "w", encoding="utf-8") as f:
+            f.write(code)
+        try:
+            proc = subprocess.run(
+                [cli, "-i", in_path, "-o", tmp_out, "-t", MERMAID_THEME, "-b", "white", "-q"],
+                capture_output=True,
+                text=True,
+                timeout=MERMAID_RENDER_TIMEOUT_S,
+            )
+        except subprocess.TimeoutExpired:
+            return f"mermaid-cli 渲染超时（{MERMAID_RENDER_TIMEOUT_S}s）", True
+        except OSError as e:
+            return f"mermaid-cli 无法启动：{e}", True
+        if proc.returncode != 0 or not os.path.exists(tmp_out):
+            error = (proc.stderr or proc.stdout or "mermaid-cli 渲染失败").strip()[-2000:]
+            return error, not is_syntax_error(error)
+        os.replace(tmp_out, out_path)
+    return None, False
+
+
+def is_syntax_error(error: str) -> bool:
+    """mmdc 的报错是否为 Mermaid 解析器给出的语法错误。"""
+    text = error.lower()
+    return any(marker in text for marker in _SYNTAX_ERROR_MARKERS)
+
+
+def _cached_result(digest: str) -> Optional[Dict[str, Any]]:
+    svg_path, png_path = _cache_path(digest, "svg"), _cache_path(digest, "png")
+    if os.path.exists(svg_path) and os.path.exists(png_path):
+        return {"ok": True, "svg": svg_path, "png": png_path, "error": None, "cached": True}
+    if os.path.exists(_error_path(digest)):
+        with open(_error_path(digest), "r", encoding="utf-8") as f:
+            return {"ok": False, "svg": None, "png": None, "error": f.read(), "cached": True}
+    with _render_locks_guard:
+        transient = _transient_failures.get(digest)
+        if transient is not None and time.time() >= transient[1]:
+            del _transient_failures[digest]
+            transient = None
+    return transient[0] if transient is not None else None
+
+
+def render_mermaid(code: str) -> Dict[str, Any]:
+    """
+    校验并渲染一段 Mermaid 代码，结果以代码哈希为键缓存为 SVG 与 PNG。
+    返回 {"ok": True/False/None, "svg": 路径, "png": 路径, "error": 错误信息, "cached": bool}；
+    ok 为 False 仅表示语法错误；ok 为 None 表示未能校验（本机没有渲染器，或渲染器因环境问题失败），
+    此时不应据此修改代码。
+    """
+    digest = code_hash(code)
+    svg_path, png_path = _cache_path(digest, "svg"), _cache_path(digest, "png")
+    cached = _cached_result(digest)
+    if cached is not None:
+        return cached
+
+    cli = find_mermaid_cli()
+    if cli is None:
+        return {"ok": None, "svg": None, "png": None, "error": "未找到 mermaid-cli（mmdc），跳过服务端渲染", "cached": False}
+
+    with _render_lock(digest):
+        # 等锁期间其他线程可能已渲染完成或刚记录了失败
+        cached = _cached_result(digest)
+        if cached is not None:
+            return cached
+        os.makedirs(MERMAID_CACHE_DIR, exist_ok=True)
+        error, transient = _run_cli(cli, code, svg_path)
+        if error is None:
+            error, transient = _run_cli(cli, code, png_path)
+        if error is not None:
+            if transient:
+                # 环境问题不写入缓存，只在短时间内避免反复启动渲染器
+                result = {"ok": None, "svg": None, "png": None, "error": error, "cached": False}
+                _record_transient_failure(digest, result)
+                return result
+            # 语法错误同样缓存，避免同一份错误代码被反复渲染
+            with open(_error_path(digest), "w", encoding="utf-8") as f:
+                f.write(error)
+            return {"ok": False, "svg": None, "png": None, "error": error, "cached": False}
+    with _render_locks_guard:
+        _transient_failures.pop(digest, None)
+    return {"ok": True, "svg": svg_path, "png": png_path, "error": None, "cached": False}
+
+
+def render_mermaid_async(code: str) -> Optional[Dict[str, Any]]:
+    """
+    页面展示用的非阻塞渲染：已有结果（或本机没有渲染器）时立即返回，
+    否则提交到后台线程渲染并返回 None，渲染完成后再次调用即可取得结果。
+    """
+    global _executor
+    digest = code_hash(code)
+    cached = _cached_result(digest)
+    if cached is not None:
+        return cached
+    if find_mermaid_cli() is None:
+        return render_mermaid(code)
+    with _render_locks_guard:
+        if digest in _pending:
+            return None
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MERMAID_RENDER_WORKERS, thread_name_prefix="mermaid-render")
+        future = _executor.submit(render_mermaid, code)
+        _pending[digest] = future
+
+    def _done(_):
+        with _render_locks_guard:
+            _pending.pop(digest, None)
+
+    future.add_done_callback(_done)
+    return None
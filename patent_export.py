@@ -0,0 +1,224 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from derived_views import content_fingerprint
+from draft_document import DraftDocument, figure_labels_text
+from mermaid_render import render_mermaid
+
+# 导出文件缓存目录：以草稿内容指纹为文件名，重复预览与下载不再重新生成
+EXPORT_CACHE_DIR = os.path.join("cache", "export")
+# PDF 由 LibreOffice 无头模式从 DOCX 转换；可通过 LIBREOFFICE_BIN 指定可执行文件
+LIBREOFFICE_ENV = "LIBREOFFICE_BIN"
+PDF_CONVERT_TIMEOUT_S = 120
+# 导出格式版本：排版逻辑变化时递增，使旧缓存失效
+EXPORT_LAYOUT_VERSION = 1
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+PDF_MIME = "application/pdf"
+
+_export_locks: Dict[str, threading.Lock] = {}
+_export_locks_guard = threading.Lock()
+
+
+# -------------- DOCX --------------
+
+_MD_HEADING_RE = re.compile(r"^\s*#{1,6}\s*")
+_MD_EMPHASIS_RE = re.compile(r"(\*\*|__|\*|`)")
+_MD_BULLET_RE = re.compile(r"^\s*[-*+]\s+")
+
+
+def _plain_lines(text: str) -> Iterator[tuple]:
+    """将 Markdown 文本拆为 (是否为小标题, 纯文本) 行，去掉强调标记与空行。"""
+    for raw in (text or "").splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        is_heading = bool(_MD_HEADING_RE.match(line))
+        line = _MD_HEADING_RE.sub("", line)
+        line = _MD_BULLET_RE.sub("", line)
+        line = _MD_EMPHASIS_RE.sub("", line).strip()
+        if line:
+            yield is_heading, line
+
+
+def _load_docx():
+    try:
+        import docx
+        from docx.enum.text import WD_ALIGN_PARAGRAPH
+        from docx.oxml.ns import qn
+        from docx.shared import Cm, Pt
+    except ImportError as e:
+        raise RuntimeError("导出 DOCX 需要安装 python-docx：pip install python-docx") from e
+    return docx, WD_ALIGN_PARAGRAPH, qn, Cm, Pt
+
+
+def _write_docx(sections: Dict[str, Any], out_path: str) -> bool:
+    """
+    按国知局（CNIPA）申请文件的版式写出 DOCX：
+    权利要求书、说明书（段落编号 [0001] 起）、说明书附图、说明书摘要，各部分分页。
+    返回是否所有附图都已渲染（有占位图时为 False）。
+    """
+    docx, WD_ALIGN_PARAGRAPH, qn, Cm, Pt = _load_docx()
+    document = docx.Document()
+
+    normal = document.styles["Normal"]
+    normal.font.name = "SimSun"
+    normal.font.size = Pt(12)
+    normal.element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
+    normal.paragraph_format.line_spacing = 1.5
+    for section in document.sections:
+        section.top_margin = section.bottom_margin = Cm(2.5)
+        section.left_margin = Cm(2.5)
+        section.right_margin = Cm(1.5)
+
+    def part_title(text: str, first: bool = False):
+        if not first:
+            document.add_page_break()
+        p = document.add_paragraph()
+        p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        run = p.add_run(text)
+        run.bold = True
+        run.font.size = Pt(16)
+
+    def centered(text: str, bold: bool = False):
+        p = document.add_paragraph()
+        p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        p.add_run(text).bold = bold
+
+    # 权利要求书：每项权利要求一段
+    part_title("权利要求书", first=True)
+    for _, line in _plain_lines(sections["claims"]):
+        document.add_paragraph(line)
+
+    # 说明书：发明名称居中，五个部分的标题不编号，正文段落连续编号
+    part_title("说明书")
+    centered(sections["title"], bold=True)
+    paragraph_no = 0
+
+    def numbered(text: str, bold: bool = False):
+        nonlocal paragraph_no
+        paragraph_no += 1
+        p = document.add_paragraph()
+        p.add_run(f"[{paragraph_no:04d}] ")
+        p.add_run(text).bold = bold
+
+    figure_body = sections["figure_description"]
+    labels_text = figure_labels_text(sections)
+    if labels_text:
+        figure_body = f"{figure_body}\n{labels_text}"
+    for heading, body in (
+        ("技术领域", sections["technical_field"]),
+        ("背景技术", sections["background"]),
+        ("发明内容", sections["invention"]),
+        ("附图说明", figure_body),
+        ("具体实施方式", sections["implementation"]),
+    ):
+        document.add_paragraph().add_run(heading).bold = True
+        for is_heading, line in _plain_lines(body):
+            numbered(line, bold=is_heading)
+
+    # 说明书附图：使用服务端渲染缓存的 PNG；无法渲染时保留图题与占位说明
+    complete = True
+    if sections["drawings"]:
+        part_title("说明书附图")
+        for i, drawing in enumerate(sections["drawings"]):
+            result = render_mermaid(drawing.get("code", ""))
+            if result["ok"]:
+                document.add_picture(result["png"], width=Cm(15))
+                document.paragraphs[-1].alignment = WD_ALIGN_PARAGRAPH.CENTER
+            else:
+                complete = False
+                centered("（附图未能渲染，请在应用中查看或导出图片）")
+            centered(f"图{i+1}")
+
+    part_title("说明书摘要")
+    for _, line in _plain_lines(sections["abstract"]):
+        document.add_paragraph(line)
+
+    document.save(out_path)
+    return complete
+
+
+# -------------- PDF --------------
+
+def find_libreoffice() -> Optional[str]:
+    """返回 LibreOffice 可执行文件路径；未安装时返回 None。"""
+    configured = os.getenv(LIBREOFFICE_ENV)
+    if configured:
+        return configured if os.path.exists(configured) or shutil.which(configured) else None
+    return shutil.which("soffice") or shutil.which("libreoffice")
+
+
+def _convert_to_pdf(docx_path: str, out_path: str):
+    office = find_libreoffice()
+    if office is None:
+        raise RuntimeError("导出 PDF 需要安装 LibreOffice（或通过 LIBREOFFICE_BIN 指定 soffice 路径）")
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            proc = subprocess.run(
+                [office, "--headless", "--convert-to", "pdf", "--outdir", tmp, docx_path],
+                capture_output=True,
+                text=True,
+                timeout=PDF_CONVERT_TIMEOUT_S,
+            )
+        except subprocess.TimeoutExpired as e:
+            raise RuntimeError(f"PDF 转换超时（{PDF_CONVERT_TIMEOUT_S}s）") from e
+        produced = os.path.join(tmp, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf")
+        if proc.returncode != 0 or not os.path.exists(produced):
+            raise RuntimeError(f"PDF 转换失败：{(proc.stderr or proc.stdout).strip()[-500:]}")
+        shutil.move(produced, out_path)
+
+
+# -------------- 导出入口 --------------
+
+def _lock_for(key: str) -> threading.Lock:
+    with _export_locks_guard:
+        lock = _export_locks.get(key)
+        if lock is None:
+            lock = threading.Lock()
+            _export_locks[key] = lock
+        return lock
+
+
+def export_fingerprint(doc: DraftDocument) -> str:
+    """导出结果的缓存键：草稿快照指纹与排版版本共同决定。"""
+    return content_fingerprint([doc.fingerprint, EXPORT_LAYOUT_VERSION])
+
+
+def export_draft(doc: DraftDocument, fmt: str = "docx") -> str:
+    """
+    生成草稿的 DOCX 或 PDF 文件并返回其路径。
+    文件以内容指纹命名缓存在磁盘上，同一内容只生成一次（并发请求同一内容时串行等待）；
+    有附图未能渲染（如渲染器暂时失败）时结果不进入缓存，下次导出重新渲染。
+    """
+    if fmt not in ("docx", "pdf"):
+        raise ValueError(f"不支持的导出格式：{fmt}")
+    return _export(doc, fmt)[0]
+
+
+def _export(doc: DraftDocument, fmt: str) -> Tuple[str, bool]:
+    """返回 (文件路径, 是否完整)；不完整的结果写到 .incomplete 文件，不会被当作缓存命中。"""
+    digest = export_fingerprint(doc)
+    out_path = os.path.join(EXPORT_CACHE_DIR, f"{digest}.{fmt}")
+    if os.path.exists(out_path):
+        return out_path, True
+
+    with _lock_for(f"{digest}.{fmt}"):
+        if os.path.exists(out_path):
+            return out_path, True
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        if fmt == "pdf":
+            docx_path, complete = _export(doc, "docx")
+            target = out_path if complete else os.path.join(EXPORT_CACHE_DIR, f"{digest}.incomplete.pdf")
+            _convert_to_pdf(docx_path, target)
+        else:
+            tmp_path = f"{out_path}.tmp"
+            complete = _write_docx(doc.sections, tmp_path)
+            target = out_path if complete else os.path.join(EXPORT_CACHE_DIR, f"{digest}.incomplete.docx")
+            os.replace(tmp_path, target)
+    return target, complete
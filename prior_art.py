@@ -0,0 +1,85 @@
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from config import load_server_config
+from derived_views import DERIVED_VIEWS, content_fingerprint
+
+# 注入 Prompt 的摘要最大长度
+ABSTRACT_MAX_CHARS = 400
+
+_INDEX = None
+_INDEX_MTIME = 0.0
+_INDEX_LOCK = threading.Lock()
+
+
+def get_prior_art_index():
+    """
+    返回进程级共享的只读索引（目录由 PRIOR_ART_INDEX_DIR 配置）；未配置或尚未构建时返回 None。
+    构建进程更新 manifest 后自动重新打开。索引引擎（numpy）在首次打开索引时才导入。
+    """
+    global _INDEX, _INDEX_MTIME
+    root = load_server_config()["prior_art_index_dir"]
+    manifest = os.path.join(root, "manifest.json") if root else ""
+    if not manifest or not os.path.exists(manifest):
+        return None
+    mtime = os.path.getmtime(manifest)
+    with _INDEX_LOCK:
+        if _INDEX is None or _INDEX.root != root or mtime != _INDEX_MTIME:
+            from prior_art_index import PriorArtIndex
+            _INDEX = PriorArtIndex(root)
+            _INDEX_MTIME = mtime
+        return _INDEX
+
+
+def prior_art_query(brief: Dict[str, Any]) -> str:
+    """由结构化摘要拼出检索查询：现有技术、技术问题、核心构思与技术方案。"""
+    fields = ("background_technology", "problem_statement", "core_inventive_concept", "technical_solution_summary")
+    return "\n".join(str(brief.get(f) or "") for f in fields).strip()
+
+
+def _query_vector(query: str) -> Optional[List[float]]:
+    model = load_server_config()["prior_art_embed_model"]
+    if not model:
+        return None
+    from config import load_config
+    from llm_client import get_llm_client
+    return get_llm_client(load_config()).embed([query], model)[0]
+
+
+def search_prior_art(brief: Dict[str, Any], k: Optional[int] = None) -> List[Dict[str, Any]]:
+    """检索与结构化摘要最相关的现有技术；索引不可用时返回空列表。"""
+    index = get_prior_art_index()
+    query = prior_art_query(brief)
+    if index is None or not query:
+        return []
+    k = k or load_server_config()["prior_art_top_k"]
+    query_vector = None
+    if index.dim:
+        try:
+            query_vector = _query_vector(query)
+        except Exception:
+            # 向量服务不可用时退回纯 BM25
+            query_vector = None
+    return index.search(query, k, query_vector)
+
+
+def cached_prior_art(brief: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """按 (索引版本, 查询指纹) 缓存检索结果：摘要未变时各步骤与界面复用同一结果。"""
+    index = get_prior_art_index()
+    query = prior_art_query(brief)
+    if index is None or not query:
+        return []
+    key = (index.root, index.version, content_fingerprint(query))
+    return DERIVED_VIEWS.get_by_key("prior_art", key, lambda: search_prior_art(brief))
+
+
+def format_prior_art(hits: List[Dict[str, Any]]) -> str:
+    """格式化为注入 Prompt 的参考文献列表。"""
+    lines = []
+    for i, hit in enumerate(hits):
+        abstract = hit.get("abstract") or ""
+        if len(abstract) > ABSTRACT_MAX_CHARS:
+            abstract = abstract[:ABSTRACT_MAX_CHARS] + "……"
+        lines.append(f"[{i+1}] {hit['id']}《{hit.get('title') or ''}》\n摘要：{abstract}")
+    return "\n".join(lines)
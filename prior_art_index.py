@@ -0,0 +1,668 @@
+"""
+本地现有技术检索索引：对本地提供的专利语料（CNIPA/USPTO XML 或 JSONL）建立 BM25 倒排索引（可选向量重排）。
+应用通过 prior_art 模块查询，为“背景技术”步骤注入最相关的若干篇专利摘要。
+
+索引由若干只读段（segment）组成，数组以 .npy 保存并以内存映射方式打开，查询只触及命中的倒排表；
+增量构建只处理新增或变化的语料文件，写入新段，同一公开号的旧文档以删除标记屏蔽，小段按层级合并。
+段文件写入后不再修改：删除标记按 manifest 版本另存为新文件（deleted_<版本>.npy），
+与新段一起随 manifest 原子切换，正在查询的应用在切换前始终看到完整的旧版本。
+被合并掉的段与旧的删除标记文件一样多保留一个 manifest 版本，再由下一次构建删除。
+
+用法：
+    python prior_art_index.py build corpus.jsonl uspto_2024.xml [--index DIR] [--rebuild] [--embed-model MODEL]
+    python prior_art_index.py search "查询文本" [-k 5] [--index DIR]
+
+JSONL 每行一篇：{"id": "CN112345678A", "title": "...", "abstract": "..."}（也接受 publication_number / invention_title 等字段名）。
+XML 支持 USPTO 批量文件（多个 XML 文档首尾相接）与 CNIPA 单篇/合并文件，读取公开号、发明名称与摘要。
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from array import array
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from config import load_server_config
+
+MANIFEST_FILE = "manifest.json"
+# 段创建时的删除标记文件；此后的删除标记按 manifest 版本写入 deleted_<版本>.npy
+INITIAL_DELETED_FILE = "deleted.npy"
+# 单个新段的最大文档数（控制构建时的内存占用）
+SEGMENT_MAX_DOCS = 50_000
+# 同时存在这么多个小段时合并为一个；合并后的段不超过 MERGE_MAX_DOCS
+MERGE_FACTOR = 8
+MERGE_MAX_DOCS = 400_000
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 查询最多使用的词项数（按 idf 取前若干个），以及忽略的高频词项（文档频率占比）
+QUERY_MAX_TERMS = 64
+MAX_DF_RATIO = 0.2
+# 向量重排：对 BM25 前 RERANK_POOL 个候选按余弦相似度加权重排
+RERANK_POOL = 100
+DENSE_WEIGHT = 0.5
+EMBED_BATCH = 64
+
+_TOKEN_RE = re.compile(r"[一-鿿]+|[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+
+
+# -------------- 分词 --------------
+
+def tokenize(text: str) -> List[str]:
+    """中文按字二元组切分（单字保留），英文与数字按词切分并转小写。无需分词词典。"""
+    tokens: List[str] = []
+    for m in _TOKEN_RE.finditer((text or "").lower()):
+        run = m.group()
+        if "一" <= run[0] <= "鿿":
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif len(run) > 1:
+            tokens.append(run)
+    return tokens
+
+
+@lru_cache(maxsize=1 << 18)
+def _term_hash(term: str) -> int:
+    """词项以 64 位哈希存储，词典即一个有序 uint64 数组。"""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+# -------------- 语料读取 --------------
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1].lower().replace("_", "-")
+
+
+def _xml_record(root: ET.Element) -> Optional[Dict[str, str]]:
+    title = abstract = ""
+    doc_id = ""
+    for el in root.iter():
+        name = _local_name(el.tag)
+        if not title and name in ("invention-title", "inventiontitle"):
+            title = " ".join("".join(el.itertext()).split())
+        elif not abstract and name == "abstract":
+            abstract = " ".join("".join(el.itertext()).split())
+        elif not doc_id and name in ("publication-reference", "publicationreference"):
+            parts = {}
+            for child in el.iter():
+                child_name = _local_name(child.tag)
+                if child_name in ("country", "doc-number", "docnumber", "kind") and child.text:
+                    parts.setdefault(child_name, child.text.strip())
+            doc_id = parts.get("country", "") + (parts.get("doc-number") or parts.get("docnumber", "")) + parts.get("kind", "")
+    if not doc_id:
+        number = root.find(".//{*}doc-number")
+        doc_id = number.text.strip() if number is not None and number.text else ""
+    if not doc_id or not (title or abstract):
+        return None
+    return {"id": doc_id, "title": title, "abstract": abstract}
+
+
+def _iter_xml_documents(path: str) -> Iterator[str]:
+    """USPTO 批量文件由多个完整 XML 文档首尾相接而成，按 XML 声明切分。"""
+    opener = gzip.open if path.endswith(".gz") else open
+    buffer: List[str] = []
+    with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if line.startswith("<?xml") and buffer:
+                yield "".join(buffer)
+                buffer = []
+            buffer.append(line)
+    if buffer:
+        yield "".join(buffer)
+
+
+def _json_record(item: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    doc_id = item.get("id") or item.get("publication_number") or item.get("pub_id") or item.get("doc_id")
+    title = item.get("title") or item.get("invention_title") or ""
+    abstract = item.get("abstract") or item.get("abstract_text") or ""
+    if not doc_id or not (title or abstract):
+        return None
+    return {"id": str(doc_id), "title": str(title), "abstract": str(abstract)}
+
+
+def iter_corpus(path: str) -> Iterator[Dict[str, str]]:
+    """逐篇读取语料文件，产出 {"id", "title", "abstract"}；无法解析的条目跳过。"""
+    lower = path.lower()
+    if lower.endswith((".xml", ".xml.gz")):
+        for text in _iter_xml_documents(path):
+            try:
+                record = _xml_record(ET.fromstring(re.sub(r"<!DOCTYPE[^>]*>", "", text)))
+            except ET.ParseError:
+                continue
+            if record:
+                yield record
+        return
+    opener = gzip.open if lower.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = _json_record(json.loads(line))
+            except (json.JSONDecodeError, AttributeError):
+                continue
+            if record:
+                yield record
+
+
+def _doc_text(record: Dict[str, str]) -> str:
+    return f"{record.get('title', '')}\n{record.get('abstract', '')}"
+
+
+# -------------- 段：写入 --------------
+
+def _write_segment(path: str, term_hashes: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray,
+                   doc_lens: np.ndarray, doc_lines: Iterable[bytes], id_hashes: np.ndarray,
+                   vectors: Optional[np.ndarray], deleted: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """将倒排数据写入段目录；postings 按 (词项哈希, 文档号) 排序。deleted 为初始删除标记。返回段元信息。"""
+    os.makedirs(path)
+    order = np.lexsort((doc_ids, term_hashes))
+    term_hashes, doc_ids, tfs = term_hashes[order], doc_ids[order], tfs[order]
+    terms, starts = np.unique(term_hashes, return_index=True)
+    offsets = np.append(starts, len(term_hashes)).astype(np.uint64)
+    np.save(os.path.join(path, "terms.npy"), terms.astype(np.uint64))
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "postings_doc.npy"), doc_ids.astype(np.uint32))
+    np.save(os.path.join(path, "postings_tf.npy"), tfs.astype(np.uint16))
+    np.save(os.path.join(path, "doc_len.npy"), doc_lens.astype(np.uint32))
+    np.save(os.path.join(path, "id_hash.npy"), id_hashes.astype(np.uint64))
+    id_order = np.argsort(id_hashes, kind="stable").astype(np.uint32)
+    np.save(os.path.join(path, "id_order.npy"), id_order)
+    if deleted is None:
+        deleted = np.zeros(len(doc_lens), dtype=np.uint8)
+    np.save(os.path.join(path, INITIAL_DELETED_FILE), deleted.astype(np.uint8))
+
+    line_offsets = array("Q", [0])
+    with open(os.path.join(path, "docs.jsonl"), "wb") as f:
+        for line in doc_lines:
+            f.write(line)
+            line_offsets.append(line_offsets[-1] + len(line))
+    np.save(os.path.join(path, "docs_offsets.npy"), np.frombuffer(line_offsets, dtype=np.uint64))
+
+    dim = 0
+    if vectors is not None and len(vectors):
+        np.save(os.path.join(path, "vectors.npy"), vectors.astype(np.float16))
+        dim = int(vectors.shape[1])
+    return {
+        "name": os.path.basename(path),
+        "docs": int(len(doc_lens)),
+        "total_len": int(doc_lens.sum()),
+        "dim": dim,
+        "created_at": time.time(),
+    }
+
+
+class _SegmentBuilder:
+    """在内存中累积一段文档的倒排数据，写满 SEGMENT_MAX_DOCS 后落盘。"""
+
+    def __init__(self):
+        self.term_hashes = array("Q")
+        self.doc_ids = array("I")
+        self.tfs = array("H")
+        self.doc_lens = array("I")
+        self.id_hashes = array("Q")
+        self.lines: List[bytes] = []
+        self.records: List[Dict[str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.doc_lens)
+
+    def add(self, record: Dict[str, str]):
+        doc = len(self.doc_lens)
+        tokens = tokenize(_doc_text(record))
+        for term, tf in Counter(tokens).items():
+            self.term_hashes.append(_term_hash(term))
+            self.doc_ids.append(doc)
+            self.tfs.append(min(tf, 0xFFFF))
+        self.doc_lens.append(len(tokens))
+        self.id_hashes.append(_term_hash(record["id"]))
+        self.lines.append((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.records.append(record)
+
+    def write(self, path: str, embedder: Optional[Callable[[List[str]], List[List[float]]]],
+              deleted: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        vectors = _embed_records(self.records, embedder) if embedder is not None else None
+        return _write_segment(
+            path,
+            np.frombuffer(self.term_hashes, dtype=np.uint64),
+            np.frombuffer(self.doc_ids, dtype=np.uint32),
+            np.frombuffer(self.tfs, dtype=np.uint16),
+            np.frombuffer(self.doc_lens, dtype=np.uint32),
+            self.lines,
+            np.frombuffer(self.id_hashes, dtype=np.uint64),
+            vectors,
+            deleted,
+        )
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _embed_records(records: List[Dict[str, str]], embedder: Callable[[List[str]], List[List[float]]]) -> np.ndarray:
+    rows: List[List[float]] = []
+    for start in range(0, len(records), EMBED_BATCH):
+        rows.extend(embedder([_doc_text(r)[:2000] for r in records[start:start + EMBED_BATCH]]))
+    return _normalize_rows(np.asarray(rows, dtype=np.float32))
+
+
+# -------------- 段：读取 --------------
+
+class _Segment:
+    """
+    以内存映射方式打开的只读段。删除标记取 meta 中记录的文件；构建进程新增的删除标记
+    先保存在内存副本中（dirty），由 PriorArtIndex 在写 manifest 时另存为新文件。
+    """
+
+    def __init__(self, path: str, meta: Dict[str, Any]):
+        self.path = path
+        self.meta = meta
+
+        def load(name: str, mode: str = "r"):
+            return np.load(os.path.join(path, name), mmap_mode=mode)
+
+        self.terms = load("terms.npy")
+        self.offsets = load("offsets.npy")
+        self.postings_doc = load("postings_doc.npy")
+        self.postings_tf = load("postings_tf.npy")
+        self.doc_len = load("doc_len.npy")
+        self.id_hash = load("id_hash.npy")
+        self.id_order = load("id_order.npy")
+        self.docs_offsets = load("docs_offsets.npy")
+        self.deleted = load(meta.get("deleted_file", INITIAL_DELETED_FILE))
+        self.dirty = False
+        vectors_path = os.path.join(path, "vectors.npy")
+        self.vectors = np.load(vectors_path, mmap_mode="r") if os.path.exists(vectors_path) else None
+
+    @property
+    def docs(self) -> int:
+        return self.meta["docs"]
+
+    def lookup(self, hashes: np.ndarray):
+        """返回各词项在本段中的 (倒排起点, 文档频率)，未出现的词项文档频率为 0。"""
+        if len(self.terms) == 0:
+            zeros = np.zeros(len(hashes), dtype=np.int64)
+            return zeros, zeros
+        pos = np.searchsorted(self.terms, hashes)
+        pos_clipped = np.minimum(pos, len(self.terms) - 1)
+        found = self.terms[pos_clipped] == hashes
+        starts = np.where(found, self.offsets[pos_clipped], 0).astype(np.int64)
+        ends = np.where(found, self.offsets[pos_clipped + 1], 0).astype(np.int64)
+        return starts, ends - starts
+
+    def find_docs(self, id_hashes: np.ndarray) -> np.ndarray:
+        """本段中公开号哈希命中的文档号（含已删除的）。"""
+        if self.docs == 0:
+            return np.zeros(0, dtype=np.int64)
+        sorted_ids = self.id_hash[self.id_order]
+        left = np.searchsorted(sorted_ids, id_hashes, side="left")
+        right = np.searchsorted(sorted_ids, id_hashes, side="right")
+        hits = [self.id_order[l:r] for l, r in zip(left, right) if r > l]
+        return np.concatenate(hits).astype(np.int64) if hits else np.zeros(0, dtype=np.int64)
+
+    def document(self, doc: int) -> Dict[str, str]:
+        start, end = int(self.docs_offsets[doc]), int(self.docs_offsets[doc + 1])
+        with open(os.path.join(self.path, "docs.jsonl"), "rb") as f:
+            f.seek(start)
+            return json.loads(f.read(end - start))
+
+    def live_count(self) -> int:
+        return self.docs - int(self.deleted.sum())
+
+    def mark_deleted(self, docs: np.ndarray):
+        """在内存副本上标记删除（不修改已发布的文件）。"""
+        if not self.dirty:
+            self.deleted = np.array(self.deleted)
+            self.dirty = True
+        self.deleted[docs] = 1
+
+    def publish_deleted(self, version: int) -> Optional[str]:
+        """把内存中的删除标记写为本版本的新文件并记入 meta；返回被取代的文件名。"""
+        if not self.dirty:
+            return None
+        name = f"deleted_{version}.npy"
+        tmp = os.path.join(self.path, name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, self.deleted)
+        os.replace(tmp, os.path.join(self.path, name))
+        previous = self.meta.get("deleted_file", INITIAL_DELETED_FILE)
+        self.meta["deleted_file"] = name
+        self.deleted = np.load(os.path.join(self.path, name), mmap_mode="r")
+        self.dirty = False
+        return previous
+
+
+# -------------- 索引 --------------
+
+class PriorArtIndex:
+    """
+    由多个段组成的现有技术索引。manifest.json 记录段列表、已索引的语料文件与全局统计；
+    manifest 以原子替换方式更新，构建过程中应用仍可照常查询旧版本。
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.manifest: Dict[str, Any] = {"segments": [], "sources": {}, "dim": 0, "version": 0}
+        self.segments: List[_Segment] = []
+        self._load()
+
+    # --- manifest ---
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.root, MANIFEST_FILE)
+
+    def _load(self):
+        path = self._manifest_path()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        self.segments = [
+            _Segment(os.path.join(self.root, meta["name"]), meta)
+            for meta in self.manifest["segments"]
+        ]
+
+    def _save_manifest(self, retired: Sequence[str] = ()):
+        """
+        原子替换 manifest。retired 为本版本移出的段：与旧的删除标记文件一样保留一个版本，
+        供仍在使用上一版本 manifest 的读者读完，下一次保存 manifest 后再删除目录。
+        """
+        version = self.manifest.get("version", 0) + 1
+        pending = self.manifest.get("retired", [])
+        expired = [r["name"] for r in pending if r["version"] < version]
+        self.manifest["retired"] = [r for r in pending if r["version"] >= version] + [
+            {"name": name, "version": version} for name in retired
+        ]
+        # 新的删除标记先写成本版本的独立文件，manifest 切换后读者才会看到
+        superseded = []
+        for segment in self.segments:
+            previous = segment.publish_deleted(version)
+            if previous is not None:
+                superseded.append((segment, previous))
+        self.manifest["segments"] = [s.meta for s in self.segments]
+        self.manifest["version"] = version
+        self.manifest["updated_at"] = time.time()
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self._manifest_path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self._manifest_path())
+        for segment, previous in superseded:
+            self._prune_deleted_files(segment, keep={segment.meta["deleted_file"], previous})
+        for name in expired:
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    @staticmethod
+    def _prune_deleted_files(segment: _Segment, keep: set):
+        """清理更早版本的删除标记文件；保留上一版本的文件，供刚读到旧 manifest 的读者打开。"""
+        for name in os.listdir(segment.path):
+            if name.startswith("deleted_") and name.endswith(".npy") and name not in keep:
+                try:
+                    os.remove(os.path.join(segment.path, name))
+                except OSError:
+                    pass
+
+    @property
+    def version(self) -> int:
+        return self.manifest.get("version", 0)
+
+    @property
+    def dim(self) -> int:
+        return self.manifest.get("dim", 0)
+
+    def doc_count(self) -> int:
+        return sum(s.docs for s in self.segments) - self.manifest.get("deleted", 0)
+
+    def _avgdl(self) -> float:
+        docs = sum(s.docs for s in self.segments)
+        return (sum(s.meta["total_len"] for s in self.segments) / docs) if docs else 1.0
+
+    # --- 构建 ---
+
+    def _new_segment_path(self) -> str:
+        return os.path.join(self.root, f"seg_{int(time.time())}_{uuid.uuid4().hex[:8]}")
+
+    def _tombstone(self, id_hashes: np.ndarray):
+        """屏蔽旧段中与新文档公开号相同的文档（随下一次 manifest 一并发布）。"""
+        for segment in self.segments:
+            docs = segment.find_docs(id_hashes)
+            if len(docs):
+                fresh = docs[np.asarray(segment.deleted[docs]) == 0]
+                if len(fresh):
+                    segment.mark_deleted(fresh)
+                    self.manifest["deleted"] = self.manifest.get("deleted", 0) + len(fresh)
+
+    def _flush_builder(self, builder: _SegmentBuilder, embedder) -> None:
+        if not len(builder):
+            return
+        id_hashes = np.frombuffer(builder.id_hashes, dtype=np.uint64)
+        # 同一批内重复的公开号只保留最后一篇
+        _, last_index = np.unique(id_hashes[::-1], return_index=True)
+        keep = np.zeros(len(id_hashes), dtype=bool)
+        keep[len(id_hashes) - 1 - last_index] = True
+        self._tombstone(np.unique(id_hashes))
+        path = self._new_segment_path()
+        # 新段尚未写入 manifest，批内重复直接写入其初始删除标记
+        meta = builder.write(path, embedder, deleted=(~keep).astype(np.uint8))
+        segment = _Segment(path, meta)
+        self.manifest["deleted"] = self.manifest.get("deleted", 0) + int((~keep).sum())
+        self.segments.append(segment)
+        if meta["dim"]:
+            self.manifest["dim"] = meta["dim"]
+        self._save_manifest()
+
+    def add_documents(self, records: Iterable[Dict[str, str]],
+                      embedder: Optional[Callable[[List[str]], List[List[float]]]] = None) -> int:
+        """追加文档（同一公开号的旧版本被替换），每 SEGMENT_MAX_DOCS 篇写成一个新段。返回写入的篇数。"""
+        builder = _SegmentBuilder()
+        added = 0
+        for record in records:
+            builder.add(record)
+            added += 1
+            if len(builder) >= SEGMENT_MAX_DOCS:
+                self._flush_builder(builder, embedder)
+                builder = _SegmentBuilder()
+        self._flush_builder(builder, embedder)
+        self._merge_small_segments()
+        return added
+
+    def build(self, paths: Sequence[str], embedder=None, log: Callable[[str], None] = print) -> int:
+        """增量索引语料文件：大小与修改时间均未变化的文件跳过。返回新写入的篇数。"""
+        total = 0
+        sources = self.manifest.setdefault("sources", {})
+        for path in paths:
+            stat = os.stat(path)
+            key = os.path.abspath(path)
+            signature = {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+            if sources.get(key) == signature:
+                log(f"跳过未变化的语料：{path}")
+                continue
+            t0 = time.perf_counter()
+            added = self.add_documents(iter_corpus(path), embedder)
+            sources[key] = signature
+            self._save_manifest()
+            total += added
+            log(f"已索引 {path}：{added} 篇，用时 {time.perf_counter() - t0:.1f}s")
+        return total
+
+    def _merge_small_segments(self):
+        """层级合并：最小的 MERGE_FACTOR 个段合计不超过 MERGE_MAX_DOCS 时合并为一段，同时清除已删除文档。"""
+        while len(self.segments) >= MERGE_FACTOR:
+            candidates = sorted(self.segments, key=lambda s: s.docs)[:MERGE_FACTOR]
+            if sum(s.live_count() for s in candidates) > MERGE_MAX_DOCS:
+                return
+            merged = self._merge(candidates)
+            names = {s.meta["name"] for s in candidates}
+            removed_deleted = sum(int(s.deleted.sum()) for s in candidates)
+            self.segments = [s for s in self.segments if s.meta["name"] not in names] + [merged]
+            self.manifest["deleted"] = self.manifest.get("deleted", 0) - removed_deleted
+            self._save_manifest(retired=sorted(names))
+
+    def _merge(self, segments: List[_Segment]) -> _Segment:
+        """直接合并各段的倒排数组（无需重新分词），已删除文档被丢弃。"""
+        term_parts, doc_parts, tf_parts = [], [], []
+        lens, ids, vectors = [], [], []
+        lines: List[bytes] = []
+        base = 0
+        with_vectors = all(s.vectors is not None for s in segments)
+        for s in segments:
+            live = np.asarray(s.deleted) == 0
+            remap = np.cumsum(live) - 1 + base
+            counts = np.diff(np.asarray(s.offsets)).astype(np.int64)
+            terms = np.repeat(np.asarray(s.terms), counts)
+            docs = np.asarray(s.postings_doc)
+            keep = live[docs]
+            term_parts.append(terms[keep])
+            doc_parts.append(remap[docs[keep]].astype(np.uint32))
+            tf_parts.append(np.asarray(s.postings_tf)[keep])
+            lens.append(np.asarray(s.doc_len)[live])
+            ids.append(np.asarray(s.id_hash)[live])
+            if with_vectors:
+                vectors.append(np.asarray(s.vectors)[live])
+            with open(os.path.join(s.path, "docs.jsonl"), "rb") as f:
+                for doc, line in enumerate(f):
+                    if live[doc]:
+                        lines.append(line)
+            base += int(live.sum())
+        path = self._new_segment_path()
+        meta = _write_segment(
+            path,
+            np.concatenate(term_parts), np.concatenate(doc_parts), np.concatenate(tf_parts),
+            np.concatenate(lens), lines, np.concatenate(ids),
+            np.concatenate(vectors) if with_vectors and vectors else None,
+        )
+        return _Segment(path, meta)
+
+    # --- 查询 ---
+
+    def search(self, query: str, k: int = 5, query_vector: Optional[Sequence[float]] = None) -> List[Dict[str, Any]]:
+        """
+        BM25 检索前 k 篇（给出 query_vector 且索引含向量时，对候选按余弦相似度加权重排）。
+        返回 [{"id", "title", "abstract", "score"}]。
+        """
+        if not self.segments:
+            return []
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        query_tf = Counter(_term_hash(t) for t in tokens)
+        hashes = np.fromiter(query_tf.keys(), dtype=np.uint64, count=len(query_tf))
+        qtf = np.fromiter(query_tf.values(), dtype=np.float32, count=len(query_tf))
+
+        lookups = [s.lookup(hashes) for s in self.segments]
+        df = np.sum([dfs for _, dfs in lookups], axis=0)
+        n_docs = max(1, self.doc_count())
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        # 只保留出现过且不过于常见的词项，按 idf 取前 QUERY_MAX_TERMS 个
+        usable = (df > 0) & (df <= max(1, MAX_DF_RATIO * n_docs))
+        if not usable.any():
+            usable = df > 0
+        selected = np.flatnonzero(usable)
+        selected = selected[np.argsort(-idf[selected])][:QUERY_MAX_TERMS]
+        if not len(selected):
+            return []
+
+        avgdl = self._avgdl()
+        pool = max(k, RERANK_POOL if query_vector is not None else k)
+        candidates: List[tuple] = []
+        for seg_index, (segment, (starts, dfs)) in enumerate(zip(self.segments, lookups)):
+            doc_parts, weight_parts = [], []
+            for j in selected:
+                if dfs[j] == 0:
+                    continue
+                start, end = starts[j], starts[j] + dfs[j]
+                docs = np.asarray(segment.postings_doc[start:end])
+                tf = np.asarray(segment.postings_tf[start:end], dtype=np.float32)
+                dl = np.asarray(segment.doc_len[docs], dtype=np.float32)
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl)
+                doc_parts.append(docs)
+                weight_parts.append(idf[j] * qtf[j] * tf * (BM25_K1 + 1) / norm)
+            if not doc_parts:
+                continue
+            docs = np.concatenate(doc_parts)
+            scores = np.bincount(docs, weights=np.concatenate(weight_parts))
+            hit_docs = np.flatnonzero(scores)
+            hit_docs = hit_docs[np.asarray(segment.deleted[hit_docs]) == 0]
+            if not len(hit_docs):
+                continue
+            if len(hit_docs) > pool:
+                top = np.argpartition(-scores[hit_docs], pool - 1)[:pool]
+                hit_docs = hit_docs[top]
+            candidates.extend((float(scores[d]), seg_index, int(d)) for d in hit_docs)
+
+        candidates.sort(key=lambda c: -c[0])
+        candidates = candidates[:pool]
+        if query_vector is not None and self.dim and all(s.vectors is not None for s in self.segments) and candidates:
+            qv = _normalize_rows(np.asarray([query_vector], dtype=np.float32))[0]
+            best = candidates[0][0] or 1.0
+            rescored = []
+            for score, seg_index, doc in candidates:
+                cosine = float(np.dot(np.asarray(self.segments[seg_index].vectors[doc], dtype=np.float32), qv))
+                rescored.append((score / best + DENSE_WEIGHT * cosine, seg_index, doc))
+            candidates = sorted(rescored, key=lambda c: -c[0])
+
+        hits = []
+        for score, seg_index, doc in candidates[:k]:
+            record = self.segments[seg_index].document(doc)
+            record["score"] = round(score, 4)
+            hits.append(record)
+        return hits
+
+
+# -------------- 命令行 --------------
+
+def _embedder_for(model: str) -> Callable[[List[str]], List[List[float]]]:
+    from config import load_config
+    from llm_client import LLMClient
+    client = LLMClient(load_config())
+    return lambda texts: client.embed(texts, model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="构建与查询本地现有技术检索索引")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="增量索引语料文件（JSONL / XML，可为 .gz）")
+    build.add_argument("paths", nargs="+")
+    build.add_argument("--index", default=None, help="索引目录（默认取 PRIOR_ART_INDEX_DIR）")
+    build.add_argument("--rebuild", action="store_true", help="清空索引后重新构建")
+    build.add_argument("--embed-model", default=None, help="同时写入向量（使用当前提供商的嵌入模型）")
+    search = sub.add_parser("search", help="检索")
+    search.add_argument("query")
+    search.add_argument("-k", type=int, default=5)
+    search.add_argument("--index", default=None)
+    args = parser.parse_args()
+
+    root = args.index or load_server_config()["prior_art_index_dir"]
+    if not root:
+        raise SystemExit("请通过 --index 或 PRIOR_ART_INDEX_DIR 指定索引目录。")
+    if args.command == "build":
+        if args.rebuild and os.path.isdir(root):
+            shutil.rmtree(root)
+        index = PriorArtIndex(root)
+        embedder = _embedder_for(args.embed_model) if args.embed_model else None
+        added = index.build(args.paths, embedder)
+        print(json.dumps({"added": added, "docs": index.doc_count(), "segments": len(index.segments)}, ensure_ascii=False))
+    else:
+        index = PriorArtIndex(root)
+        t0 = time.perf_counter()
+        hits = index.search(args.query, args.k)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        print(json.dumps({"elapsed_ms": round(elapsed_ms, 2), "hits": hits}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,29 @@ f"{ROLE_INSTRUCTION}\n"
 "技术交底材料：\n{user_input}"
 )
 
+# 长交底材料：分块提炼（map）与合并（reduce）
+PROMPT_ANALYZE_CHUNK = (
+f"{ROLE_INSTRUCTION}\n"
+"任务：以下是一份较长技术交底材料中的一个片段。只根据该片段提炼其中出现的信息，输出与完整分析相同字段的 JSON 对象。\n"
+"输出：仅返回有效 JSON，必须以 {{ 开头、以 }} 结尾。\n"
+"字段：background_technology、problem_statement、core_inventive_concept、technical_solution_summary（string），"
+"key_components_or_steps（array，对象包含 name 与 function），achieved_effects（string，每行一个效果）。\n"
+"规范：片段中没有涉及的字段填 null（数组字段用 []），不得根据常识补全；保留片段中的具体参数、数值与组件名称。\n\n"
+"交底材料片段：\n{chunk_text}"
+)
+
+PROMPT_ANALYZE_REDUCE = (
+f"{ROLE_INSTRUCTION}\n"
+"任务：下面是从同一份技术交底材料的各个片段中分别提炼出的信息（已按字段初步汇总）。请将其合并为一个完整、一致的结构化 JSON 对象。\n"
+"输出：仅返回有效 JSON，必须以 {{ 开头、以 }} 结尾。\n"
+"字段与约束：\n"
+"- background_technology、problem_statement、core_inventive_concept、technical_solution_summary: string，综合各片段归纳，去除重复与矛盾；\n"
+"- key_components_or_steps: array，对象包含 name 与 function；同一组件的不同叫法合并为一项，保留最完整的功能描述；\n"
+"- achieved_effects: string，每行一个效果，去重，不使用项目符号。\n"
+"规范：只使用下列信息，不得臆造；信息缺失的字段填 null（数组字段用 []）。\n\n"
+"各片段提炼结果：\n{partial_briefs}"
+)
+
 PROMPT_TITLE = (
 f"{ROLE_INSTRUCTION}\n"
 "任务：根据核心创新点与技术方案，生成 3 个不超过 25 字的中文发明名称。\n"
@@ -59,9 +82,11 @@ f"{ROLE_INSTRUCTION}\n"
 "结构：\n"
 "1) 客观描述与本发明最相关的1–2种主流方案的原理与应用；\n"
 "2) 在客观描述基础上，铺垫并指明其在特定方面的固有限制与技术瓶颈（不下结论式贬低）。\n"
+"3) 若提供了检索到的相关专利，优先以其公开的方案为描述依据，可注明公开号；不得编造未提供的文献。\n"
 "输出：仅段落内容。\n\n"
 "现有技术详细描述：\n{background_technology}\n"
-"现有技术存在的问题：\n{background_problem}"
+"现有技术存在的问题：\n{background_problem}\n"
+"检索到的相关专利（可能为空）：\n{prior_art}"
 )
 
 PROMPT_BACKGROUND_PROBLEM = (
@@ -72,8 +97,10 @@ f"{ROLE_INSTRUCTION}\n"
 "2) 原因分析：给出技术性/结构性根因；\n"
 "3) 影响阐述：对性能/成本/可靠性/用户体验的不良影响；\n"
 "语言风格：客观、严谨、技术化，不夸张、不主观。\n"
+"若提供了检索到的相关专利，问题与原因应与其公开的方案相对应。\n"
 "输出：仅段落内容，不含标题或其他标识。\n\n"
-"技术问题概要：{problem_statement}"
+"技术问题概要：{problem_statement}\n"
+"检索到的相关专利（可能为空）：\n{prior_art}"
 )
 
 # 说明书-3 发明内容
@@ -178,6 +205,18 @@ f"{ROLE_INSTRUCTION}\n"
 "技术解决方案全文参考：\n{invention_solution_detail}"
 )
 
+PROMPT_MERMAID_FIX = (
+f"{ROLE_INSTRUCTION}\n"
+"任务：修复下列 Mermaid 图代码中的语法错误，使其能被 Mermaid 正确解析，图的结构与含义保持不变。\n"
+"输出要求：\n"
+"1) 严格仅输出修复后的 Mermaid 图代码正文；不得包含 Markdown 代码块围栏或其他文本；\n"
+"2) 只修改与报错相关的部分，不增删节点与连线；\n"
+"3) 节点统一格式 A[\"标签\"]，禁止 style/linkStyle/classDef、注释与特殊字符。\n\n"
+"附图标题：{title}\n"
+"解析器报错：\n{error}\n\n"
+"待修复的 Mermaid 代码：\n{code}"
+)
+
 # 说明书-5 具体实施方式
 PROMPT_IMPLEMENTATION_POINT = (
 f"{ROLE_INSTRUCTION}\n"
@@ -205,9 +244,30 @@ f"{ROLE_INSTRUCTION}\n"
 "技术特征要点：{solution_points_str}"
 )
 
+# 单条权利要求重写
+PROMPT_CLAIM_REGENERATE = (
+f"{ROLE_INSTRUCTION}\n"
+"任务：只重写权利要求书中的第 {claim_no} 项权利要求，其余权利要求保持不变。\n"
+"要求：\n"
+"1) 保持该项的类型与引用关系（独立/从属及所引用的权利要求编号）不变；\n"
+"2) 使用“所述/该”指代的要素必须已在本项前文或其引用的在先权利要求中引入；\n"
+"3) 修正下列已发现的问题，术语与说明书及其他权利要求保持一致，不得引入说明书未披露的要素；\n"
+"输出：仅该项权利要求的正文，不含编号、标题或额外说明。\n\n"
+"待重写的权利要求 {claim_no}：\n{claim_text}\n\n"
+"其引用的在先权利要求：\n{basis_claims}\n\n"
+"已发现的问题：\n{claim_issues}\n\n"
+"权利要求书全文（供参考）：\n{claims_text}\n\n"
+"参考材料：\n"
+"关键组件/步骤清单：{key_components_or_steps}\n"
+"技术特征要点：{solution_points_str}"
+)
+
 PROMPT_CLAIMS_CHECK = (
 f"{ROLE_INSTRUCTION}\n"
-"任务：对“权利要求书”进行一致性与支持度校验，并输出结构化报告。\n"
+"任务：对“权利要求书”进行语义层面的支持度校验，并输出结构化报告。\n"
+"术语是否在说明书中出现、命名是否统一已由本地分析完成（见下方“本地术语分析结论”），无需重复检查；"
+"请专注于：技术特征与限定是否被说明书实质性公开并支持、功能性限定是否有具体实现方式、"
+"保护范围是否超出说明书公开的内容、从属权利要求的附加特征是否有实施例依据。\n"
 "输出为严格 JSON，字段：\n"
 "- claim_no: integer，权利要求编号；\n"
 "- supported: boolean，是否完全有说明书支持；\n"
@@ -217,7 +277,8 @@ f"{ROLE_INSTRUCTION}\n"
 "要求：不得臆造支持；若存在不确定，明确标注。\n\n"
 "权利要求书全文：\n{claims_text}\n\n"
 "说明书全文上下文（含技术领域、背景、发明目的、技术方案、技术效果、实施例）：\n{global_context}\n"
-"术语与组件清单：\n{key_components_or_steps}"
+"术语与组件清单：\n{key_components_or_steps}\n"
+"本地术语分析结论：\n{local_findings}"
 )
 
 # 摘要
@@ -250,4 +311,19 @@ PROMPT_GLOBAL_RESTRUCTURE_AND_POLISH = (
 "【原始生成要求】: \n{original_generation_prompt}\n\n"
 "输出：仅返回重构后的 {target_section_name} 完整文本，不含任何额外说明、标题或前言。"
 )
- 
\ No newline at end of file
+ 
+# 输出被截断后的续写
+PROMPT_CONTINUE = (
+"你的上一条输出因长度限制被截断。请从截断处直接继续输出剩余内容：\n"
+"1) 紧接上一条输出的最后一个字符继续，不要重复已输出的任何内容；\n"
+"2) 保持相同的格式与结构（若为 JSON，则直接续写剩余的 JSON 文本，不要重新开始一个对象，不要使用代码块）；\n"
+"3) 不要添加任何说明、标题或前言。"
+)
+
+# 失控检测中止后的重试说明
+PROMPT_GUARD_RETRY = (
+"注意：上一次生成出现了{problem}，已被中止。请重新完成上述任务：\n"
+"1) 每个句子与段落只写一次，不要重复已经表述过的内容；\n"
+"2) 全文使用规范的简体中文（技术术语缩写可保留）；\n"
+"3) 篇幅与上述要求相称，完成后立即结束。"
+)
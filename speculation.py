@@ -0,0 +1,192 @@
+import time
+from typing import Any, Dict, List, Mapping, Optional
+
+import streamlit as st
+
+from config import UI_SECTION_CONFIG, UI_SECTION_ORDER, WORKFLOW_CONFIG, load_server_config
+from derived_views import content_fingerprint
+from job_runner import get_job_runner
+from state_manager import get_active_content, is_stale
+
+# 输入保持多少秒未编辑后才开始预生成
+SPECULATION_IDLE_S = 8
+# 调度检查间隔（秒）
+SPECULATION_POLL_S = 2.0
+# 不参与预生成的章节：附图需逐图校验渲染；附图说明在跳过附图时为本地占位
+SPECULATION_EXCLUDED = ("drawings",)
+
+CANDIDATES_KEY = "speculative_candidates"
+SPENT_KEY = "speculation_tokens_spent"
+JOB_KEY = "speculation_job"
+ATTEMPTED_KEY = "speculation_attempted"
+
+
+def speculation_enabled() -> bool:
+    return bool(st.session_state.get("speculative_mode"))
+
+
+def speculation_budget() -> int:
+    """每个会话的预生成 token 上限（估算值）。"""
+    return load_server_config()["speculation_token_budget"]
+
+
+def tokens_spent() -> int:
+    return st.session_state.get(SPENT_KEY, 0)
+
+
+def record_tokens(tokens: int):
+    st.session_state[SPENT_KEY] = tokens_spent() + int(tokens or 0)
+
+
+def section_input_fingerprint(ui_key: str, state: Optional[Mapping[str, Any]] = None) -> str:
+    """
+    章节生成输入的指纹：结构化摘要、各微观步骤依赖的外部步骤的激活内容，以及是否跳过附图。
+    指纹不变即意味着此时点击生成会得到同样的 Prompt。
+    """
+    if state is None:
+        state = st.session_state
+    own = set(UI_SECTION_CONFIG[ui_key]["workflow_keys"])
+    deps = {"solution_points"}
+    for micro_key in own:
+        deps.update(d for d in WORKFLOW_CONFIG[micro_key]["dependencies"] if d in WORKFLOW_CONFIG)
+    deps -= own
+    return content_fingerprint({
+        "ui_key": ui_key,
+        "brief": state.get("structured_brief") or {},
+        "deps": {d: get_active_content(d, state) for d in sorted(deps)},
+        "skip_drawings": state.get("skip_drawings", True),
+    })
+
+
+# -------------- 候选版本 --------------
+
+def store_candidate(ui_key: str, fingerprint: str, versions: Dict[str, List[Any]], tokens: int):
+    """保存预生成结果：versions 为 {键: 待追加的新版本列表}。"""
+    st.session_state.setdefault(CANDIDATES_KEY, {})[ui_key] = {
+        "fingerprint": fingerprint,
+        "versions": versions,
+        "tokens": tokens,
+        "created_at": time.time(),
+    }
+
+
+def ready_candidates() -> List[str]:
+    """与当前输入仍然匹配的候选章节。"""
+    candidates = st.session_state.get(CANDIDATES_KEY, {})
+    return [k for k, c in candidates.items() if c["fingerprint"] == section_input_fingerprint(k)]
+
+
+def prune_candidates():
+    """丢弃输入已变化的候选。"""
+    candidates = st.session_state.get(CANDIDATES_KEY, {})
+    for ui_key in list(candidates):
+        if candidates[ui_key]["fingerprint"] != section_input_fingerprint(ui_key):
+            del candidates[ui_key]
+
+
+def promote_speculative_candidate(ui_key: str) -> bool:
+    """
+    若存在与当前输入匹配的候选，将其作为新版本写入会话并返回 True；
+    否则丢弃过期候选、取消同一章节仍在进行的预生成，返回 False 由调用方正常生成。
+    """
+    candidate = st.session_state.get(CANDIDATES_KEY, {}).pop(ui_key, None)
+    if candidate is None or candidate["fingerprint"] != section_input_fingerprint(ui_key):
+        cancel_speculation(ui_key)
+        return False
+    now = time.time()
+    timestamps = st.session_state.setdefault("data_timestamps", {})
+    for key, new_versions in candidate["versions"].items():
+        if not new_versions:
+            continue
+        versions = st.session_state.setdefault(f"{key}_versions", [])
+        versions.extend(new_versions)
+        st.session_state[f"{key}_active_index"] = len(versions) - 1
+        timestamps[key] = now
+    return True
+
+
+# -------------- 调度 --------------
+
+def _speculation_job():
+    info = st.session_state.get(JOB_KEY)
+    if not info:
+        return None, None
+    return info, get_job_runner().get(info["job_id"])
+
+
+def cancel_speculation(ui_key: Optional[str] = None):
+    """取消正在进行的预生成（可限定章节）。"""
+    info, job = _speculation_job()
+    if job is not None and not job.finished and (ui_key is None or info["ui_key"] == ui_key):
+        job.cancel()
+
+
+def _deps_met(ui_key: str) -> bool:
+    return all(
+        (st.session_state.get("structured_brief") if dep == "structured_brief" else get_active_content(dep))
+        for dep in UI_SECTION_CONFIG[ui_key]["dependencies"]
+    )
+
+
+def inputs_idle_s() -> float:
+    """距最近一次编辑（结构化摘要或任一章节版本变化）的秒数。"""
+    timestamps = st.session_state.get("data_timestamps") or {}
+    last_edit = max(timestamps.values(), default=0)
+    return time.time() - last_edit
+
+
+def next_speculation_target() -> Optional[str]:
+    """
+    返回下一个值得预生成的章节：尚无版本（或已过期）、依赖已满足、且没有匹配当前输入的候选。
+    未开启、预算用尽、已有预生成在进行或输入仍在变动时返回 None。
+    同一章节在同一输入下只尝试一次，失败或被取消后不会反复重试。
+    """
+    if not speculation_enabled() or tokens_spent() >= speculation_budget():
+        return None
+    info, job = _speculation_job()
+    if job is not None and not job.finished:
+        # 输入在预生成期间发生变化：结果必然作废，尽早取消
+        if section_input_fingerprint(info["ui_key"]) != info["fingerprint"]:
+            job.cancel()
+        return None
+    if inputs_idle_s() < SPECULATION_IDLE_S:
+        return None
+
+    ready = set(ready_candidates())
+    attempted = st.session_state.get(ATTEMPTED_KEY, set())
+    skip_drawings = st.session_state.get("skip_drawings", True)
+    for ui_key in UI_SECTION_ORDER:
+        if ui_key in SPECULATION_EXCLUDED or ui_key in ready:
+            continue
+        if ui_key == "figure_description" and skip_drawings:
+            continue
+        if st.session_state.get(f"{ui_key}_versions") and not is_stale(ui_key):
+            continue
+        if _deps_met(ui_key) and (ui_key, section_input_fingerprint(ui_key)) not in attempted:
+            return ui_key
+    return None
+
+
+def start_speculation(ui_key: str, fn) -> None:
+    """以后台任务执行 fn(job, fingerprint)；任务与用户发起的生成任务分开跟踪。"""
+    fingerprint = section_input_fingerprint(ui_key)
+    label = UI_SECTION_CONFIG[ui_key]["label"]
+    job = get_job_runner().submit(
+        "speculate", f"预生成：{label}", lambda job: fn(job, fingerprint),
+        owner=st.session_state.get("username"),
+        deadline_s=load_server_config()["section_deadline_s"],
+    )
+    st.session_state[JOB_KEY] = {"job_id": job.id, "ui_key": ui_key, "fingerprint": fingerprint}
+    st.session_state.setdefault(ATTEMPTED_KEY, set()).add((ui_key, fingerprint))
+
+
+def speculation_status() -> Dict[str, Any]:
+    """供界面展示：进行中的章节、已就绪的候选与预算使用情况。"""
+    info, job = _speculation_job()
+    running = info["ui_key"] if job is not None and not job.finished else None
+    return {
+        "running": running,
+        "ready": ready_candidates(),
+        "spent": tokens_spent(),
+        "budget": speculation_budget(),
+    }
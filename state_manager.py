@@ -1,19 +1,42 @@
 import streamlit as st
+import copy
 import time
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Mapping, MutableMapping, Optional
 from config import UI_SECTION_CONFIG, WORKFLOW_CONFIG
 
-def get_active_content(key: str) -> Any:
-    """获取某个部分当前激活版本的内容。"""
-    if f"{key}_versions" not in st.session_state or not st.session_state[f"{key}_versions"]:
+def get_active_content(key: str, state: Optional[Mapping[str, Any]] = None) -> Any:
+    """获取某个部分当前激活版本的内容（state 默认为当前会话，批量模式传入草稿状态字典）。"""
+    if state is None:
+        state = st.session_state
+    if f"{key}_versions" not in state or not state[f"{key}_versions"]:
         return None
-    active_index = st.session_state.get(f"{key}_active_index", 0)
-    version_data = st.session_state[f"{key}_versions"][active_index]
+    active_index = state.get(f"{key}_active_index", 0)
+    version_data = state[f"{key}_versions"][active_index]
 
     # The complex dictionary wrapper for versions has been removed.
     # The version data is now the content itself (e.g., a string, or a list for drawings).
     return version_data
 
+def mark_partial_version(key: str, index: int, note: str, state: Optional[MutableMapping[str, Any]] = None):
+    """将某个版本标记为部分结果（如生成被取消或超时后保留的内容），note 说明缺失的部分。"""
+    if state is None:
+        state = st.session_state
+    # 索引以字符串保存，快照经 JSON 往返后仍可匹配
+    state.setdefault("partial_versions", {}).setdefault(key, {})[str(index)] = note
+
+def partial_version_note(key: str, index: int, state: Optional[Mapping[str, Any]] = None) -> Optional[str]:
+    """返回版本的部分结果说明；完整版本返回 None。"""
+    if state is None:
+        state = st.session_state
+    return (state.get("partial_versions") or {}).get(key, {}).get(str(index))
+
+def version_labels(key: str, count: int) -> List[str]:
+    """版本选择框的选项文字，部分结果版本带有明显标记。"""
+    return [
+        f"版本 {i+1}" + (" ⚠️ 部分结果" if partial_version_note(key, i) else "")
+        for i in range(count)
+    ]
+
 def is_stale(ui_key: str) -> bool:
     """检查某个UI章节是否因其依赖项更新而过时。"""
     timestamps = st.session_state.data_timestamps
@@ -56,3 +79,38 @@ def initialize_session_state():
             st.session_state[f"{key}_versions"] = []
         if f"{key}_active_index" not in st.session_state:
             st.session_state[f"{key}_active_index"] = 0
+
+# 草稿状态中需要随后台任务快照迁移的顶层键（不含任何控件绑定的键）
+DRAFT_STATE_KEYS = [
+    "stage",
+    "user_input",
+    "structured_brief",
+    "data_timestamps",
+    "globally_refined_draft",
+    "refined_version_available",
+    "refined_version_partial",
+    "partial_versions",
+    "draft_tokens_used",
+    "draft_token_budget",
+]
+
+def _versioned_keys() -> List[str]:
+    keys = list(UI_SECTION_CONFIG.keys()) + list(WORKFLOW_CONFIG.keys())
+    return list(dict.fromkeys(keys))
+
+def export_draft_state() -> Dict[str, Any]:
+    """导出当前草稿状态的深拷贝快照（核心要素、各章节版本与激活索引、精炼稿）。"""
+    snapshot: Dict[str, Any] = {}
+    for k in DRAFT_STATE_KEYS:
+        if k in st.session_state:
+            snapshot[k] = copy.deepcopy(st.session_state[k])
+    for key in _versioned_keys():
+        for suffix in ("_versions", "_active_index"):
+            if f"{key}{suffix}" in st.session_state:
+                snapshot[f"{key}{suffix}"] = copy.deepcopy(st.session_state[f"{key}{suffix}"])
+    return snapshot
+
+def import_draft_state(snapshot: Dict[str, Any]):
+    """将 export_draft_state 生成的快照写回当前会话。"""
+    for k, v in (snapshot or {}).items():
+        st.session_state[k] = copy.deepcopy(v)
@@ -0,0 +1,212 @@
+import re
+import time
+from collections import deque
+from typing import Any, Dict, Iterator, List, Mapping, Sequence, Tuple
+
+from claims_parser import cached_claim_tree
+from derived_views import DERIVED_VIEWS, content_fingerprint
+
+# 组件名称常见的通用后缀：同一核心词换用不同后缀视为命名漂移（如“信号处理模块”与“信号处理单元”）
+GENERIC_SUFFIXES = ("子系统", "模块", "单元", "装置", "组件", "部件", "机构", "电路", "系统", "设备", "器", "部", "件")
+# 参与“说明书支持”判断的章节（权利要求书与摘要之外的说明书正文）
+DESCRIPTION_SECTIONS = ("technical_field", "background", "invention", "figure_description", "implementation")
+SECTION_LABELS = {
+    "technical_field": "技术领域",
+    "background": "背景技术",
+    "invention": "发明内容",
+    "figure_description": "附图说明",
+    "implementation": "具体实施方式",
+    "claims": "权利要求书",
+    "abstract": "摘要",
+}
+# 权利要求中以“所述/该”引用的技术术语（取到第一个通用后缀为止）
+_CLAIM_TERM_RE = re.compile(
+    r"(?:所述|该)(?!的)([一-鿿A-Za-z0-9]{1,16}?(?:" + "|".join(GENERIC_SUFFIXES) + r"))"
+)
+
+
+class AhoCorasick:
+    """多模式串匹配自动机：一次扫描文本即可找出所有模式串的全部出现位置。"""
+
+    def __init__(self, patterns: Sequence[str]):
+        self.patterns = list(patterns)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        for index, pattern in enumerate(self.patterns):
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(index)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """产出所有 (起点, 终点, 模式序号)，包括相互重叠的匹配。"""
+        node = 0
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self.patterns
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for index in out[node]:
+                yield i + 1 - len(patterns[index]), i + 1, index
+
+    def find_all(self, text: str) -> List[Tuple[int, int, int]]:
+        """最左最长、互不重叠的匹配（“信号处理模块”不会再计作“处理模块”）。"""
+        matches = sorted(self.iter_matches(text), key=lambda m: (m[0], -(m[1] - m[0])))
+        result: List[Tuple[int, int, int]] = []
+        last_end = 0
+        for start, end, index in matches:
+            if start >= last_end:
+                result.append((start, end, index))
+                last_end = end
+        return result
+
+
+def _core_name(name: str) -> str:
+    for suffix in GENERIC_SUFFIXES:
+        if name.endswith(suffix) and len(name) - len(suffix) >= 2:
+            return name[: -len(suffix)]
+    return name
+
+
+class TermLexicon:
+    """
+    由关键组件/步骤清单构建的术语表：每个组件的规范名称及其变体（核心词 + 其他通用后缀），
+    以及覆盖全部名称与变体的自动机。
+    """
+
+    def __init__(self, components: Sequence[Any]):
+        self.names: List[str] = []
+        for item in components or []:
+            name = str((item.get("name") if isinstance(item, dict) else item) or "").strip()
+            if len(name) >= 2 and name not in self.names:
+                self.names.append(name)
+        # 模式串 -> (组件序号, 是否为规范名称)；规范名称优先于其他组件的变体
+        self.entries: Dict[str, Tuple[int, bool]] = {name: (i, True) for i, name in enumerate(self.names)}
+        for i, name in enumerate(self.names):
+            core = _core_name(name)
+            if core == name:
+                continue
+            for suffix in GENERIC_SUFFIXES:
+                variant = core + suffix
+                if variant not in self.entries:
+                    self.entries[variant] = (i, False)
+        self.patterns = list(self.entries)
+        self.automaton = AhoCorasick(self.patterns)
+        self.fingerprint = content_fingerprint(self.patterns)
+
+
+def _build_lexicon(components: Sequence[Any]) -> TermLexicon:
+    return TermLexicon(components)
+
+
+def _scan_section(lexicon: TermLexicon, text: str) -> Dict[str, List[int]]:
+    """扫描一个章节：{模式串: [出现位置]}。"""
+    hits: Dict[str, List[int]] = {}
+    for start, _, index in lexicon.automaton.find_all(text):
+        hits.setdefault(lexicon.patterns[index], []).append(start)
+    return hits
+
+
+def scan_section(lexicon: TermLexicon, key: str, text: str) -> Dict[str, List[int]]:
+    """按 (术语表, 章节内容) 缓存的章节扫描结果：编辑某一章节后只重新扫描该章节。"""
+    cache_key = (lexicon.fingerprint, key, content_fingerprint(text or ""))
+    return DERIVED_VIEWS.get_by_key("term_scan", cache_key, lambda: _scan_section(lexicon, text or ""))
+
+
+def analyze_terminology(sections: Mapping[str, Any], components: Sequence[Any]) -> Dict[str, Any]:
+    """
+    本地术语一致性分析（不调用模型）：
+    - terms：各组件在各章节的出现次数，以及使用了哪些名称变体
+    - drift：同一组件在文中使用了规范名称以外的变体
+    - unsupported：权利要求中出现、但说明书正文中找不到的术语（组件名或“所述/该”引出的术语）
+    - unused：清单中从未在说明书与权利要求中出现的组件
+    sections 为章节键到文本的映射（通常取 DraftDocument.sections）。
+    """
+    t0 = time.perf_counter()
+    lexicon: TermLexicon = DERIVED_VIEWS.get("term_lexicon", list(components or []), _build_lexicon)
+    texts = {key: str(sections.get(key) or "") for key in SECTION_LABELS}
+    scans = {key: scan_section(lexicon, key, text) for key, text in texts.items()}
+
+    terms = []
+    drift = []
+    unused = []
+    for i, name in enumerate(lexicon.names):
+        occurrences: Dict[str, int] = {}
+        variants: Dict[str, Dict[str, int]] = {}
+        for key, hits in scans.items():
+            for pattern, positions in hits.items():
+                if lexicon.entries[pattern][0] != i:
+                    continue
+                occurrences[key] = occurrences.get(key, 0) + len(positions)
+                variants.setdefault(pattern, {})[SECTION_LABELS[key]] = len(positions)
+        in_description = any(occurrences.get(k) for k in DESCRIPTION_SECTIONS)
+        terms.append({
+            "name": name,
+            "occurrences": {SECTION_LABELS[k]: n for k, n in occurrences.items()},
+            "variants": sorted(variants),
+            "in_claims": bool(occurrences.get("claims")),
+            "in_description": in_description,
+        })
+        other = {v: where for v, where in variants.items() if v != name}
+        if other:
+            drift.append({"name": name, "variants": other})
+        if not occurrences.get("claims") and not in_description:
+            unused.append(name)
+
+    # 权利要求中的术语是否在说明书正文中出现
+    description_text = "\n".join(texts[k] for k in DESCRIPTION_SECTIONS)
+    claims_text = texts["claims"]
+    claim_tree = cached_claim_tree(claims_text)
+    unsupported: Dict[str, Dict[str, Any]] = {}
+    for pattern, positions in scans["claims"].items():
+        component = lexicon.names[lexicon.entries[pattern][0]]
+        if pattern not in description_text:
+            unsupported.setdefault(pattern, {"term": pattern, "component": component, "claims": set()})
+            unsupported[pattern]["claims"].update(claim_tree.claim_number_at(p) for p in positions)
+    for m in _CLAIM_TERM_RE.finditer(claims_text):
+        term = m.group(1)
+        if term in lexicon.entries or term in description_text or term in unsupported:
+            continue
+        unsupported[term] = {"term": term, "component": None, "claims": {claim_tree.claim_number_at(m.start())}}
+    for item in unsupported.values():
+        item["claims"] = sorted(n for n in item["claims"] if n is not None)
+
+    return {
+        "terms": terms,
+        "drift": drift,
+        "unsupported": list(unsupported.values()),
+        "unused": unused,
+        "elapsed_ms": round((time.perf_counter() - t0) * 1000, 2),
+    }
+
+
+def format_terminology_findings(report: Dict[str, Any]) -> str:
+    """本地分析结论的文字摘要，随模型语义校验一并提供，避免模型重复检查术语层面的问题。"""
+    lines = []
+    for item in report["unsupported"]:
+        claims = "、".join(str(n) for n in item["claims"]) or "?"
+        lines.append(f"- 术语“{item['term']}”（权利要求 {claims}）在说明书正文中未出现")
+    for item in report["drift"]:
+        lines.append(f"- 组件“{item['name']}”存在命名变体：{'、'.join(item['variants'])}")
+    for name in report["unused"]:
+        lines.append(f"- 组件“{name}”在说明书与权利要求中均未出现")
+    return "\n".join(lines) or "（本地分析未发现术语层面的问题）"
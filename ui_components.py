@@ -1,7 +1,22 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import json
+import os
+import html
+import functools
+from datetime import datetime
+from typing import Optional
 from config import save_config
+from mermaid_render import render_mermaid_async
+
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+MERMAID_SCRIPT_PATH = os.path.join(_MODULE_DIR, "mermaid_script.js")
+# 自托管 Mermaid 库：将 mermaid.min.js 放入 static/ 目录（见 static/README.md）
+STATIC_DIR = os.path.join(_MODULE_DIR, "static")
+MERMAID_BUNDLE_FILE = "mermaid.min.js"
+MERMAID_CDN_URL = "https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.min.js"
+# 等待后台渲染附图时的轮询间隔（秒）
+MERMAID_POLL_S = 1.0
 
 def render_sidebar(config: dict):
     """渲染侧边栏并返回更新后的配置字典。"""
@@ -46,10 +61,119 @@ def render_sidebar(config: dict):
         if st.button("保存配置"):
             save_config(config)
             st.success("配置已保存！")
-            if 'llm_client' in st.session_state:
-                del st.session_state.llm_client
             st.rerun()
 
+def render_admin_panel(pool_stats: dict, jobs: list, endpoints: Optional[list] = None, endpoint_history: Optional[list] = None):
+    """渲染管理员视图：共享调用池的队列深度、在途请求、各用户用量、各端点的自适应并发上限以及后台任务。"""
+    col1, col2, col3 = st.columns(3)
+    col1.metric("调用池容量", pool_stats["size"])
+    col2.metric("在途请求", pool_stats["in_flight"])
+    col3.metric("排队请求", pool_stats["queue_depth"])
+
+    st.markdown("**各优先级排队情况**")
+    st.dataframe(pool_stats["classes"], hide_index=True, use_container_width=True)
+
+    st.markdown("**各用户用量**")
+    if pool_stats["users"]:
+        st.dataframe(pool_stats["users"], hide_index=True, use_container_width=True)
+    else:
+        st.caption("暂无调用记录。")
+
+    st.markdown("**在途调用**")
+    if pool_stats["in_flight_calls"]:
+        st.dataframe(pool_stats["in_flight_calls"], hide_index=True, use_container_width=True)
+    else:
+        st.caption("当前无在途调用。")
+
+    st.markdown("**各端点自适应并发**")
+    if endpoints:
+        st.dataframe(endpoints, hide_index=True, use_container_width=True)
+        if endpoint_history:
+            st.line_chart(
+                [{"时间": datetime.fromtimestamp(h["ts"]), "在途上限": h["limit"], "端点": h["endpoint"]} for h in endpoint_history],
+                x="时间", y="在途上限", color="端点",
+            )
+    else:
+        st.caption("暂无端点调用记录。")
+
+    st.markdown("**后台任务**")
+    if jobs:
+        st.dataframe([job.summary() for job in jobs], hide_index=True, use_container_width=True)
+    else:
+        st.caption("暂无后台任务。")
+
+def render_prior_art_hits(hits: list):
+    """展示为背景技术检索到的相关专利（生成时作为依据注入 Prompt）。"""
+    if not hits:
+        return
+    with st.expander(f"📚 检索到的相关现有技术（{len(hits)} 篇，生成背景技术时作为参考）"):
+        for hit in hits:
+            st.markdown(f"**{hit['id']}** {hit.get('title') or ''}")
+            st.caption(hit.get("abstract") or "")
+
+def render_terminology_report(report: dict):
+    """展示本地术语一致性分析：未获支持的术语、命名漂移、未使用的组件与各章节出现次数。"""
+    unsupported, drift, unused = report["unsupported"], report["drift"], report["unused"]
+    cols = st.columns(3)
+    cols[0].metric("说明书中缺失的术语", len(unsupported))
+    cols[1].metric("命名不一致", len(drift))
+    cols[2].metric("未使用的组件", len(unused))
+    for item in unsupported:
+        claims = "、".join(str(n) for n in item["claims"]) or "?"
+        st.write(f"❌ 权利要求 {claims} 中的“{item['term']}”在说明书正文中未出现")
+    for item in drift:
+        where = "；".join(f"{v}（{'、'.join(sections)}）" for v, sections in item["variants"].items())
+        st.write(f"⚠️ “{item['name']}”被写作：{where}")
+    if unused:
+        st.write(f"ℹ️ 未出现的组件：{'、'.join(unused)}")
+    if report["terms"]:
+        with st.expander("各章节术语出现次数"):
+            st.dataframe(
+                [{"术语": t["name"], **t["occurrences"]} for t in report["terms"]],
+                use_container_width=True,
+            )
+    st.caption(f"本地分析耗时 {report['elapsed_ms']} ms")
+
+def render_cost_plan(plan: dict, status: dict):
+    """展示整稿任务的预估：调用次数、输入/输出 token、费用与耗时，以及本草稿预算的剩余额度。"""
+    cols = st.columns(4)
+    cols[0].metric("模型调用", plan["calls"])
+    cols[1].metric("预估 token", f"{plan['tokens']:,}", help=f"输入 {plan['input_tokens']:,} / 输出 {plan['output_tokens']:,}")
+    cols[2].metric("预估费用", f"{plan['cost']:.2f} {plan['currency']}" if plan["cost"] is not None else "未配置单价")
+    cols[3].metric("预估耗时", f"{plan['seconds'] / 60:.1f} 分钟")
+    with st.expander("各步骤明细"):
+        st.dataframe(
+            [{"步骤": s["label"], "调用": s["calls"], "输入 token": s["input_tokens"],
+              "输出 token": s["output_tokens"], "耗时(秒)": round(s["seconds"])} for s in plan["steps"]],
+            use_container_width=True,
+        )
+    basis = f"基于 {plan['history_samples']} 次历史调用" if plan["history_samples"] else "暂无历史调用，按默认值估计"
+    st.caption(f"输出与耗时{basis}；步骤按顺序执行，耗时含排队等待。")
+    if status["budget"]:
+        note = f"本草稿预算 {status['budget']:,} token，已用 {status['used']:,}，剩余 {status['remaining']:,}"
+        if status["exceeds"]:
+            st.error(f"❌ 预估用量超出剩余预算。{note}")
+        else:
+            st.caption(note)
+
+def render_claim_structure(tree, issues: list):
+    """展示权利要求的引用树（从属权利要求缩进在其引用的权利要求之下）与结构/引用基础问题。"""
+    if not tree.claims:
+        st.caption("未识别出编号的权利要求（每项应以“1.”等编号开头）。")
+        return
+    independent = len(tree.roots())
+    st.caption(f"共 {len(tree.claims)} 项权利要求，其中独立权利要求 {independent} 项，发现问题 {len(issues)} 处")
+    lines = []
+    for claim in tree.claims:
+        depth = len(tree.ancestors(claim.number))
+        refs = f"（引用 {'、'.join(str(r) for r in claim.refs)}）" if claim.refs else "（独立）"
+        marker = "⚠️ " if any(i["claim_no"] == claim.number for i in issues) else ""
+        lines.append(f"{'　' * depth}{marker}{claim.number}. {claim.preamble[:30]}{refs}")
+    with st.expander("引用关系"):
+        st.text("\n".join(lines))
+    for item in issues:
+        st.write(f"❌ 权利要求 {item['claim_no']}：{item['message']}")
+
 def clean_mermaid_code(code: str) -> str:
     """清理Mermaid代码字符串，移除可选的markdown代码块标识。"""
     cleaned_code = code.strip()
@@ -60,74 +184,118 @@ def clean_mermaid_code(code: str) -> str:
     return cleaned_code
 
 
+@functools.lru_cache(maxsize=1)
 def load_mermaid_script() -> str:
-    """加载并缓存外部的Mermaid JS脚本文件内容。"""
+    """加载并缓存外部的Mermaid JS脚本文件内容（每个进程只读取一次）。"""
     try:
-        with open("mermaid_script.js", "r", encoding="utf-8") as f:
+        with open(MERMAID_SCRIPT_PATH, "r", encoding="utf-8") as f:
             return f.read()
     except FileNotFoundError:
         # This will be visible in the browser's JS console
-                return "console.error('FATAL: mermaid_script.js not found.');"
+        return "console.error('FATAL: mermaid_script.js not found.');"
 
-def render_mermaid_component(drawing_key: str, drawing: dict, height: int = 500):
-    """
-    使用统一的HTML组件渲染单个Mermaid图表。
-    每个组件都在一个独立的iframe中加载自己的JS依赖项。
+def mermaid_bundle_src() -> str:
     """
-    # 1. 加载自定义脚本内容
-    mermaid_script_content = load_mermaid_script()
-
-    # 2. 为每个组件准备完整的脚本集
-    # 每次调用都必须包含这些脚本，因为每个组件都在一个独立的iframe中。
-    script_tags = f"""
-    <script src="https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.min.js"></script>
-    <script>{mermaid_script_content}</script>
+    返回 mermaid.min.js 的加载地址。
+    优先使用 MERMAID_JS_URL；其次使用 static/ 目录下自托管的文件（经 Streamlit 静态文件服务提供，
+    浏览器可缓存，适用于无法访问外网的部署；可用 fetch_static_assets.py 获取）；都没有时才回退到 CDN。
+    每次渲染时检查文件是否存在，部署后放入的文件无需重启即可生效。
     """
+    override = os.getenv("MERMAID_JS_URL")
+    if override:
+        return override
+    if os.path.exists(os.path.join(STATIC_DIR, MERMAID_BUNDLE_FILE)):
+        # 组件 iframe 使用 srcdoc：使用带 server.baseUrlPath 前缀的绝对路径，不依赖宿主页面的当前路径
+        base = (st.get_option("server.baseUrlPath") or "").strip("/")
+        prefix = f"/{base}" if base else ""
+        return f"{prefix}/app/static/{MERMAID_BUNDLE_FILE}"
+    return MERMAID_CDN_URL
 
-    # 3. 清理和准备数据
-    code_to_render = clean_mermaid_code(drawing.get("code", "graph TD; A[无代码];"))
-    safe_title = "".join(c for c in drawing.get('title', '') if c.isalnum() or c in (' ', '_')).rstrip()
-
-    # 4. 将 Python 变量转换为 JSON 字符串以便安全嵌入
-    code_json = json.dumps(code_to_render)
-    safe_title_json = json.dumps(safe_title)
-    drawing_key_json = json.dumps(drawing_key)
+def render_mermaid_gallery(drawings: list, height_per_drawing: int = 500, key_prefix: str = "mermaid"):
+    """
+    在同一个HTML组件（单个iframe）中渲染多张Mermaid附图。
+    Mermaid 库与自定义脚本只加载、初始化一次，各附图依次渲染，每张图保留独立的 PNG 下载按钮。
+    """
+    if not drawings:
+        return
 
-    # 5. 构建完整的 HTML 内容
-    html_content = f"""
-    {script_tags}
-    <div style="position: relative; height: {height}px;">
-        <div id="mermaid-container-{drawing_key}" style="height: 100%; overflow: auto; border: 1px solid #eee; padding: 10px; border-radius: 5px;">
+    items = []
+    blocks = []
+    for i, drawing in enumerate(drawings):
+        drawing_key = f"{key_prefix}_{i}"
+        code_to_render = clean_mermaid_code(drawing.get("code", "graph TD; A[无代码];"))
+        title = drawing.get('title', '')
+        safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '_')).rstrip()
+        items.append({"key": drawing_key, "title": safe_title, "code": code_to_render})
+        blocks.append(f"""
+    <div style="position: relative; height: {height_per_drawing}px; margin-bottom: 12px;">
+        <div style="font-weight: 600; margin: 4px 0;">附图 {i+1}: {html.escape(title or '无标题')}</div>
+        <div id="mermaid-container-{drawing_key}" style="height: calc(100% - 28px); overflow: auto; border: 1px solid #eee; padding: 10px; border-radius: 5px;">
             <div id="mermaid-error-{drawing_key}" style="color: red;"></div>
             <div id="mermaid-output-{drawing_key}" style="background-color: white; padding: 1rem; border-radius: 0.5rem;"></div>
         </div>
-        <button id="download-btn-{drawing_key}" style="position: absolute; top: 15px; right: 15px; padding: 5px 10px; border-radius: 5px; border: 1px solid #ccc; cursor: pointer; z-index: 10;">📥 下载 PNG</button>
-    </div>
-    
+        <button id="download-btn-{drawing_key}" style="position: absolute; top: 40px; right: 15px; padding: 5px 10px; border-radius: 5px; border: 1px solid #ccc; cursor: pointer; z-index: 10;">📥 下载 PNG</button>
+    </div>""")
+
+    html_content = f"""
+    <script src="{mermaid_bundle_src()}"></script>
+    <script>{load_mermaid_script()}</script>
+    {''.join(blocks)}
     <script>
-        // 使用 setTimeout 确保 Mermaid 库已初始化
-        setTimeout(() => {{
-            try {{
-                if (window.renderMermaid) {{
-                    window.renderMermaid({drawing_key_json}, {safe_title_json}, {code_json});
-                }} else {{
-                    const errorMsg = 'Mermaid render function (window.renderMermaid) not found.';
-                    console.error(errorMsg);
-                    const errorDiv = document.getElementById('mermaid-error-{drawing_key}');
-                    if(errorDiv) {{
-                        errorDiv.innerHTML = '<p>' + errorMsg + '</p>';
+        // 依次渲染，避免并发调用 mermaid.render 互相干扰
+        (async () => {{
+            const drawings = {json.dumps(items)};
+            for (const d of drawings) {{
+                const errorDiv = document.getElementById('mermaid-error-' + d.key);
+                try {{
+                    if (!window.renderMermaid) {{
+                        throw new Error('Mermaid render function (window.renderMermaid) not found.');
+                    }}
+                    await window.renderMermaid(d.key, d.title, d.code);
+                }} catch (e) {{
+                    console.error('Error initializing Mermaid render for key: ' + d.key, e);
+                    if (errorDiv) {{
+                        errorDiv.innerHTML = '<p>Error initializing Mermaid: ' + (e.message || e) + '</p>';
                     }}
-                }}
-            }} catch (e) {{
-                const errorMsg = 'Error initializing Mermaid: ' + (e.message || e);
-                console.error('Error initializing Mermaid render for key: ' + '{drawing_key}', e);
-                const errorDiv = document.getElementById('mermaid-error-{drawing_key}');
-                if(errorDiv) {{
-                    errorDiv.innerHTML = '<p>' + errorMsg + '</p>';
                 }}
             }}
-        }}, 100);
+        }})();
     </script>
     """
-    components.html(html_content, height=height, scrolling=True)
+    components.html(html_content, height=(height_per_drawing + 12) * len(drawings), scrolling=True)
+
+def render_mermaid_component(drawing_key: str, drawing: dict, height: int = 500):
+    """渲染单个Mermaid图表（单图版本的 render_mermaid_gallery）。"""
+    render_mermaid_gallery([drawing], height_per_drawing=height, key_prefix=drawing_key)
+
+def render_mermaid_image(drawing_key: str, drawing: dict):
+    """
+    展示服务端渲染（并缓存）的附图图片，渲染失败时显示解析器报错。
+    未缓存的附图在后台线程渲染，期间以片段轮询，渲染完成后刷新页面。
+    """
+    code = clean_mermaid_code(drawing.get("code", ""))
+    result = render_mermaid_async(code)
+    if result is None:
+        _poll_mermaid_render(code)
+        return
+    if result["ok"] is None:
+        # 渲染器因环境问题不可用：改由浏览器端渲染，不把代码判为错误
+        st.caption(f"服务端渲染暂不可用，已改为浏览器端渲染：{result['error'][-200:]}")
+        render_mermaid_gallery([drawing], key_prefix=drawing_key)
+        return
+    if result["ok"]:
+        st.image(result["png"])
+        safe_title = "".join(c for c in drawing.get('title', '') if c.isalnum() or c in (' ', '_')).rstrip() or "patent_drawing"
+        col_png, col_svg = st.columns(2)
+        with open(result["png"], "rb") as f:
+            col_png.download_button("📥 下载 PNG", f.read(), file_name=f"{safe_title}.png", mime="image/png", key=f"dl_png_{drawing_key}")
+        with open(result["svg"], "rb") as f:
+            col_svg.download_button("📥 下载 SVG", f.read(), file_name=f"{safe_title}.svg", mime="image/svg+xml", key=f"dl_svg_{drawing_key}")
+    else:
+        st.error(f"附图代码无法解析：\n{result['error']}")
 
+@st.fragment(run_every=MERMAID_POLL_S)
+def _poll_mermaid_render(code: str):
+    if render_mermaid_async(code) is not None:
+        st.rerun()
+    st.caption("⏳ 正在服务端渲染附图...")
@@ -1,14 +1,30 @@
 import streamlit as st
 import json
+import threading
 import time
 import os
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Callable, Mapping, MutableMapping
 import prompts
-from llm_client import LLMClient
-from state_manager import get_active_content
-from config import UI_SECTION_CONFIG, WORKFLOW_CONFIG, UI_SECTION_ORDER
+from llm_client import FINISH_LENGTH, FINISH_STOP, GenerationAborted, LLMClient
+from generation_guard import REASON_LABELS, RunawayGuard, guard_for_step, trim_runaway
+from llm_output import is_valid_json, repair_truncated_json, stitch_continuation, strip_code_fence
+from state_manager import get_active_content, mark_partial_version, partial_version_note
+from config import UI_SECTION_CONFIG, WORKFLOW_CONFIG, UI_SECTION_ORDER, load_server_config
 from ui_components import clean_mermaid_code
+from derived_views import DERIVED_VIEWS, content_fingerprint, identity_fingerprint
+from job_runner import current_job, JobCancelled
+from llm_pool import PRIORITY_NAMES, get_llm_pool, estimate_tokens, priority_for_job_kind
+from adaptive_concurrency import EndpointSaturated, get_endpoint_limiter
+from hedging import get_hedge_policy, hedge_client_for, hedge_key, race
+from mermaid_render import render_mermaid, MERMAID_FIX_MAX_ATTEMPTS
+from draft_document import get_draft_document
+from prior_art import cached_prior_art, format_prior_art
+from claims_parser import validate_claims, replace_claim, strip_claim_number
+from draft_budget import check_draft_budget, record_draft_tokens
+from speculation import promote_speculative_candidate, store_candidate, section_input_fingerprint, record_tokens
+from state_manager import export_draft_state
 
 # -------------- 行为与日志配置 --------------
 
@@ -24,6 +40,9 @@ LOG_MAX_CONTENT_CHARS = 5000
 LOG_CAPTURE_FULL_PROMPT = True
 LOG_CAPTURE_FULL_RESPONSE = True
 
+# 后台任务中等待模型返回时检查取消与时限的间隔（秒）
+CANCEL_POLL_S = 0.5
+
 # -------------- 工具函数 --------------
 
 def safe_format_prompt(template: str, **kwargs) -> str:
@@ -33,13 +52,15 @@ def safe_format_prompt(template: str, **kwargs) -> str:
         escaped = escaped.replace(f"{{{{{k}}}}}", f"{{{k}}}")
     return escaped.format(**kwargs)
 
-def ensure_version_state(key: str):
-    if f"{key}_versions" not in st.session_state:
-        st.session_state[f"{key}_versions"] = []
-    if f"{key}_active_index" not in st.session_state:
-        st.session_state[f"{key}_active_index"] = 0
-    if "data_timestamps" not in st.session_state:
-        st.session_state.data_timestamps = {}
+def ensure_version_state(key: str, state: Optional[MutableMapping[str, Any]] = None):
+    if state is None:
+        state = st.session_state
+    if f"{key}_versions" not in state:
+        state[f"{key}_versions"] = []
+    if f"{key}_active_index" not in state:
+        state[f"{key}_active_index"] = 0
+    if "data_timestamps" not in state:
+        state["data_timestamps"] = {}
 
 def _truncate_text(text: Any, max_len: int) -> str:
     if text is None:
@@ -51,6 +72,61 @@ def _truncate_text(text: Any, max_len: int) -> str:
             text = repr(text)
     return text if len(text) <= max_len else text[:max_len] + f"...(truncated {len(text)-max_len} chars)"
 
+# -------------- 后台任务适配 --------------
+# 工作流既可在脚本线程内联执行，也可由 job_runner 在后台线程执行；
+# 后台执行时界面元素无处可画，提示与进度改为写入任务事件流，由界面轮询展示。
+
+def _notify(level: str, message: str):
+    job = current_job()
+    if job is not None:
+        job.emit(level, message)
+    else:
+        getattr(st, level)(message)
+
+def _checkpoint():
+    """步骤间的取消检查点（仅在后台任务中生效）。"""
+    job = current_job()
+    if job is not None:
+        job.check_cancelled()
+
+class _JobStatus:
+    """在后台任务中代替 st.status 的上下文对象。"""
+    def __init__(self, job, label: str):
+        self.job = job
+        self.job.emit("info", label)
+
+    def update(self, label: Optional[str] = None, state: Optional[str] = None, **_):
+        if label:
+            self.job.emit("success" if state == "complete" else "info", label)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class _JobProgress:
+    """在后台任务中代替 st.progress 的进度对象。"""
+    def __init__(self, job, text: str):
+        self.job = job
+        self.job.emit("info", text)
+
+    def progress(self, value: float, text: Optional[str] = None):
+        if text:
+            self.job.emit("info", text)
+
+def _status(label: str):
+    job = current_job()
+    if job is not None:
+        return _JobStatus(job, label)
+    return st.status(label, expanded=True)
+
+def _progress_bar(text: str):
+    job = current_job()
+    if job is not None:
+        return _JobProgress(job, text)
+    return st.progress(0, text=text)
+
 def ensure_log_setup():
     if "log_file" not in st.session_state:
         os.makedirs(LOG_DIR, exist_ok=True)
@@ -87,9 +163,11 @@ def write_log(level: str, action: str, message: str, context: Optional[Dict[str,
         with open(st.session_state.log_file, "a", encoding="utf-8") as f:
             f.write(json.dumps(record, ensure_ascii=False) + "\n")
     except Exception as e:
-        st.warning(f"写入日志失败: {e}")
+        _notify("warning", f"写入日志失败: {e}")
 
+@st.fragment
 def render_logs_viewer():
+    """执行日志查看器（fragment：切换文件与行数只重跑本组件）。"""
     os.makedirs(LOG_DIR, exist_ok=True)
     st.subheader("执行日志")
     files = sorted([f for f in os.listdir(LOG_DIR) if f.endswith(".log")])
@@ -127,6 +205,14 @@ def render_logs_viewer():
         except Exception:
             pass
 
+# 同一会话的并行调用（如分块提炼）同时分配步骤编号，编号重复会使 artifacts 互相覆盖
+_step_counter_lock = threading.Lock()
+
+def _next_step_id(tag: str) -> str:
+    with _step_counter_lock:
+        st.session_state.step_counter += 1
+        return f"{st.session_state.step_counter:04d}_{tag}"
+
 def _write_artifact(step_id: str, kind: str, content: str) -> str:
     """
     将完整的 prompt 或 response 写入 artifacts 文件。
@@ -154,16 +240,191 @@ def _messages_to_text(messages: List[Dict[str, str]]) -> str:
         parts.append(f"[{role}] {content}")
     return "\n---\n".join(parts)
 
-def call_llm(llm_client: LLMClient, messages: List[Dict[str, str]], json_mode: bool = False, tag: str = "llm_call", extra_ctx: Optional[Dict[str, Any]] = None) -> str:
+def _call_provider(llm_client: LLMClient, messages: List[Dict[str, str]], json_mode: bool, job,
+                   tag: str = "llm_call", on_hedge: Optional[Callable[[], None]] = None,
+                   max_tokens: Optional[int] = None, guard=None) -> Tuple[str, str, Dict[str, Any]]:
+    """
+    发起模型调用，返回 (响应, 结束原因, 对冲信息)。在后台任务中：HTTP 超时取任务的剩余时限；调用在辅助线程中进行，
+    任务被取消或超时时立即抛出 JobCancelled，未完成的请求被放弃，其结果不再使用。
+    开启对冲（HEDGE_ENABLED）后，调用超过该步骤历史耗时的分位数仍未返回时，在对冲预算内
+    向同一（或备用）端点再发一次相同请求，先返回者胜出；发出对冲时回调 on_hedge 计入用量。
+    """
+    policy = get_hedge_policy()
+    key = hedge_key(llm_client.endpoint, tag)
+    delay_s = policy.delay_for(key) if policy is not None else None
+    if job is None and delay_s is None:
+        response, finish = llm_client.call_with_finish(messages, json_mode=json_mode, max_tokens=max_tokens, guard=guard)
+        return response, finish, {"hedged": False}
+    if job is not None:
+        job.check_cancelled()
+
+    def timeout():
+        return job.remaining_s() if job is not None else None
+
+    backup = hedge_client_for(llm_client) if delay_s is not None else None
+
+    def call_hedge():
+        # 对冲请求同样占用端点在途名额，自适应上限据此看到真实并发；名额恰好被占满时放弃本次对冲
+        with _endpoint_slot(backup, block=False) as endpoint:
+            try:
+                response, finish = backup.call_with_finish(messages, json_mode=json_mode, timeout=timeout(),
+                                                           max_tokens=max_tokens, guard=guard)
+            except GenerationAborted:
+                raise
+            except Exception as e:
+                endpoint["error"] = e
+                raise
+            endpoint["output_tokens"] = estimate_tokens(response or "")
+            return response, finish
+
+    def record_primary(elapsed_s: float):
+        # 对冲胜出时原请求的实际耗时仍计入分布，避免只留下被对冲缩短的样本
+        policy.record(key, elapsed_s)
+
+    def may_hedge() -> bool:
+        # 端点已达自适应上限时不对冲：向已饱和的后端追加请求只会拖慢所有调用
+        limiter = get_endpoint_limiter(backup.endpoint)
+        if limiter.in_flight >= int(limiter.limit) or not policy.try_spend():
+            return False
+        if on_hedge is not None:
+            on_hedge()
+        return True
+
+    try:
+        (response, finish), info = race(
+            lambda: llm_client.call_with_finish(messages, json_mode=json_mode, timeout=timeout(), max_tokens=max_tokens,
+                                                guard=guard),
+            call_hedge if backup is not None else None,
+            delay_s,
+            CANCEL_POLL_S,
+            check=job.check_cancelled if job is not None else None,
+            may_hedge=may_hedge,
+            thread_name=f"llm-call-{job.id}" if job is not None else "llm-call",
+            on_late_primary=record_primary if policy is not None else None,
+        )
+    except (JobCancelled, GenerationAborted):
+        raise
+    except Exception:
+        # HTTP 超时等失败若由时限引起，按超时上报
+        if job is not None:
+            job.check_cancelled()
+        raise
+    if info["hedged"]:
+        policy.record_outcome(info["winner"])
+        info.update({"hedge_delay_s": round(delay_s, 3), "hedge_endpoint": backup.endpoint})
+    return response, finish, info
+
+@contextmanager
+def _endpoint_slot(llm_client: LLMClient, check=None, block: bool = True):
+    """按模型端点占用自适应在途名额；关闭自适应时不做限制。block=False 时名额已满即抛出 EndpointSaturated。"""
+    if not load_server_config()["adaptive_concurrency"]:
+        yield {"waited_s": 0.0, "output_tokens": None, "error": None}
+        return
+    limiter = get_endpoint_limiter(llm_client.endpoint)
+    with limiter.acquire(check, block=block) as info:
+        info["limit"] = int(limiter.limit)
+        yield info
+
+@contextmanager
+def _call_slots(llm_client: LLMClient, user: str, tag: str, priority: int, check=None):
+    """
+    依次占用调用池槽位与端点在途名额，返回 (slot, endpoint)。
+    端点名额以非阻塞方式占用：已满时交还槽位，不占任何资源地等到端点有空位，再以最初的排队时刻重新排队。
+    因此排队中的请求不占端点名额（优先级、用户轮转与交互保留槽位照常生效），等端点的请求也不占全局槽位。
+    """
+    pool = get_llm_pool()
+    enqueued_at = time.time()
+    endpoint_wait_s = 0.0
+    while True:
+        with ExitStack() as stack:
+            slot = stack.enter_context(pool.slot(user, tag, priority, check=check, enqueued_at=enqueued_at))
+            try:
+                endpoint = stack.enter_context(_endpoint_slot(llm_client, check, block=False))
+            except EndpointSaturated:
+                slot["requeued"] = True
+            else:
+                endpoint["waited_s"] = round(endpoint_wait_s, 3)
+                yield slot, endpoint
+                return
+        waited_from = time.time()
+        get_endpoint_limiter(llm_client.endpoint).wait_available(check)
+        endpoint_wait_s += time.time() - waited_from
+
+def call_llm(llm_client: LLMClient, messages: List[Dict[str, str]], json_mode: bool = False, tag: str = "llm_call",
+             extra_ctx: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None,
+             guard: Optional[RunawayGuard] = None) -> str:
     """
     统一封装对 LLM 的调用：
     - 记录请求与响应日志（片段与完整 artifacts）
-    - 记录耗时、json_mode、tag
-    - 返回模型原始字符串响应
+    - 记录耗时、json_mode、tag 与结束原因
+    - 输出因达到长度上限被截断时，以续写 Prompt 接着生成（最多 LLM_MAX_CONTINUATIONS 次）并无缝拼接；
+      JSON 输出续写后仍不完整时补全被截断的结构
+    - 返回模型字符串响应
+    max_tokens 为单次调用的输出上限（取自 WORKFLOW_CONFIG 的 max_tokens），缺省使用提供商默认值。
+    guard（见 generation_guard.guard_for_step）使调用改为流式并在重复、语言漂移或超长时提前中止，
+    随后以调整后的 Prompt 重试（GUARD_MAX_RETRIES 次），仍失控时保留可用部分。
     """
+    response_str, finish_reason = _call_llm_guarded(llm_client, messages, json_mode, tag, extra_ctx, max_tokens, guard)
+    if finish_reason != FINISH_LENGTH:
+        return response_str
+
+    text = strip_code_fence(response_str) if json_mode else response_str
+    max_continuations = load_server_config()["llm_max_continuations"]
+    continuations = 0
+    while finish_reason == FINISH_LENGTH and continuations < max_continuations:
+        continuations += 1
+        write_log("WARN", "LLM:truncated", "输出达到长度上限，续写剩余内容", {
+            "tag": tag, "continuation": continuations, "chars_so_far": len(text),
+        })
+        # 续写不使用 JSON 模式：该模式会要求从头输出一个新的完整对象
+        continue_messages = list(messages) + [
+            {"role": "assistant", "content": text},
+            {"role": "user", "content": prompts.PROMPT_CONTINUE},
+        ]
+        continuation, finish_reason = _call_llm_guarded(llm_client, continue_messages, False,
+                                                        f"{tag}:continue{continuations}", extra_ctx, max_tokens, guard)
+        text = stitch_continuation(text, strip_code_fence(continuation) if json_mode else continuation)
+
+    if json_mode and not is_valid_json(text):
+        repaired = repair_truncated_json(text)
+        write_log("WARN", "LLM:json_repaired" if repaired else "LLM:json_repair_failed",
+                  "补全被截断的 JSON" if repaired else "被截断的 JSON 无法补全",
+                  {"tag": tag, "continuations": continuations, "chars": len(text)})
+        text = repaired or text
+    elif finish_reason == FINISH_LENGTH:
+        write_log("WARN", "LLM:truncated_final", "续写次数用尽，输出仍不完整", {"tag": tag, "continuations": continuations})
+    return text
+
+def _call_llm_guarded(llm_client: LLMClient, messages: List[Dict[str, str]], json_mode: bool, tag: str,
+                      extra_ctx: Optional[Dict[str, Any]], max_tokens: Optional[int],
+                      guard: Optional[RunawayGuard]) -> Tuple[str, str]:
+    """调用一次；被失控检测中止时在最后一条用户消息后附上纠正说明重试，重试用尽则截取可用部分。"""
+    max_retries = load_server_config()["guard_max_retries"] if guard is not None else 0
+    attempt = 0
+    while True:
+        try:
+            return _call_llm_once(llm_client, messages, json_mode, tag, extra_ctx, max_tokens, guard)
+        except GenerationAborted as e:
+            if attempt >= max_retries:
+                trimmed = trim_runaway(e.partial, e.reason)
+                write_log("WARN", "LLM:guard_gave_up", "重试后仍失控，保留可用部分", {
+                    "tag": tag, "reason": e.reason, "attempts": attempt + 1, "kept_len": len(trimmed),
+                })
+                return trimmed, FINISH_STOP
+            attempt += 1
+            note = safe_format_prompt(prompts.PROMPT_GUARD_RETRY, problem=REASON_LABELS.get(e.reason, e.reason))
+            messages = list(messages[:-1]) + [dict(messages[-1], content=f"{messages[-1]['content']}\n\n{note}")]
+            tag = f"{tag.split(':retry')[0]}:retry{attempt}"
+
+def _call_llm_once(llm_client: LLMClient, messages: List[Dict[str, str]], json_mode: bool, tag: str,
+                   extra_ctx: Optional[Dict[str, Any]], max_tokens: Optional[int], guard=None) -> Tuple[str, str]:
+    """
+    单次模型调用（排队、限流、对冲、计费与日志），返回 (响应, 结束原因)。
+    流式生成被 guard 中止时记录日志并抛出 GenerationAborted（已生成部分照常计费）。
+    """
+    _checkpoint()
     ensure_log_setup()
-    st.session_state.step_counter += 1
-    step_id = f"{st.session_state.step_counter:04d}_{tag}"
+    step_id = _next_step_id(tag)
 
     prompt_text = _messages_to_text(messages)
     prompt_snippet = _truncate_text(prompt_text, LOG_MAX_PROMPT_CHARS)
@@ -179,14 +440,73 @@ def call_llm(llm_client: LLMClient, messages: List[Dict[str, str]], json_mode: b
 
     write_log("DEBUG", "LLM:request", "发送给模型的输入", ctx_req)
 
+    # 所有调用经由进程级共享调用池：全局并发上限、按优先级与用户公平排队、配额
+    # 优先级由所在后台任务的类型决定，不在任务中的调用为交互调用
+    user = st.session_state.get("username") or "default"
+    job = current_job()
+    priority = priority_for_job_kind(job.kind if job is not None else None)
+    # 后台任务被取消或超时：排队中的调用撤出队列，进行中的调用立即放弃
+    check = job.check_cancelled if job is not None else None
     t0 = time.perf_counter()
+    prompt_tokens = estimate_tokens(prompt_text)
     try:
-        response_str = llm_client.call(messages, json_mode=json_mode)
+        # 本草稿预算用尽时不再发出请求
+        check_draft_budget(prompt_tokens)
+        with _call_slots(llm_client, user, tag, priority, check) as (slot, endpoint):
+            t0 = time.perf_counter()
+            # 请求一经发出即按输入计费，中止时也计入
+            slot["tokens"] = prompt_tokens
+            record_draft_tokens(prompt_tokens)
+            def on_hedge():
+                # 对冲请求同样按输入计费
+                slot["tokens"] += prompt_tokens
+                record_draft_tokens(prompt_tokens)
+
+            try:
+                response_str, finish_reason, hedge_info = _call_provider(llm_client, messages, json_mode, job, tag,
+                                                                         on_hedge, max_tokens, guard)
+            except JobCancelled:
+                raise
+            except GenerationAborted as e:
+                partial_tokens = estimate_tokens(e.partial)
+                slot["tokens"] += partial_tokens
+                record_draft_tokens(partial_tokens)
+                if job is not None:
+                    job.tokens_used += slot["tokens"]
+                raise
+            except Exception as e:
+                endpoint["error"] = e
+                raise
+            response_tokens = estimate_tokens(response_str or "")
+            endpoint["output_tokens"] = response_tokens
+            slot["tokens"] += response_tokens
+            record_draft_tokens(response_tokens)
+        if job is not None:
+            job.tokens_used += slot["tokens"]
+    except JobCancelled:
+        t1 = time.perf_counter()
+        write_log("WARN", "LLM:aborted", "任务已取消或超时，调用中止", {
+            "step_id": step_id, "reason": job.cancel_reason if job is not None else None, "elapsed_s": round(t1 - t0, 3),
+        })
+        raise
+    except GenerationAborted as e:
+        t1 = time.perf_counter()
+        write_log("WARN", "LLM:guard_abort", f"生成出现{REASON_LABELS.get(e.reason, e.reason)}，已提前中止", {
+            "step_id": step_id, "tag": tag, "reason": e.reason, "partial_len": len(e.partial),
+            "partial_tokens_est": estimate_tokens(e.partial), "elapsed_s": round(t1 - t0, 3),
+            "partial_snippet": _truncate_text(e.partial[-LOG_MAX_PROMPT_CHARS:], LOG_MAX_PROMPT_CHARS),
+        })
+        raise
     except Exception as e:
         t1 = time.perf_counter()
         write_log("ERROR", "LLM:call_failed", "模型调用失败", {"step_id": step_id, "error": str(e), "elapsed_s": round(t1 - t0, 3)})
         raise
     t1 = time.perf_counter()
+    # 各步骤的耗时分布决定对冲的触发时刻
+    hedge_policy = get_hedge_policy()
+    if hedge_policy is not None and hedge_info.get("winner") != "hedge":
+        # 只记录原请求的耗时；对冲胜出时原请求的耗时在其完成后由 _call_provider 补记
+        hedge_policy.record(hedge_key(llm_client.endpoint, tag), t1 - t0)
 
     response_snippet = _truncate_text(response_str, LOG_MAX_CONTENT_CHARS)
     response_art_path = ""
@@ -198,14 +518,25 @@ def call_llm(llm_client: LLMClient, messages: List[Dict[str, str]], json_mode: b
         "json_mode": json_mode,
         "tag": tag,
         "elapsed_s": round(t1 - t0, 3),
+        "queue_wait_s": slot["waited_s"],
+        "endpoint_wait_s": endpoint["waited_s"],
+        "endpoint_limit": endpoint.get("limit"),
+        "priority": PRIORITY_NAMES[priority],
+        "tokens_est": slot["tokens"],
+        "response_tokens_est": response_tokens,
+        "finish_reason": finish_reason,
         "response_len": len(response_str or ""),
         "response_snippet": response_snippet,
     }
     if response_art_path:
         ctx_resp["response_artifact"] = response_art_path
+    if hedge_info["hedged"]:
+        ctx_resp["hedge"] = hedge_info
+        write_log("INFO", "LLM:hedge", "对冲请求胜出" if hedge_info["winner"] == "hedge" else "原请求胜出，对冲请求被放弃",
+                  dict(hedge_info, step_id=step_id, tag=tag, elapsed_s=round(t1 - t0, 3)))
     write_log("INFO", "LLM:response", "模型返回内容", ctx_resp)
 
-    return response_str
+    return response_str, finish_reason
 
 # -------------- 标题与附图构思规范化 --------------
 
@@ -287,33 +618,8 @@ def normalize_ideas_container(raw) -> List[Dict[str, Any]]:
 
 # -------------- Prompt 参数构建 --------------
 
-def build_format_args(dependencies: List[str]) -> Dict[str, Any]:
-    """
-    根据依赖项列表，构建用于格式化Prompt的字典。
-    """
-    brief = st.session_state.get('structured_brief', {}) or {}
-    format_args: Dict[str, Any] = {}
-
-    for k in [
-        "background_technology",
-        "problem_statement",
-        "core_inventive_concept",
-        "technical_solution_summary",
-        "achieved_effects",
-    ]:
-        format_args[k] = brief.get(k) or ""
-
-    dep_used: Dict[str, Any] = {}
-    for dep in dependencies:
-        dep_content = get_active_content(dep)
-        if dep_content is not None:
-            format_args[dep] = dep_content
-            dep_used[dep] = dep_content
-        else:
-            format_args[dep] = brief.get(dep)
-            dep_used[dep] = brief.get(dep)
-
-    components = brief.get('key_components_or_steps', [])
+def _build_components_views(components: Any) -> Tuple[str, str]:
+    """将 key_components_or_steps 规范化为 (文本行, JSON字符串) 两种表示。"""
     text_lines: List[str] = []
     components_json_str = "[]"
 
@@ -338,36 +644,124 @@ def build_format_args(dependencies: List[str]) -> Dict[str, Any]:
             components_json_str = json.dumps(parsed, ensure_ascii=False)
         except Exception:
             components_json_str = json.dumps([components], ensure_ascii=False)
-    else:
-        text_lines = []
-        components_json_str = "[]"
 
-    format_args["key_components_or_steps"] = "\n".join([line for line in text_lines if line])
+    return "\n".join([line for line in text_lines if line]), components_json_str
+
+def _build_solution_points_str(solution_points: Any) -> str:
+    return "\n".join([f"{i+1}. {p}" for i, p in enumerate(solution_points or [])])
+
+def build_format_args(dependencies: List[str], state: Optional[Mapping[str, Any]] = None) -> Dict[str, Any]:
+    """
+    根据依赖项列表，构建用于格式化Prompt的字典。
+    各类派生表示（组件文本/JSON、要点列表、日志片段）经 DERIVED_VIEWS 按内容指纹缓存，
+    源值不变时在所有步骤间复用。
+    state 默认为当前会话（并写入会话日志）；批量模式传入各草稿自己的状态字典。
+    """
+    interactive = state is None
+    if state is None:
+        state = st.session_state
+    brief = state.get('structured_brief', {}) or {}
+    format_args: Dict[str, Any] = {}
+
+    for k in [
+        "background_technology",
+        "problem_statement",
+        "core_inventive_concept",
+        "technical_solution_summary",
+        "achieved_effects",
+    ]:
+        format_args[k] = brief.get(k) or ""
+
+    dep_used: Dict[str, Any] = {}
+    for dep in dependencies:
+        dep_content = get_active_content(dep, state)
+        if dep_content is not None:
+            format_args[dep] = dep_content
+            dep_used[dep] = dep_content
+        else:
+            format_args[dep] = brief.get(dep)
+            dep_used[dep] = brief.get(dep)
+
+    # 本地现有技术检索结果（未配置索引时为空）
+    if "prior_art" in dependencies:
+        try:
+            prior_art = format_prior_art(cached_prior_art(brief))
+        except Exception as e:
+            prior_art = ""
+            if interactive:
+                write_log("WARN", "prior_art:search_failed", f"现有技术检索失败: {e}")
+        format_args["prior_art"] = prior_art or "（无）"
+        dep_used["prior_art"] = format_args["prior_art"]
+
+    # 版本内容与摘要字段只会整体替换、不会原地修改：按对象身份记忆指纹，同一版本不重复序列化
+    components = brief.get('key_components_or_steps', [])
+    components_text, components_json_str = DERIVED_VIEWS.get_by_key(
+        "key_components_or_steps", identity_fingerprint(components), lambda: _build_components_views(components)
+    )
+    format_args["key_components_or_steps"] = components_text
     format_args["key_components_or_steps_json"] = components_json_str
 
-    solution_points = get_active_content("solution_points") or []
-    format_args["solution_points_str"] = "\n".join([f"{i+1}. {p}" for i, p in enumerate(solution_points)])
-
-    write_log(
-        "DEBUG",
-        "build_format_args",
-        "构建Prompt参数",
-        {
-            "dependencies": dependencies,
-            "keys_provided": list(format_args.keys()),
-            "solution_points_count": len(solution_points),
-            "components_text_len": len(format_args.get("key_components_or_steps", "")),
-            "deps_used_snippet": _truncate_text(json.dumps(dep_used, ensure_ascii=False), LOG_MAX_CONTENT_CHARS),
-        }
+    solution_points = get_active_content("solution_points", state) or []
+    format_args["solution_points_str"] = DERIVED_VIEWS.get_by_key(
+        "solution_points_str", identity_fingerprint(solution_points), lambda: _build_solution_points_str(solution_points)
     )
+
+    if LOG_ENABLED and interactive:
+        # 检索结果每次调用都是新字符串，按内容计算指纹
+        deps_key = tuple(
+            (dep, content_fingerprint(value) if dep == "prior_art" else identity_fingerprint(value))
+            for dep, value in dep_used.items()
+        )
+        deps_used_snippet = DERIVED_VIEWS.get_by_key(
+            "deps_used_snippet",
+            deps_key,
+            lambda: _truncate_text(json.dumps(dep_used, ensure_ascii=False), LOG_MAX_CONTENT_CHARS),
+        )
+        write_log(
+            "DEBUG",
+            "build_format_args",
+            "构建Prompt参数",
+            {
+                "dependencies": dependencies,
+                "keys_provided": list(format_args.keys()),
+                "solution_points_count": len(solution_points),
+                "components_text_len": len(format_args.get("key_components_or_steps", "")),
+                "deps_used_snippet": deps_used_snippet,
+                "derived_views": DERIVED_VIEWS.totals(),
+            }
+        )
     return format_args
 
 # -------------- 附图生成（可跳过） --------------
 
-def generate_all_drawings(llm_client: LLMClient, invention_solution_detail: str):
+def validate_drawing_code(llm_client: LLMClient, title: str, code: str, tag: str) -> str:
+    """
+    在服务端校验并渲染附图代码（结果按代码哈希缓存为 SVG/PNG）。
+    出现语法错误时携带解析器报错发起定向修复调用，返回最终（可能已修复）的代码。
+    本机没有渲染器时原样返回，由浏览器端渲染。
+    """
+    result = render_mermaid(code)
+    attempts = 0
+    while result["ok"] is False and attempts < MERMAID_FIX_MAX_ATTEMPTS:
+        attempts += 1
+        write_log("WARN", "drawings:syntax_error", "附图代码解析失败，发起修复调用", {"title": title, "attempt": attempts, "error": _truncate_text(result["error"], LOG_MAX_CONTENT_CHARS)})
+        fix_prompt = safe_format_prompt(prompts.PROMPT_MERMAID_FIX, title=title, error=result["error"], code=code)
+        code = clean_mermaid_code(call_llm(
+            llm_client,
+            messages=[{"role": "user", "content": fix_prompt}],
+            json_mode=False,
+            tag=f"{tag}_fix_{attempts}",
+            extra_ctx={"section": "drawings", "idea_title": title}
+        ))
+        result = render_mermaid(code)
+    write_log("INFO", "drawings:validated", "附图代码服务端校验完成", {"title": title, "ok": result["ok"], "fix_attempts": attempts, "cached": result["cached"]})
+    return code
+
+def generate_all_drawings(llm_client: LLMClient, invention_solution_detail: str) -> bool:
     """
     统一生成所有附图：先构思，然后为每个构思生成代码。
     可通过 st.session_state['skip_drawings'] 或 SKIP_DRAWINGS_DEFAULT 跳过。
+    返回是否保存了新版本（构思为空或无法解析时为 False）。
     """
     skip_drawings = st.session_state.get("skip_drawings", SKIP_DRAWINGS_DEFAULT)
     if skip_drawings:
@@ -376,13 +770,13 @@ def generate_all_drawings(llm_client: LLMClient, invention_solution_detail: str)
         st.session_state["drawings_versions"].append([])
         st.session_state["drawings_active_index"] = len(st.session_state["drawings_versions"]) - 1
         st.session_state.data_timestamps['drawings'] = time.time()
-        return
+        return True
 
     write_log("INFO", "drawings:start", "开始生成附图", {"has_solution_detail": bool(invention_solution_detail)})
     if not invention_solution_detail:
-        st.warning("无法生成附图，因为“发明内容”>“技术解决方案”内容为空。")
+        _notify("warning", "无法生成附图，因为“发明内容”>“技术解决方案”内容为空。")
         write_log("WARN", "drawings:abort", "技术解决方案为空，附图生成终止")
-        return
+        return False
 
     ideas_prompt = safe_format_prompt(
         prompts.PROMPT_MERMAID_IDEAS,
@@ -398,18 +792,18 @@ def generate_all_drawings(llm_client: LLMClient, invention_solution_detail: str)
     try:
         ideas_raw = json.loads(ideas_response_str.strip())
     except json.JSONDecodeError:
-        st.error(f"附图构思返回格式错误，期望列表或包含列表的对象，但得到: {ideas_response_str}")
+        _notify("error", f"附图构思返回格式错误，期望列表或包含列表的对象，但得到: {ideas_response_str}")
         write_log("ERROR", "drawings:ideas_parse_error", "构思JSON解析失败", {"raw_snippet": _truncate_text(ideas_response_str, LOG_MAX_CONTENT_CHARS)})
-        return
+        return False
 
     ideas = normalize_ideas_container(ideas_raw)
     if not ideas:
-        st.error("附图构思列表为空或不可解析，请重试。")
+        _notify("error", "附图构思列表为空或不可解析，请重试。")
         write_log("ERROR", "drawings:ideas_empty", "规范化后附图构思为空", {"normalized_len": 0})
-        return
+        return False
 
     drawings = []
-    progress_bar = st.progress(0, text="正在生成附图代码...")
+    progress_bar = _progress_bar("正在生成附图代码...")
     for i, idea in enumerate(ideas):
         idea_title = idea.get('title') or f'附图构思 {i+1}'
         idea_desc = idea.get('description') or ''
@@ -429,6 +823,7 @@ def generate_all_drawings(llm_client: LLMClient, invention_solution_detail: str)
         )
         cleaned_code = clean_mermaid_code(code)
         write_log("INFO", "drawings:code_generated", "附图代码生成完成", {"index": i, "title": idea_title, "code_len": len(code), "cleaned_len": len(cleaned_code)})
+        cleaned_code = validate_drawing_code(llm_client, idea_title, cleaned_code, tag=f"drawings_code_{i+1}")
 
         drawings.append({
             "title": idea_title,
@@ -442,6 +837,7 @@ def generate_all_drawings(llm_client: LLMClient, invention_solution_detail: str)
     st.session_state.drawings_active_index = len(st.session_state.drawings_versions) - 1
     st.session_state.data_timestamps['drawings'] = time.time()
     write_log("INFO", "drawings:done", "附图生成完成并保存版本", {"versions_count": len(st.session_state.drawings_versions)})
+    return True
 
 # -------------- 章节内容兜底构造 --------------
 
@@ -513,92 +909,166 @@ def _stringify_block(block: Any) -> str:
 
 # -------------- UI章节生成与组装 --------------
 
-def generate_ui_section(llm_client: LLMClient, ui_key: str):
-    """为单个UI章节执行生成流程（含日志、容错与兜底）。"""
+def generate_ui_section(llm_client: LLMClient, ui_key: str, state: Optional[MutableMapping[str, Any]] = None) -> bool:
+    """
+    为单个UI章节执行生成流程（含日志、容错与兜底）。
+    state 默认为当前会话：若已有与当前输入匹配的预生成候选则直接采用；
+    预生成时传入会话状态的影子副本，生成结果不影响用户正在编辑的草稿。
+    返回章节是否生成成功；模型输出无法解析时已通过 _notify 提示，返回 False。
+    """
     if "skip_drawings" not in st.session_state:
         st.session_state.skip_drawings = SKIP_DRAWINGS_DEFAULT
+    interactive = state is None
+    if interactive and promote_speculative_candidate(ui_key):
+        write_log("INFO", "ui_section:speculative_hit", f"采用预生成结果: {ui_key}", {"ui_key": ui_key})
+        return True
+    if state is None:
+        state = st.session_state
 
     write_log("INFO", "ui_section:start", f"开始生成章节: {ui_key}", {"ui_key": ui_key})
 
     # 附图类章节：根据配置跳过
     if ui_key in ("drawings", "figures", "drawings_description", "figures_description", "figures_desc"):
-        skip_drawings = st.session_state.get("skip_drawings", SKIP_DRAWINGS_DEFAULT)
+        skip_drawings = state.get("skip_drawings", SKIP_DRAWINGS_DEFAULT)
         if ui_key == "drawings":
             invention_solution_detail = get_active_content("invention_solution_detail")
-            generate_all_drawings(llm_client, invention_solution_detail)
-            write_log("INFO", "ui_section:done", "附图章节处理完成", {"ui_key": ui_key, "skipped": skip_drawings})
-            return
+            ok = generate_all_drawings(llm_client, invention_solution_detail)
+            write_log("INFO", "ui_section:done", "附图章节处理完成", {"ui_key": ui_key, "skipped": skip_drawings, "ok": ok})
+            return ok
         else:
             if skip_drawings:
                 content = _fallback_drawings_desc()
-                ensure_version_state(ui_key)
-                st.session_state[f"{ui_key}_versions"].append(content)
-                st.session_state[f"{ui_key}_active_index"] = len(st.session_state[f"{ui_key}_versions"]) - 1
-                st.session_state.data_timestamps[ui_key] = time.time()
+                ensure_version_state(ui_key, state)
+                state[f"{ui_key}_versions"].append(content)
+                state[f"{ui_key}_active_index"] = len(state[f"{ui_key}_versions"]) - 1
+                state["data_timestamps"][ui_key] = time.time()
                 write_log("INFO", "ui_section:drawings_desc_placeholder", "附图说明采用无附图占位", {"ui_key": ui_key})
-                return
+                return True
 
     # --- 步骤 1: 生成所有微观组件（每步记录输入与输出） ---
     workflow_keys = UI_SECTION_CONFIG[ui_key]["workflow_keys"]
     write_log("DEBUG", "ui_section:workflow_keys", "章节工作流组件", {"ui_key": ui_key, "workflow_keys": workflow_keys})
 
-    for micro_key in workflow_keys:
-        step_config = WORKFLOW_CONFIG[micro_key]
-        format_args = build_format_args(step_config["dependencies"])
-
-        if micro_key == "implementation_details":
-            points = get_active_content("solution_points") or []
-            details = []
-            write_log("DEBUG", "ui_section:impl_details:start", "开始逐点生成实施例细节", {"points_count": len(points)})
-            for i, point in enumerate(points):
-                point_prompt = safe_format_prompt(step_config["prompt"], point=point)
-                detail = call_llm(
-                    llm_client,
-                    messages=[{"role": "user", "content": point_prompt}],
-                    json_mode=False,
-                    tag=f"implementation_detail_{i+1}",
-                    extra_ctx={"micro_key": micro_key}
-                )
-                details.append(detail)
-            ensure_version_state(micro_key)
-            st.session_state[f"{micro_key}_versions"].append(details)
-            st.session_state[f"{micro_key}_active_index"] = len(st.session_state[f"{micro_key}_versions"]) - 1
-            st.session_state.data_timestamps[micro_key] = time.time()
-            write_log("INFO", "ui_section:impl_details:done", "实施例细节生成完成并保存版本", {"versions_count": len(st.session_state[f"{micro_key}_versions"])})
-            continue
+    completed: List[str] = []
+    try:
+        for micro_key in workflow_keys:
+            step_config = WORKFLOW_CONFIG[micro_key]
+            format_args = build_format_args(step_config["dependencies"], state=None if interactive else state)
 
-        prompt = safe_format_prompt(step_config["prompt"], **format_args)
-        response_str = call_llm(
-            llm_client,
-            messages=[{"role": "user", "content": prompt}],
-            json_mode=step_config["json_mode"],
-            tag=f"{ui_key}:{micro_key}",
-            extra_ctx={"micro_key": micro_key, "ui_key": ui_key}
-        )
-        try:
-            result = json.loads(response_str.strip()) if step_config["json_mode"] else response_str.strip()
-        except json.JSONDecodeError:
-            st.error(f"无法解析JSON，模型返回内容: {response_str}")
-            write_log("ERROR", "ui_section:json_parse_error", "微观组件JSON解析失败", {"micro_key": micro_key, "raw_snippet": _truncate_text(response_str, LOG_MAX_CONTENT_CHARS)})
-            return
+            if micro_key == "implementation_details":
+                points = get_active_content("solution_points", state) or []
+                details = []
+                write_log("DEBUG", "ui_section:impl_details:start", "开始逐点生成实施例细节", {"points_count": len(points)})
+                try:
+                    for i, point in enumerate(points):
+                        point_prompt = safe_format_prompt(step_config["prompt"], point=point)
+                        detail = call_llm(
+                            llm_client,
+                            messages=[{"role": "user", "content": point_prompt}],
+                            json_mode=False,
+                            tag=f"implementation_detail_{i+1}",
+                            extra_ctx={"micro_key": micro_key},
+                            max_tokens=step_config.get("max_tokens"),
+                            guard=guard_for_step(micro_key),
+                        )
+                        details.append(detail)
+                except JobCancelled:
+                    # 已完成的要点作为部分结果保留
+                    if details:
+                        _append_version(micro_key, details, state)
+                        mark_partial_version(micro_key, len(state[f"{micro_key}_versions"]) - 1,
+                                             f"仅完成 {len(details)}/{len(points)} 个实施例要点", state)
+                        completed.append(micro_key)
+                    raise
+                _append_version(micro_key, details, state)
+                completed.append(micro_key)
+                write_log("INFO", "ui_section:impl_details:done", "实施例细节生成完成并保存版本", {"versions_count": len(state[f"{micro_key}_versions"])})
+                continue
 
-        ensure_version_state(micro_key)
-        st.session_state[f"{micro_key}_versions"].append(result)
-        st.session_state[f"{micro_key}_active_index"] = len(st.session_state[f"{micro_key}_versions"]) - 1
-        st.session_state.data_timestamps[micro_key] = time.time()
-        write_log("INFO", "ui_section:micro_generated", "微观组件生成完成", {"micro_key": micro_key, "ui_key": ui_key})
+            prompt = safe_format_prompt(step_config["prompt"], **format_args)
+            response_str = call_llm(
+                llm_client,
+                messages=[{"role": "user", "content": prompt}],
+                json_mode=step_config["json_mode"],
+                tag=f"{ui_key}:{micro_key}",
+                extra_ctx={"micro_key": micro_key, "ui_key": ui_key},
+                max_tokens=step_config.get("max_tokens"),
+                guard=guard_for_step(micro_key),
+            )
+            try:
+                result = json.loads(response_str.strip()) if step_config["json_mode"] else response_str.strip()
+            except json.JSONDecodeError:
+                _notify("error", f"无法解析JSON，模型返回内容: {response_str}")
+                write_log("ERROR", "ui_section:json_parse_error", "微观组件JSON解析失败", {"micro_key": micro_key, "raw_snippet": _truncate_text(response_str, LOG_MAX_CONTENT_CHARS)})
+                return False
+
+            _append_version(micro_key, result, state)
+            completed.append(micro_key)
+            write_log("INFO", "ui_section:micro_generated", "微观组件生成完成", {"micro_key": micro_key, "ui_key": ui_key})
+    except JobCancelled:
+        _keep_partial_section(ui_key, completed, state)
+        raise
 
     # --- 步骤 2: 组装章节初稿（增强兜底，并记录组装结果） ---
-    brief = st.session_state.get('structured_brief', {}) or {}
+    assemble_ui_section(ui_key, state)
+    write_log("INFO", "ui_section:done", "章节生成完成", {"ui_key": ui_key})
+    return True
+
+
+def _append_version(key: str, content: Any, state: MutableMapping[str, Any]):
+    ensure_version_state(key, state)
+    state[f"{key}_versions"].append(content)
+    state[f"{key}_active_index"] = len(state[f"{key}_versions"]) - 1
+    state["data_timestamps"][key] = time.time()
+
+
+def _keep_partial_section(ui_key: str, completed: List[str], state: MutableMapping[str, Any]):
+    """
+    生成被取消或超时：用本次已完成的微观组件组装章节，作为标记为部分结果的新版本保留；
+    一个组件都未完成时不写入任何版本，章节保持原状。
+    """
+    workflow_keys = UI_SECTION_CONFIG[ui_key]["workflow_keys"]
+    if not completed:
+        write_log("WARN", "ui_section:cancelled", "章节生成已中止，无可保留的结果", {"ui_key": ui_key})
+        return
+    if not assemble_ui_section(ui_key, state):
+        return
+    missing = [k for k in workflow_keys if k not in completed]
+    if missing:
+        note = f"生成已中止，仅完成 {len(completed)}/{len(workflow_keys)} 个组成步骤（未完成：{'、'.join(missing)}）"
+    else:
+        # 最后一个组件本身是部分结果（如实施例只完成了部分要点）
+        note = "生成已中止，" + (partial_version_note(completed[-1], state[f"{completed[-1]}_active_index"], state) or "部分组件不完整")
+    mark_partial_version(ui_key, len(state[f"{ui_key}_versions"]) - 1, note, state)
+    write_log("WARN", "ui_section:partial_kept", "章节生成已中止，部分结果已保存为标记版本", {
+        "ui_key": ui_key, "completed": completed, "missing": missing,
+    })
+
+
+def assemble_ui_section(ui_key: str, state: Optional[MutableMapping[str, Any]] = None,
+                        log: Optional[Callable[..., None]] = None) -> bool:
+    """
+    由已生成的微观组件组装章节初稿（不调用模型），并作为新版本保存。
+    state 默认为当前会话；批量模式传入各草稿自己的状态字典与日志函数。
+    返回是否成功写入了新版本。
+    """
+    if state is None:
+        state = st.session_state
+    if log is None:
+        log, notify = write_log, _notify
+    else:
+        notify = lambda level, message: log("WARN", "ui_section:notice", message, {"ui_key": ui_key})
+    brief = state.get('structured_brief', {}) or {}
+    workflow_keys = UI_SECTION_CONFIG[ui_key]["workflow_keys"]
     content = ""
 
     if ui_key == "title":
-        raw_options = get_active_content("title_options") or []
+        raw_options = get_active_content("title_options", state) or []
         titles = dedup_and_clean_titles(normalize_title_options(raw_options))
-        if "title_versions" not in st.session_state:
-            st.session_state.title_versions = []
+        if "title_versions" not in state:
+            state["title_versions"] = []
         else:
-            st.session_state.title_versions = dedup_and_clean_titles(st.session_state.title_versions)
+            state["title_versions"] = dedup_and_clean_titles(state["title_versions"])
 
         if not titles:
             core = (brief.get('core_inventive_concept') or '').strip()
@@ -612,56 +1082,55 @@ def generate_ui_section(llm_client: LLMClient, ui_key: str):
                 fallback = f"一种基于{core}的技术方案"
             if fallback:
                 titles = [fallback]
-                write_log("WARN", "ui_section:title_fallback", "使用结构化摘要兜底生成标题", {"fallback": fallback})
+                log("WARN", "ui_section:title_fallback", "使用结构化摘要兜底生成标题", {"fallback": fallback})
 
         if titles:
-            st.session_state.title_versions.extend(titles)
-            st.session_state.title_active_index = len(st.session_state.title_versions) - 1
-            st.session_state.data_timestamps[ui_key] = time.time()
-            write_log("INFO", "ui_section:title_built", "标题候选生成并保存", {"added_count": len(titles), "total_versions": len(st.session_state.title_versions)})
+            state["title_versions"].extend(titles)
+            state["title_active_index"] = len(state["title_versions"]) - 1
+            state["data_timestamps"][ui_key] = time.time()
+            log("INFO", "ui_section:title_built", "标题候选生成并保存", {"added_count": len(titles), "total_versions": len(state["title_versions"])})
         else:
-            st.warning("未能提取有效的发明名称候选，请重试或手动编辑。")
-            write_log("WARN", "ui_section:title_empty", "未能提取有效标题候选")
-        write_log("INFO", "ui_section:done", "章节生成完成", {"ui_key": ui_key})
-        return
+            notify("warning", "未能提取有效的发明名称候选，请重试或手动编辑。")
+            log("WARN", "ui_section:title_empty", "未能提取有效标题候选")
+        return bool(titles)
 
     elif ui_key == "background":
-        context = (get_active_content("background_context") or "").strip()
-        problem = (get_active_content("background_problem") or "").strip()
+        context = (get_active_content("background_context", state) or "").strip()
+        problem = (get_active_content("background_problem", state) or "").strip()
         if not context and brief.get("background_technology"):
             context = str(brief.get("background_technology"))
-            write_log("WARN", "ui_section:background_fallback_context", "背景技术使用结构化摘要兜底")
+            log("WARN", "ui_section:background_fallback_context", "背景技术使用结构化摘要兜底")
         if not problem and brief.get("problem_statement"):
             problem = str(brief.get("problem_statement"))
-            write_log("WARN", "ui_section:background_fallback_problem", "现有技术问题使用结构化摘要兜底")
+            log("WARN", "ui_section:background_fallback_problem", "现有技术问题使用结构化摘要兜底")
         content = f"## 2.1 对最接近发明的同类现有技术状况加以分析说明\n{context}\n\n## 2.2 实事求是地指出现有技术存在的问题，尽可能分析存在的原因。\n{problem}"
 
     elif ui_key == "invention":
-        purpose = (get_active_content("invention_purpose") or "").strip()
-        solution_detail = (get_active_content("invention_solution_detail") or "").strip()
-        effects = (get_active_content("invention_effects") or "").strip()
+        purpose = (get_active_content("invention_purpose", state) or "").strip()
+        solution_detail = (get_active_content("invention_solution_detail", state) or "").strip()
+        effects = (get_active_content("invention_effects", state) or "").strip()
         if not purpose and brief.get("problem_statement") and brief.get("core_inventive_concept"):
             purpose = f"为解决{brief.get('problem_statement')}，提出基于{brief.get('core_inventive_concept')}的技术方案。"
-            write_log("WARN", "ui_section:invention_fallback_purpose", "发明目的使用结构化摘要兜底")
+            log("WARN", "ui_section:invention_fallback_purpose", "发明目的使用结构化摘要兜底")
         if not solution_detail and brief.get("technical_solution_summary"):
             solution_detail = str(brief.get("technical_solution_summary"))
-            write_log("WARN", "ui_section:invention_fallback_solution", "技术解决方案使用结构化摘要兜底")
+            log("WARN", "ui_section:invention_fallback_solution", "技术解决方案使用结构化摘要兜底")
         if not effects and brief.get("achieved_effects"):
             effects = str(brief.get("achieved_effects"))
-            write_log("WARN", "ui_section:invention_fallback_effects", "技术效果使用结构化摘要兜底")
+            log("WARN", "ui_section:invention_fallback_effects", "技术效果使用结构化摘要兜底")
         content = f"## 3.1 发明目的\n{purpose}\n\n## 3.2 技术解决方案\n{solution_detail}\n\n## 3.3 技术效果\n{effects}"
 
     elif ui_key == "implementation":
-        details = get_active_content("implementation_details") or []
+        details = get_active_content("implementation_details", state) or []
         if isinstance(details, list) and not details:
-            sol = (get_active_content("invention_solution_detail") or brief.get("technical_solution_summary") or "").strip()
+            sol = (get_active_content("invention_solution_detail", state) or brief.get("technical_solution_summary") or "").strip()
             if sol:
                 details = [
                     f"实施例1：根据上述技术解决方案，系统由关键模块构成并按设计流程运行。核心方案：{sol}",
                     "实施例2：在不同环境与约束条件下的参数设定与安全策略调整。",
                     "实施例3：与现有系统的接口与数据交互、以及性能评估与可靠性保障。",
                 ]
-                write_log("WARN", "ui_section:implementation_fallback", "实施例细节为空，使用兜底条目")
+                log("WARN", "ui_section:implementation_fallback", "实施例细节为空，使用兜底条目")
         content = "\n".join([f"{i+1}. {detail}" for i, detail in enumerate(details)])
 
     elif ui_key in ("technical_field", "tech_field"):
@@ -676,7 +1145,7 @@ def generate_ui_section(llm_client: LLMClient, ui_key: str):
     else:
         parts: List[str] = []
         for micro_key in workflow_keys:
-            block = get_active_content(micro_key)
+            block = get_active_content(micro_key, state)
             text = _stringify_block(block)
             if text:
                 heading = WORKFLOW_CONFIG.get(micro_key, {}).get("title") or WORKFLOW_CONFIG.get(micro_key, {}).get("label")
@@ -684,7 +1153,7 @@ def generate_ui_section(llm_client: LLMClient, ui_key: str):
         content = "\n\n".join([p for p in parts if p.strip()])
         if not content.strip():
             if ui_key in ("drawings_description", "figures_description", "figures_desc"):
-                content = _fallback_drawings_desc() if st.session_state.get("skip_drawings", SKIP_DRAWINGS_DEFAULT) else ""
+                content = _fallback_drawings_desc() if state.get("skip_drawings", SKIP_DRAWINGS_DEFAULT) else ""
             elif ui_key in ("technical_field", "tech_field"):
                 content = _fallback_technical_field(brief)
             elif ui_key in ("claims", "claim"):
@@ -693,87 +1162,222 @@ def generate_ui_section(llm_client: LLMClient, ui_key: str):
                 content = _fallback_abstract(brief)
 
     if not content.strip():
-        st.warning(f"无法为 {UI_SECTION_CONFIG[ui_key]['label']} 生成初稿，依赖项内容为空。")
-        write_log("WARN", "ui_section:empty_content", "章节初稿内容为空", {"ui_key": ui_key})
-        return
+        notify("warning", f"无法为 {UI_SECTION_CONFIG[ui_key]['label']} 生成初稿，依赖项内容为空。")
+        log("WARN", "ui_section:empty_content", "章节初稿内容为空", {"ui_key": ui_key})
+        return False
 
-    ensure_version_state(ui_key)
-    st.session_state[f"{ui_key}_versions"].append(content)
-    st.session_state[f"{ui_key}_active_index"] = len(st.session_state[f"{ui_key}_versions"]) - 1
-    st.session_state.data_timestamps[ui_key] = time.time()
+    ensure_version_state(ui_key, state)
+    state[f"{ui_key}_versions"].append(content)
+    state[f"{ui_key}_active_index"] = len(state[f"{ui_key}_versions"]) - 1
+    state["data_timestamps"][ui_key] = time.time()
 
-    write_log("INFO", "ui_section:assembled", "章节初稿组装并保存", {
+    log("INFO", "ui_section:assembled", "章节初稿组装并保存", {
         "ui_key": ui_key,
         "content_len": len(content),
         "content_snippet": _truncate_text(content, LOG_MAX_CONTENT_CHARS),
-        "versions_count": len(st.session_state[f"{ui_key}_versions"])
+        "versions_count": len(state[f"{ui_key}_versions"])
     })
-    write_log("INFO", "ui_section:done", "章节生成完成", {"ui_key": ui_key})
+    return True
+
+
+# -------------- 预生成（投机生成） --------------
+
+def speculate_ui_section(llm_client: LLMClient, ui_key: str, job, fingerprint: str):
+    """
+    在会话状态的影子副本上生成章节，把新增版本作为候选保存（键为输入指纹）。
+    用户点击生成时若输入未变则直接采用候选；结束时输入已变化则丢弃结果。
+    """
+    shadow = export_draft_state()
+    shadow["skip_drawings"] = st.session_state.get("skip_drawings", SKIP_DRAWINGS_DEFAULT)
+    keys = list(UI_SECTION_CONFIG[ui_key]["workflow_keys"]) + [ui_key]
+    before = {k: list(shadow.get(f"{k}_versions", [])) for k in keys}
+    write_log("INFO", "speculation:start", f"开始预生成章节: {ui_key}", {"ui_key": ui_key, "fingerprint": fingerprint})
+    try:
+        generate_ui_section(llm_client, ui_key, state=shadow)
+    finally:
+        record_tokens(job.tokens_used)
+
+    if section_input_fingerprint(ui_key) != fingerprint:
+        write_log("INFO", "speculation:discarded", "输入已变化，丢弃预生成结果", {"ui_key": ui_key, "tokens_est": job.tokens_used})
+        return
+    versions: Dict[str, List[Any]] = {}
+    for k in keys:
+        old, new = before[k], shadow.get(f"{k}_versions", [])
+        added = new[len(old):] if new[:len(old)] == old else [v for v in new if v not in old]
+        if added:
+            versions[k] = added
+    if ui_key not in versions:
+        write_log("WARN", "speculation:empty", "预生成未产生章节版本", {"ui_key": ui_key})
+        return
+    store_candidate(ui_key, fingerprint, versions, job.tokens_used)
+    write_log("INFO", "speculation:ready", "预生成候选已就绪", {"ui_key": ui_key, "keys": list(versions), "tokens_est": job.tokens_used})
+
+# -------------- 单项权利要求重写 --------------
+
+def regenerate_claim(llm_client: LLMClient, claim_no: int) -> bool:
+    """
+    只重写权利要求书中的第 claim_no 项：由解析出的结构定位该项及其引用的在先权利要求，
+    连同本地校验发现的问题一并交给模型；结果替换回原文，作为权利要求书的新版本保存，其余各项保持不变。
+    """
+    claims_text = get_active_content("claims") or ""
+    report = validate_claims(claims_text)
+    tree = report["tree"]
+    claim = tree.by_number.get(claim_no)
+    if claim is None:
+        _notify("warning", f"权利要求 {claim_no} 不存在。")
+        return False
+
+    step_config = WORKFLOW_CONFIG["claim_regenerate"]
+    format_args = build_format_args(step_config["dependencies"])
+    issues = [item["message"] for item in report["issues"] if item["claim_no"] == claim_no]
+    basis = "\n".join(f"{a.number}. {a.text}" for a in tree.ancestors(claim_no))
+    prompt = safe_format_prompt(
+        step_config["prompt"],
+        **format_args,
+        claim_no=claim_no,
+        claim_text=claim.text,
+        basis_claims=basis or "（无，本项为独立权利要求）",
+        claim_issues="\n".join(f"- {m}" for m in issues) or "（本地校验未发现问题，按要求优化表述）",
+        claims_text=claims_text,
+    )
+    response = call_llm(
+        llm_client,
+        messages=[{"role": "user", "content": prompt}],
+        json_mode=False,
+        tag=f"claims:claim_{claim_no}",
+        extra_ctx={"ui_key": "claims", "claim_no": claim_no},
+        guard=guard_for_step("claim_regenerate"),
+    )
+    new_text = strip_claim_number(response)
+    if not new_text:
+        _notify("warning", f"权利要求 {claim_no} 重写结果为空，已保留原文。")
+        write_log("WARN", "claims:claim_empty", "单项权利要求重写结果为空", {"claim_no": claim_no})
+        return False
+    _append_version("claims", replace_claim(claims_text, claim_no, new_text), st.session_state)
+    write_log("INFO", "claims:claim_regenerated", "单项权利要求已重写", {
+        "claim_no": claim_no, "issues_before": len(issues), "content_len": len(new_text),
+    })
+    return True
+
+# -------------- 一键生成初稿 --------------
+
+def generate_full_draft(llm_client: LLMClient):
+    """
+    按 UI_SECTION_ORDER 依次生成全部章节；在后台任务中执行时跳过已完成的章节以支持续跑。
+    只有生成成功的章节才记为已完成，解析失败的章节在续跑时重新生成。
+    """
+    job = current_job()
+    write_log("INFO", "full_draft:start", "开始一键生成初稿", {"resumed_steps": list(job.completed_steps) if job else []})
+    with _status("正在为您生成完整专利初稿...") as status:
+        for key in UI_SECTION_ORDER:
+            if job is not None and job.is_step_done(key):
+                continue
+            _checkpoint()
+            status.update(label=f"正在生成: {UI_SECTION_CONFIG[key]['label']}...")
+            if generate_ui_section(llm_client, key) and job is not None:
+                job.mark_step_done(key)
+        # 补齐组合章节键，避免预览为空（仅在配置存在的情况下）
+        for k in UI_SECTION_ORDER:
+            if (k in UI_SECTION_CONFIG) and (not get_active_content(k)):
+                _checkpoint()
+                label = UI_SECTION_CONFIG.get(k, {}).get('label', k)
+                status.update(label=f"正在生成: {label}...")
+                generate_ui_section(llm_client, k)
+        status.update(label="✅ 所有章节生成完毕！", state="complete")
+    write_log("INFO", "full_draft:done", "一键生成初稿完成")
 
 # -------------- 全局重构与润色 --------------
 
+# 全局润色原样保留的章节（附图类）
+REFINE_SKIP_KEYS = ('drawings', 'figures', 'drawings_description', 'figures_description', 'figures_desc')
+# 润色单个章节的输出上限：超出时由 call_llm 续写
+REFINE_MAX_TOKENS = 8192
+# 润色时随章节一并提供的原始生成指令
+REFINE_ORIGINAL_PROMPTS = {
+    "background": [prompts.PROMPT_BACKGROUND_CONTEXT, prompts.PROMPT_BACKGROUND_PROBLEM],
+    "invention": [prompts.PROMPT_INVENTION_PURPOSE, prompts.PROMPT_INVENTION_SOLUTION_DETAIL, prompts.PROMPT_INVENTION_EFFECTS],
+    "implementation": [prompts.PROMPT_IMPLEMENTATION_POINT]
+}
+
 def run_global_refinement(llm_client: LLMClient):
     """迭代所有章节，并根据全局上下文和原始生成要求进行重构与润色。"""
     write_log("INFO", "global_refinement:start", "开始全局重构与润色")
-    st.session_state.globally_refined_draft = {}
-    initial_draft_content = {key: get_active_content(key) for key in UI_SECTION_ORDER}
+    job = current_job()
+    # 续跑时保留已润色的章节
+    if not (job is not None and job.completed_steps):
+        st.session_state.globally_refined_draft = {}
+    # 全文快照只组装一次，各章节的“排除自身”上下文由快照按需构建
+    draft = get_draft_document()
+    initial_draft_content = draft.data
 
-    prompt_map = {
-        "background": [prompts.PROMPT_BACKGROUND_CONTEXT, prompts.PROMPT_BACKGROUND_PROBLEM],
-        "invention": [prompts.PROMPT_INVENTION_PURPOSE, prompts.PROMPT_INVENTION_SOLUTION_DETAIL, prompts.PROMPT_INVENTION_EFFECTS],
-        "implementation": [prompts.PROMPT_IMPLEMENTATION_POINT]
-    }
+    try:
+        with _status("正在执行全局重构与润色...") as status:
+            for target_key in UI_SECTION_ORDER:
+                if job is not None and job.is_step_done(target_key):
+                    continue
+                if target_key in REFINE_SKIP_KEYS:
+                    st.session_state.globally_refined_draft[target_key] = initial_draft_content.get(target_key)
+                    write_log("INFO", "global_refinement:skip", "跳过章节（无需润色）", {"target_key": target_key})
+                    if job is not None:
+                        job.mark_step_done(target_key)
+                    continue
 
-    with st.status("正在执行全局重构与润色...", expanded=True) as status:
-        for target_key in UI_SECTION_ORDER:
-            if target_key in ('drawings', 'figures', 'drawings_description', 'figures_description', 'figures_desc'):
-                st.session_state.globally_refined_draft[target_key] = initial_draft_content.get(target_key)
-                write_log("INFO", "global_refinement:skip", "跳过章节（无需润色）", {"target_key": target_key})
-                continue
+                status.update(label=f"正在重构与润色: {UI_SECTION_CONFIG[target_key]['label']}...")
+                write_log("INFO", "global_refinement:section_start", "开始润色章节", {"target_key": target_key})
 
-            status.update(label=f"正在重构与润色: {UI_SECTION_CONFIG[target_key]['label']}...")
-            write_log("INFO", "global_refinement:section_start", "开始润色章节", {"target_key": target_key})
+                global_context = draft.context_excluding(target_key)
+                target_content = initial_draft_content.get(target_key, "") or ""
 
-            global_context_parts = []
-            for key, content in initial_draft_content.items():
-                if key == target_key:
-                    continue
-                label = UI_SECTION_CONFIG[key]['label']
-                processed_content = ""
-                if key == 'title':
-                    processed_content = content or ""
-                elif key in ('drawings', 'figures') and isinstance(content, list):
-                    processed_content = "附图列表:\n" + "\n".join([f"- {d.get('title')}: {d.get('description')}" for d in content])
-                elif isinstance(content, str):
-                    processed_content = content
-                if processed_content:
-                    global_context_parts.append(f"--- {label} ---\n{processed_content}")
-            global_context = "\n".join(global_context_parts)
-            target_content = initial_draft_content.get(target_key, "") or ""
-
-            original_prompts = prompt_map.get(target_key, [])
-            original_generation_prompt = "\n---\n".join(original_prompts)
-            if not original_generation_prompt:
-                st.warning(f"未找到 {UI_SECTION_CONFIG[target_key]['label']} 的原始生成指令，将仅基于全局上下文进行润色。")
-                write_log("WARN", "global_refinement:no_original_prompt", "缺少原始生成指令", {"target_key": target_key})
-
-            refine_prompt = safe_format_prompt(
-                prompts.PROMPT_GLOBAL_RESTRUCTURE_AND_POLISH,
-                global_context=global_context,
-                target_section_name=UI_SECTION_CONFIG[target_key]['label'],
-                target_section_content=target_content,
-                original_generation_prompt=original_generation_prompt or ""
-            )
-            refined_content = call_llm(
-                llm_client,
-                messages=[{"role": "user", "content": refine_prompt}],
-                json_mode=False,
-                tag=f"refine:{target_key}",
-                extra_ctx={"target_key": target_key}
-            )
-            st.session_state.globally_refined_draft[target_key] = (refined_content or "").strip()
-            write_log("INFO", "global_refinement:refined", "章节润色完成", {"target_key": target_key, "refined_len": len(refined_content)})
+                original_prompts = REFINE_ORIGINAL_PROMPTS.get(target_key, [])
+                original_generation_prompt = "\n---\n".join(original_prompts)
+                if not original_generation_prompt:
+                    _notify("warning", f"未找到 {UI_SECTION_CONFIG[target_key]['label']} 的原始生成指令，将仅基于全局上下文进行润色。")
+                    write_log("WARN", "global_refinement:no_original_prompt", "缺少原始生成指令", {"target_key": target_key})
 
-        status.update(label="✅ 全局重构与润色完成！", state="complete")
+                refine_prompt = safe_format_prompt(
+                    prompts.PROMPT_GLOBAL_RESTRUCTURE_AND_POLISH,
+                    global_context=global_context,
+                    target_section_name=UI_SECTION_CONFIG[target_key]['label'],
+                    target_section_content=target_content,
+                    original_generation_prompt=original_generation_prompt or ""
+                )
+                refined_content = call_llm(
+                    llm_client,
+                    messages=[{"role": "user", "content": refine_prompt}],
+                    json_mode=False,
+                    tag=f"refine:{target_key}",
+                    extra_ctx={"target_key": target_key},
+                    max_tokens=REFINE_MAX_TOKENS,
+                    guard=guard_for_step(f"refine:{target_key}"),
+                )
+                st.session_state.globally_refined_draft[target_key] = (refined_content or "").strip()
+                write_log("INFO", "global_refinement:refined", "章节润色完成", {"target_key": target_key, "refined_len": len(refined_content)})
+                if job is not None:
+                    job.mark_step_done(target_key)
+
+            status.update(label="✅ 全局重构与润色完成！", state="complete")
+    except JobCancelled:
+        _keep_partial_refinement(initial_draft_content)
+        raise
     st.session_state.refined_version_available = True
+    st.session_state.refined_version_partial = []
     write_log("INFO", "global_refinement:done", "全局重构与润色完成")
+
+
+def _keep_partial_refinement(initial_draft_content: Dict[str, Any]):
+    """
+    润色被取消或超时：已润色的章节保留为润色版，其余章节沿用初稿内容，
+    并记录未润色的章节，预览中将该润色版标为部分结果。续跑会补齐剩余章节。
+    """
+    refined = st.session_state.get("globally_refined_draft") or {}
+    unrefined = [k for k in UI_SECTION_ORDER if k not in refined]
+    if not any(k not in REFINE_SKIP_KEYS for k in refined):
+        write_log("WARN", "global_refinement:cancelled", "全局润色已中止，无可保留的结果")
+        return
+    merged = dict(refined)
+    for k in unrefined:
+        merged[k] = initial_draft_content.get(k)
+    st.session_state.globally_refined_draft = merged
+    st.session_state.refined_version_available = True
+    st.session_state.refined_version_partial = unrefined
+    write_log("WARN", "global_refinement:partial_kept", "全局润色已中止，部分结果已保存", {"unrefined": unrefined})